@@ -1,7 +1,9 @@
+import copy
 import argparse
+import torch
 
 
-def get_args():
+def get_args(argv=None):
     parser = argparse.ArgumentParser(description='Fairness')
     parser.add_argument('--result-dir', default='./results/',
                         help='directory to save results (default: ./results/)')
@@ -13,6 +15,9 @@ def get_args():
                         help='directory to save trained models (default: ./trained_models/)')
     parser.add_argument('--device', default=0, type=int, help='cuda device number')
     parser.add_argument('--t-device', default=0, type=int, help='teacher cuda device number')
+    parser.add_argument('--cpu', default=False, action='store_true', help='run on cpu even if a gpu is available')
+    parser.add_argument('--num-threads', default=None, type=int, help='intra-op threads for torch on cpu')
+    parser.add_argument('--num-interop-threads', default=None, type=int, help='inter-op threads for torch on cpu')
     
     parser.add_argument('--mode', default='train', choices=['train', 'eval'])
     parser.add_argument('--modelpath', default=None)
@@ -41,9 +46,27 @@ def get_args():
     parser.add_argument('--teamodel', default='', choices=['resnet12', 'resnet50', 'resnet34', 'resnet18', 'resnet101','mlp'])        
     parser.add_argument('--teacher-type', default=None, choices=['mlp','resnet12','bert','resnet18', 'resnet34', 'resnet50', 'mobilenet', 'shufflenet', 'cifar_net', 'None'])
     parser.add_argument('--teacher-path', default=None, help='teacher model path')
+    parser.add_argument('--teacher-cache', default=False, action='store_true',
+                        help='compute the teacher features of the train set once into a memory-mapped cache (mfd)')
+    parser.add_argument('--teacher-cache-views', default=0, type=int,
+                        help='0: cache the non-augmented view of each sample, K: cache K augmented views (image datasets)')
 
     parser.add_argument('--pretrained', default=False, action='store_true', help='load imagenet pretrained model')
     parser.add_argument('--n-workers', default=1, type=int, help='the number of thread used in dataloader')
+    parser.add_argument('--img-cache', default=False, action='store_true',
+                        help='decode and resize images once into a memory-mapped cache (celeba, utkface, waterbird)')
+    parser.add_argument('--token-cache', default=False, action='store_true',
+                        help='tokenize jigsaw once into a memory-mapped cache and pad each batch to its longest comment')
+    parser.add_argument('--resident', default=False, action='store_true',
+                        help='keep adult/compas as tensors on the gpu and batch them by index slicing')
+    parser.add_argument('--length-bucketing', default=False, action='store_true',
+                        help='batch comments of similar length together (needs --token-cache)')
+    parser.add_argument('--amp', default=None, choices=['bf16', 'fp16'], help='mixed precision for forward passes')
+    parser.add_argument('--channels-last', default=False, action='store_true', help='channels-last memory format for the model')
+    parser.add_argument('--ckpt-freq', default=1, type=int, help='save a checkpoint every this many epochs (0: never)')
+    parser.add_argument('--resume', default=False, action='store_true', help='resume training from the checkpoint of this run')
+    parser.add_argument('--count-syncs', default=False, action='store_true',
+                        help='report the host syncs per training step (item, tolist, cpu, ...)')
     parser.add_argument('--term', default=20, type=int, help='the period for recording train acc')
     parser.add_argument('--target', default='Blond_Hair', type=str, help='target attribute for celeba')
     parser.add_argument('--add-attr', default=None, help='additional group attribute for celeba')
@@ -52,10 +75,21 @@ def get_args():
 
     parser.add_argument('--sigma', default=1.0, type=float, help='sigma for rbf kernel')
     parser.add_argument('--kernel', default='rbf', type=str, choices=['rbf', 'poly'], help='kernel for mmd')
+    parser.add_argument('--hsic-estimator', default='unbiased', choices=['unbiased', 'trace', 'rff', 'nystrom', 'block'],
+                        help='hsic estimator for fairhsic: unbiased (O(n^3) as in the paper), trace (same estimate, O(n^2)), '
+                             'rff/nystrom (low rank, O(n d^2)), block (mean over blocks, O(n b))')
+    parser.add_argument('--hsic-features', default=512, type=int, help='random features or landmarks of rff/nystrom')
+    parser.add_argument('--hsic-block', default=64, type=int, help='block size of the block hsic estimator')
+    parser.add_argument('--mmd-features', default=0, type=int,
+                        help='approximate the rbf kernel of mmd with this many random Fourier features (0: exact)')
     parser.add_argument('--balSampling', default=False, action='store_true', help='balSampling loader')
     parser.add_argument('--get-inter', default=False, action='store_true',
                         help='get penultimate features for TSNE visualization')
     parser.add_argument('--record', default=False, action='store_true', help='record')
+    parser.add_argument('--record-backend', default='tensorboard', choices=['tensorboard', 'jsonl', 'csv'],
+                        help='where --record writes to, <log-dir>/<date>/<dataset>/<method>/<log name>[.jsonl|.csv]')
+    parser.add_argument('--fused-record', default=False, action='store_true',
+                        help='record the train loss/acc from the training steps of each epoch instead of an extra pass')
     parser.add_argument('--analysis', default=False, action='store_true', help='analysis')
     parser.add_argument('--uc', default=False, action='store_true', help='uncertain')
     
@@ -73,10 +107,16 @@ def get_args():
     parser.add_argument('--q-decay', default='linear', type=str, help='the type of optimization for q')
     parser.add_argument('--label-flipped', default=False, action='store_true', help='flip a label when the corresponding q has a negative value')
     parser.add_argument('--rholr', default=0.001, type=float, help='learning rate of lambda')        
+    parser.add_argument('--q-loss-estimator', default='full', choices=['full', 'running', 'ema'],
+                        help='full: re-evaluate the train set for each q update, '
+                             'running/ema: reuse the per-sample losses of the training steps')
+    parser.add_argument('--q-loss-decay', default=0.9, type=float, help='decay of the per-sample loss for the ema estimator')
    
     # For exp_grad_reduction,
     parser.add_argument('--bound_B', default=0.01, type=float, help='bound for L1 norm')
     parser.add_argument('--constraint_c', default=0.0, type=float, help='bound for constraint c')
+    parser.add_argument('--egr-ensemble', default='fp16-delta', choices=['fp32', 'fp16', 'fp16-delta'],
+                        help='how the model of every iteration is stored on disk: fp32, fp16, or fp16 differences to the initial model')
     
     # For cotter,
     parser.add_argument('--lamblr', default=0.001, type=float, help='learning rate of lambda')    
@@ -84,13 +124,49 @@ def get_args():
     
     # balanced cross entropy
     parser.add_argument('--balanced', default=False, action='store_true', help='whether use a balanced acc')
+
+    # For training several mlp/lr replicas at once,
+    parser.add_argument('--replicas', default=1, type=int, help='the number of mlp replicas trained in one batched pass')
+    parser.add_argument('--replica-seeds', default=None, type=int, nargs='+', help='init seed of each replica (default: seed, seed+1, ...); the first one must be --seed')
+    parser.add_argument('--replica-rho', default=None, type=float, nargs='+', help='rho of each replica (fairdro)')
+    parser.add_argument('--replica-gamma', default=None, type=float, nargs='+', help='gamma of each replica (fairdro, gdro)')
     
-    args = parser.parse_args()
-    args.cuda=True
+    args = parser.parse_args(argv)
+    args.cuda = torch.cuda.is_available() and not args.cpu
+    if args.replicas > 1:
+        if args.method not in ['scratch', 'fairdro', 'gdro'] or args.model not in ['mlp', 'lr']:
+            raise Exception('Replicas are only supported for the mlp and lr models with scratch, fairdro and gdro')
+        if args.mode != 'train' or args.record:
+            raise Exception('Replicas are only supported for training without --record')
+        args.replica_seeds = args.replica_seeds or [args.seed + k for k in range(args.replicas)]
+        if args.replica_seeds[0] != args.seed:
+            # replica 0 and the data order follow the global rng, which is seeded with --seed
+            raise Exception('The first of --replica-seeds must be --seed ({})'.format(args.seed))
+        args.replica_rho = args.replica_rho or [args.rho] * args.replicas
+        args.replica_gamma = args.replica_gamma or [args.gamma] * args.replicas
+        for name in ['replica_seeds', 'replica_rho', 'replica_gamma']:
+            if len(getattr(args, name)) != args.replicas:
+                raise Exception('--{} needs one value per replica'.format(name.replace('_', '-')))
+    if args.method == 'fairhsic' and args.hsic_estimator == 'rff' and args.dataset == 'jigsaw':
+        raise Exception('The rff hsic estimator needs the rbf kernel, use nystrom for jigsaw')
     if args.mode == 'train' and args.method == 'mfd':
         if args.teacher_type is None:
             raise Exception('A teacher model needs to be specified for distillation')
         elif args.teacher_path is None:
             raise Exception('A teacher model path is not specified.')
+        if args.teacher_cache_views > 0 and args.dataset in ('adult', 'compas', 'jigsaw'):
+            raise Exception('{} has no augmentation, --teacher-cache-views needs an image dataset'.format(args.dataset))
+        if args.mmd_features > 0 and args.kernel != 'rbf':
+            raise Exception('--mmd-features needs the rbf kernel')
 
     return args
+
+
+def get_replica_args(args):
+    # the configuration each replica of a --replicas run corresponds to as a single run
+    replica_args = []
+    for seed, rho, gamma in zip(args.replica_seeds, args.replica_rho, args.replica_gamma):
+        replica = copy.copy(args)
+        replica.replicas, replica.seed, replica.rho, replica.gamma = 1, seed, rho, gamma
+        replica_args.append(replica)
+    return replica_args
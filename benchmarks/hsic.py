@@ -0,0 +1,91 @@
+"""
+Accuracy against speed of the HSIC estimators of fairhsic (--hsic-estimator).
+
+    $ python benchmarks/hsic.py --batch-sizes 128 512 2048
+
+The features are synthetic, shaped like those of resnet50 (rbf kernel,
+d=2048) and of the bert cls token (squared cosine kernel as for jigsaw,
+d=768), with 2 classes and 3 groups. For every estimator it prints the time
+of one forward and backward pass of the fairhsic loss (one masked HSIC per
+class) and its deviation from the unbiased estimate.
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from trainer.hsic import RbfHSIC
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='HSIC estimator benchmark')
+    parser.add_argument('--batch-sizes', default=[128, 512, 2048], type=int, nargs='+')
+    parser.add_argument('--estimators', default=['unbiased', 'trace', 'rff:512', 'rff:2048', 'nystrom:128',
+                                                 'nystrom:512', 'block:64', 'block:256'], nargs='+',
+                        metavar='NAME[:FEATURES_OR_BLOCK]')
+    parser.add_argument('--n-groups', default=3, type=int)
+    parser.add_argument('--n-classes', default=2, type=int)
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+def make_hsic(estimator, nlp_flag):
+    name, _, size = estimator.partition(':')
+    kwargs = {}
+    if name in ['rff', 'nystrom'] and size:
+        kwargs['n_features'] = int(size)
+    elif name == 'block' and size:
+        kwargs['block_size'] = int(size)
+    return RbfHSIC(1, 1, algorithm=name, nlp_flag=nlp_flag, **kwargs)
+
+
+def fairhsic_loss(hsic, features, groups, labels, n_classes):
+    return sum(hsic.estimator(features, groups, mask=labels == c) for c in range(n_classes))
+
+
+def main():
+    args = get_args()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    for nlp_flag, dim in [(False, 2048), (True, 768)]:
+        print('kernel {}, d={}'.format('squared cosine (jigsaw)' if nlp_flag else 'rbf', dim))
+        print('{:>6} {:>12} {:>10} {:>10}'.format('n', 'estimator', 'ms', 'deviation'))
+        for n in args.batch_sizes:
+            g = torch.randint(0, args.n_groups, (n,), device=device)
+            labels = torch.randint(0, args.n_classes, (n,), device=device)
+            # relu features that depend on the group, so the HSIC is well above 0
+            shift = 0.4 * torch.randn(args.n_groups, dim, device=device)
+            features = torch.relu(torch.randn(n, dim, device=device) + shift[g]).requires_grad_()
+            groups = F.one_hot(g, args.n_groups).float()
+
+            ref = None
+            for estimator in args.estimators:
+                if nlp_flag and estimator.startswith('rff'):
+                    continue # rff needs the rbf kernel
+                hsic = make_hsic(estimator, nlp_flag)
+                fairhsic_loss(hsic, features, groups, labels, args.n_classes).backward()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    value = fairhsic_loss(hsic, features, groups, labels, args.n_classes)
+                    value.backward()
+                if device.type == 'cuda':
+                    torch.cuda.synchronize(device)
+                elapsed = (time.perf_counter() - start) / args.repeat
+                features.grad = None
+                if estimator == 'unbiased':
+                    ref = value.item()
+                deviation = '{:+.1f}%'.format(100 * (value.item() - ref) / abs(ref)) if ref else '-'
+                print('{:>6} {:>12} {:>10.1f} {:>10}'.format(n, estimator, elapsed * 1e3, deviation))
+
+
+if __name__ == '__main__':
+    main()
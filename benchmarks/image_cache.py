@@ -0,0 +1,117 @@
+"""
+Loader throughput of the --img-cache path against the PIL path.
+
+    $ python benchmarks/image_cache.py --dataset celeba --n-workers 0 2 4 8
+
+Runs the train and test transforms of the dataset class through a DataLoader,
+once decoding the JPEG files with PIL and once from an ImageCache, and prints
+samples/s for every number of loader workers. Without --images, the images
+are synthetic JPEGs of --image-size written to a temporary directory.
+"""
+import os
+import sys
+import time
+import glob
+import argparse
+import importlib
+import tempfile
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from data_handler.dataset_factory import dataset_dict
+from data_handler.image_cache import ImageCache
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='image cache benchmark')
+    parser.add_argument('--dataset', default='celeba', choices=['celeba', 'utkface', 'waterbird'],
+                        help='the dataset class whose transforms and cache sizes are used')
+    parser.add_argument('--images', default=None, help='directory of .jpg files to read instead of synthetic ones')
+    parser.add_argument('--n-images', default=2048, type=int)
+    parser.add_argument('--image-size', default=[218, 178], type=int, nargs=2, metavar=('H', 'W'),
+                        help='size of the synthetic images (celeba: 218 178)')
+    parser.add_argument('--n-workers', default=[0, 2, 4], type=int, nargs='+')
+    parser.add_argument('--batch-size', default=128, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+class _Files(Dataset):
+    def __init__(self, paths, transform):
+        self.paths = paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, index):
+        return self.transform(Image.open(self.paths[index], mode='r').convert('RGB'))
+
+
+class _Cached(Dataset):
+    def __init__(self, cache, transform):
+        self.cache = cache
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __getitem__(self, index):
+        return self.transform(self.cache[index])
+
+
+def throughput(dataset, batch_size, n_workers):
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=n_workers, drop_last=False)
+    start = time.perf_counter()
+    n = 0
+    for batch in loader:
+        n += len(batch)
+    return n / (time.perf_counter() - start)
+
+
+def synthetic_images(root, n, size, seed):
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(n):
+        path = os.path.join(root, '{:06d}.jpg'.format(i))
+        # smooth noise, so the jpegs decode at a realistic cost
+        small = rng.randint(0, 256, (size[0] // 8 + 1, size[1] // 8 + 1, 3), dtype=np.uint8)
+        Image.fromarray(small).resize((size[1], size[0]), Image.BILINEAR).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def main():
+    args = get_args()
+    torch.manual_seed(args.seed)
+    module, name = dataset_dict[args.dataset]
+    cls = getattr(importlib.import_module(module), name)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.images is None:
+            paths = synthetic_images(tmp, args.n_images, args.image_size, args.seed)
+        else:
+            paths = sorted(glob.glob(os.path.join(args.images, '*.jpg')))[:args.n_images]
+        zeros = np.zeros(len(paths), dtype=np.int64)
+
+        print('{} images, {}, batch size {}'.format(len(paths), args.dataset, args.batch_size))
+        print('{:>6} {:>8} {:>14} {:>14} {:>8}'.format('split', 'workers', 'PIL (img/s)', 'cache (img/s)', 'speedup'))
+        for split in ['train', 'test']:
+            size = cls.cache_size[split] if isinstance(cls.cache_size, dict) else cls.cache_size
+            cache = ImageCache.open_or_build(os.path.join(tmp, 'cache'), split, paths, zeros, zeros, size,
+                                             n_workers=max(args.n_workers))
+            pil = _Files(paths, cls.train_transform if split == 'train' else cls.test_transform)
+            cached = _Cached(cache, cls.cached_train_transform if split == 'train' else cls.cached_test_transform)
+            for n_workers in args.n_workers:
+                pil_rate = throughput(pil, args.batch_size, n_workers)
+                cache_rate = throughput(cached, args.batch_size, n_workers)
+                print('{:>6} {:>8} {:>14.0f} {:>14.0f} {:>7.1f}x'.format(split, n_workers, pil_rate, cache_rate,
+                                                                      cache_rate / pil_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Per-subgroup mean loss of a batch: utils.subgroup_mean against the dense
+group_map matmul that the trainers used before.
+
+    $ python benchmarks/subgroup_stats.py --subgroups 4 10 80 1000 --batch-size 256
+
+For every number of subgroups it checks that both give the same means and
+gradients and prints the time of one forward and backward pass of each.
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import subgroup_mean
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='subgroup reduction benchmark')
+    parser.add_argument('--subgroups', default=[4, 10, 80, 1000], type=int, nargs='+')
+    parser.add_argument('--batch-size', default=256, type=int)
+    parser.add_argument('--repeat', default=200, type=int)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--seed', default=0, type=int)
+    return parser.parse_args()
+
+
+def matmul_mean(loss, subgroups, n_subgroups):
+    group_map = (subgroups == torch.arange(n_subgroups, device=loss.device).unsqueeze(1).long()).float()
+    group_count = group_map.sum(1)
+    group_denom = group_count + (group_count == 0).float() # avoid nans
+    return (group_map @ loss.view(-1)) / group_denom
+
+
+def timed(fn, loss, subgroups, n_subgroups, repeat, device):
+    weights = torch.arange(n_subgroups, device=device).float()
+    for _ in range(10):
+        (fn(loss, subgroups, n_subgroups) @ weights).backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        (fn(loss, subgroups, n_subgroups) @ weights).backward()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    args = get_args()
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+
+    print('batch size {}, forward + backward'.format(args.batch_size))
+    print('{:>9} {:>11} {:>14} {:>10}'.format('subgroups', 'matmul (us)', 'index_add (us)', 'max diff'))
+    for n_subgroups in args.subgroups:
+        subgroups = torch.randint(0, n_subgroups, (args.batch_size,), device=device)
+        loss = torch.rand(args.batch_size, device=device, requires_grad=True)
+
+        weights = torch.arange(n_subgroups, device=device).float()
+        ref = matmul_mean(loss, subgroups, n_subgroups)
+        out = subgroup_mean(loss, subgroups, n_subgroups)
+        ref_grad, = torch.autograd.grad(ref @ weights, loss)
+        out_grad, = torch.autograd.grad(out @ weights, loss)
+        diff = max((ref - out).abs().max().item(), (ref_grad - out_grad).abs().max().item())
+
+        t_matmul = timed(matmul_mean, loss, subgroups, n_subgroups, args.repeat, device)
+        t_index = timed(subgroup_mean, loss, subgroups, n_subgroups, args.repeat, device)
+        print('{:>9} {:>11.1f} {:>14.1f} {:>10.1e}'.format(n_subgroups, t_matmul * 1e6, t_index * 1e6, diff))
+
+
+if __name__ == '__main__':
+    main()
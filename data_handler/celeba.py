@@ -41,10 +41,22 @@ class CelebA(data_handler.GenericDataset):
              transforms.ToTensor(),
              transforms.Normalize(mean=mean, std=std)] 
         )
+    # the resize is baked into the image cache, the rest runs on the cached uint8 tensors
+    cache_size = {'train': (256, 256), 'test': (224, 224)}
+    cached_train_transform = transforms.Compose(
+            [transforms.RandomCrop(224),
+             transforms.RandomHorizontalFlip(),
+             transforms.ConvertImageDtype(torch.float),
+             transforms.Normalize(mean=mean, std=std)]
+        )
+    cached_test_transform = transforms.Compose(
+            [transforms.ConvertImageDtype(torch.float),
+             transforms.Normalize(mean=mean, std=std)]
+        )
     
     name = 'celeba'
 
-    def __init__(self, target_attr='Blond_Hair', add_attr=None, download=False, **kwargs):
+    def __init__(self, target_attr='Blond_Hair', add_attr=None, download=False, img_cache=False, n_workers=4, **kwargs):
         transform = self.train_transform if kwargs['split'] == 'train' else self.test_transform
         super(CelebA, self).__init__(transform=transform, **kwargs)
 
@@ -97,6 +109,13 @@ class CelebA(data_handler.GenericDataset):
         tmp = np.array(self.features)
         att = tmp[:,0]
         self.n_data, self.idxs_per_group = self._data_count(self.features, self.n_groups, self.n_classes)
+
+        self.image_cache = None
+        if img_cache:
+            train = self.split == 'train'
+            image_paths = [os.path.join(self.root, "img_align_celeba", f[2]) for f in self.features]
+            self.image_cache = self._load_image_cache(image_paths, self.cache_size['train' if train else 'test'], n_workers)
+            self.transform = self.cached_train_transform if train else self.cached_test_transform
         
         #if self.split == "test":
         #    self.features = self._balance_test_data(self.n_data, self.n_groups, self.n_classes)
@@ -104,7 +123,10 @@ class CelebA(data_handler.GenericDataset):
 
     def __getitem__(self, index):
         sensitive, target, img_name = self.features[index]
-        image = PIL.Image.open(os.path.join(self.root, "img_align_celeba", img_name))
+        if self.image_cache is not None:
+            image = self.image_cache[index]
+        else:
+            image = PIL.Image.open(os.path.join(self.root, "img_align_celeba", img_name))
         
         if self.transform is not None:
             image = self.transform(image)
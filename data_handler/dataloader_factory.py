@@ -10,8 +10,7 @@ class DataloaderFactory:
         pass
 
     @staticmethod
-    def get_dataloader(name, batch_size=256, seed = 0, n_workers=4,
-                       target_attr='Blond_Hair', add_attr=None, balSampling=False, args=None):
+    def get_datasets(name, batch_size=256, seed=0, target_attr='Blond_Hair', add_attr=None, args=None):
         if name == 'adult':
             target_attr = 'sex'
         elif name == 'compas':
@@ -20,9 +19,23 @@ class DataloaderFactory:
             target_attr = 'toxicity'
 
         test_dataset = DatasetFactory.get_dataset(name, split='test',
-                                                  target_attr=target_attr, seed=seed, add_attr=add_attr, bs=batch_size,uc=args.uc,method=args.method)
+                                                  target_attr=target_attr, seed=seed, add_attr=add_attr, bs=batch_size,uc=args.uc,method=args.method,
+                                                  img_cache=args.img_cache, token_cache=args.token_cache,
+                                                  n_workers=args.n_workers)
         train_dataset = DatasetFactory.get_dataset(name, split='train',
-                                                   target_attr=target_attr, seed=seed,add_attr=add_attr, bs=batch_size,uc=args.uc,method=args.method)
+                                                   target_attr=target_attr, seed=seed,add_attr=add_attr, bs=batch_size,uc=args.uc,method=args.method,
+                                                   img_cache=args.img_cache, token_cache=args.token_cache,
+                                                   n_workers=args.n_workers)
+        return train_dataset, test_dataset
+
+    @staticmethod
+    def get_dataloader(name, batch_size=256, seed = 0, n_workers=4,
+                       target_attr='Blond_Hair', add_attr=None, balSampling=False, args=None, datasets=None):
+        # datasets: an already loaded (train, test) pair, e.g. shared by the configs of a sweep
+        if datasets is None:
+            datasets = DataloaderFactory.get_datasets(name, batch_size=batch_size, seed=seed, target_attr=target_attr,
+                                                      add_attr=add_attr, args=args)
+        train_dataset, test_dataset = datasets
         
         n_classes = test_dataset.n_classes
         n_groups = test_dataset.n_groups
@@ -48,12 +61,26 @@ class DataloaderFactory:
             from data_handler.fairbatch import FairBatch
             sampler = FairBatch(train_dataset, batch_size, gamma=args.gamma, target_fairness='eo', seed=seed)
             shuffle = False
+        elif args.length_bucketing and getattr(train_dataset, 'lengths', None) is not None:
+            from data_handler.jigsaw_dataset import LengthBucketSampler
+            sampler = LengthBucketSampler(train_dataset.lengths, batch_size, seed=seed)
+            shuffle = False
 
-        train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
-                                      num_workers=n_workers, worker_init_fn=_init_fn, pin_memory=True, drop_last=True)
+        if args.resident and name in ('adult', 'compas'):
+            from data_handler.resident_loader import ResidentLoader
+            from utils import get_device
+            device = get_device(args)
+            train_dataloader = ResidentLoader(train_dataset, batch_size, shuffle=shuffle, sampler=sampler,
+                                              drop_last=True, device=device)
+            test_dataloader = ResidentLoader(test_dataset, 256, shuffle=False, device=device)
+        else:
+            train_dataloader = DataLoader(train_dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
+                                          num_workers=n_workers, worker_init_fn=_init_fn, pin_memory=args.cuda, drop_last=True,
+                                          collate_fn=train_dataset.collate_fn)
 
-        test_dataloader = DataLoader(test_dataset, batch_size=256, shuffle=False,
-                                     num_workers=n_workers, worker_init_fn=_init_fn, pin_memory=True)
+            test_dataloader = DataLoader(test_dataset, batch_size=256, shuffle=False,
+                                         num_workers=n_workers, worker_init_fn=_init_fn, pin_memory=args.cuda,
+                                         collate_fn=test_dataset.collate_fn)
 
         print('# of test data : {}'.format(len(test_dataset)))
         print('# of train data : {}'.format(len(train_dataset)))
@@ -62,3 +89,10 @@ class DataloaderFactory:
 
         return n_classes, n_groups, train_dataloader, test_dataloader
 
+    @staticmethod
+    def get_loader(dataset, batch_size, shuffle=False, **kwargs):
+        # any further loader over a dataset of get_dataloader (q updates, statistics passes) must go through here:
+        # with the token cache, jigsaw samples are unpadded and only the dataset's collate_fn can batch them
+        return DataLoader(dataset, batch_size=batch_size, shuffle=shuffle,
+                          collate_fn=getattr(dataset, 'collate_fn', None), **kwargs)
+
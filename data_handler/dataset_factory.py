@@ -1,4 +1,5 @@
 import importlib
+import os
 import torch.utils.data as data
 import numpy as np
 from collections import defaultdict
@@ -20,7 +21,8 @@ class DatasetFactory:
 
     @staticmethod
    # def get_dataset(name, split='Train', seed=0, sv_ratio=1, version=1, target='Attractive', add_attr=None):
-    def get_dataset(name, split='train', seed=0, target_attr='Blond_Hair', add_attr=None, balSampling=False, bs=256, uc=False, method=None):
+    def get_dataset(name, split='train', seed=0, target_attr='Blond_Hair', add_attr=None, balSampling=False, bs=256, uc=False, method=None, img_cache=False,
+                    token_cache=False, n_workers=4):
         root = f'./data/{name}' if name != 'utkface_fairface' else './data/utkface'
         kwargs = {'root':root,
                   'split':split,
@@ -30,6 +32,10 @@ class DatasetFactory:
         if name not in dataset_dict.keys():
             raise Exception('Not allowed method')
         
+        if name in ('celeba', 'utkface', 'waterbird'):
+            kwargs['img_cache'] = img_cache
+            kwargs['n_workers'] = n_workers # decode workers of an image cache build
+
         if name == 'celeba':
             kwargs['add_attr'] = add_attr
             kwargs['target_attr'] = target_attr
@@ -42,6 +48,7 @@ class DatasetFactory:
             kwargs['batch_size'] = bs
             kwargs['uc']=uc
             kwargs['method']=method
+            kwargs['token_cache'] = token_cache
         
         module = importlib.import_module(dataset_dict[name][0])
         class_ = getattr(module, dataset_dict[name][1])
@@ -51,6 +58,8 @@ class DatasetFactory:
         return class_(**kwargs)
 
 class GenericDataset(data.Dataset):
+    collate_fn = None # default collate unless a dataset pads its own batches
+
     def __init__(self, root, split='train', transform=None, seed=0, uc=False):
         self.root = root
         self.split = split
@@ -61,6 +70,20 @@ class GenericDataset(data.Dataset):
         
     def __len__(self):
         return np.sum(self.n_data)
+
+    # metadata of every sample, so that statistics passes need not load the inputs
+    def get_group_array(self):
+        return np.array([int(feature[0]) for feature in self.features])
+
+    def get_label_array(self):
+        return np.array([int(feature[1]) for feature in self.features])
+
+    def _load_image_cache(self, image_paths, size, n_workers=4):
+        # decoded and resized once, then memory-mapped; see data_handler/image_cache.py
+        from data_handler.image_cache import ImageCache
+        return ImageCache.open_or_build(os.path.join(self.root, 'cache'), '{}_{}'.format(self.name, self.split),
+                                        image_paths, self.get_group_array(), self.get_label_array(), size,
+                                        n_workers=n_workers)
     
     def _data_count(self, features, n_groups, n_classes):
         idxs_per_group = defaultdict(lambda: [])
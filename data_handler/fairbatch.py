@@ -152,27 +152,39 @@ class FairBatch(Sampler):
             
         """
         
-        select_index = []
-        
         if replacement == True:
+            select_index = []
             for _ in range(n_batch):
                 select_index.append(np.random.choice(full_index, batch_size, replace = False))
-        else:
-            tmp_index = full_index.detach().cpu().numpy().copy()
-            random.shuffle(tmp_index)
-            
+            return select_index
+
+        # same draws as random.shuffle on the index array, which keeps the epochs identical for a given seed
+        tmp_index = full_index.detach().cpu().numpy().reshape(-1).tolist()
+        random.shuffle(tmp_index)
+        tmp_index = np.asarray(tmp_index, dtype=np.int64)
+        n_index = len(tmp_index)
+
+        if 0 <= batch_size <= n_index and n_index > 0:
+            # start of every batch; a batch running past the end wraps around to the front
+            starts = np.empty(n_batch, dtype=np.int64)
             start_idx = 0
             for i in range(n_batch):
-                if start_idx + batch_size > len(full_index):
-                    select_index.append(np.concatenate((tmp_index[start_idx:], tmp_index[ : batch_size - (len(full_index)-start_idx)])))
-                    start_idx = len(full_index)-start_idx
-                else:
-                    select_index.append(tmp_index[start_idx:start_idx + batch_size])
-                    start_idx += batch_size
-            
+                starts[i] = start_idx
+                start_idx = n_index - start_idx if start_idx + batch_size > n_index else start_idx + batch_size
+            return tmp_index[(starts[:, None] + np.arange(batch_size)) % n_index]
+
+        # batch sizes outside the subgroup size give ragged batches
+        select_index = []
+        start_idx = 0
+        for i in range(n_batch):
+            if start_idx + batch_size > n_index:
+                select_index.append(np.concatenate((tmp_index[start_idx:], tmp_index[ : batch_size - (n_index-start_idx)])))
+                start_idx = n_index-start_idx
+            else:
+                select_index.append(tmp_index[start_idx:start_idx + batch_size])
+                start_idx += batch_size
         return select_index
 
-    
     def __iter__(self):
         """Iters the full process of FairBatch for serving the batches to training.
         
@@ -244,19 +256,24 @@ class FairBatch(Sampler):
 #             sort_index_y_0_z_1 = self.select_batch_replacement(each_size[(0, 1)], self.yz_index[(0,1)], self.batch_num, self.replacement)
 #             sort_index_y_1_z_0 = self.select_batch_replacement(each_size[(1, 0)], self.yz_index[(1,0)], self.batch_num, self.replacement)
 #             sort_index_y_0_z_0 = self.select_batch_replacement(each_size[(0, 0)], self.yz_index[(0,0)], self.batch_num, self.replacement)
-        finallist = []
+        keys = [(_l, _g) for _l in range(self.n_labels) for _g in range(self.n_groups)]
+        if not all(isinstance(sort_index[key], np.ndarray) for key in keys):
+            finallist = []
+            for i in range(self.n_batch):
+                key_in_fairbatch = np.hstack([sort_index[key][i] for key in keys]).tolist()
+                random.shuffle(key_in_fairbatch)
+                finallist.extend(key_in_fairbatch)
+            return iter(finallist)
+
+        # (n_batch, batch size) in the key order, then the per-batch shuffle applied as one gather;
+        # shuffling range(batch size) consumes the same draws as shuffling the batch itself
+        batches = np.concatenate([sort_index[key] for key in keys], axis=1)
+        perms = np.empty(batches.shape, dtype=np.int64)
         for i in range(self.n_batch):
-            batch = None
-            for _l in range(self.n_labels):
-                for _g in range(self.n_groups):
-                    key = (_l, _g)                        
-                    if batch is None:
-                        batch = sort_index[key][i].copy()
-                    else:
-                        batch = np.hstack((batch, sort_index[key][i].copy()))
-            key_in_fairbatch = batch.tolist()
-            random.shuffle(key_in_fairbatch)
-            finallist.extend(key_in_fairbatch)
+            perm = list(range(batches.shape[1]))
+            random.shuffle(perm)
+            perms[i] = perm
+        finallist = np.take_along_axis(batches, perms, axis=1).reshape(-1).tolist()
 
 #                 key_in_fairbatch = np.hstack(batch)
 #                 key_in_fairbatch = sort_index_y_0_z_0[i].copy()
@@ -271,4 +288,11 @@ class FairBatch(Sampler):
 
     def __len__(self):
         """Returns the length of data."""
-        return len(self.y_data)
\ No newline at end of file
+        return len(self.y_data)
+
+    def state_dict(self):
+        """Returns the lambdas adjusted during training, for checkpoints."""
+        return {'lbs': copy.deepcopy(self.lbs)}
+
+    def load_state_dict(self, state):
+        self.lbs = copy.deepcopy(state['lbs'])
\ No newline at end of file
@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import transforms
+from torch.utils.data import Dataset, DataLoader
+
+
+class ImageCache:
+    """Pre-decoded, resized uint8 images of one dataset split in a single memory-mapped file.
+
+    Layout: magic | header length (uint64) | json header | padding |
+            images (N, H, W, 3) uint8 | groups (N,) int64 | labels (N,) int64
+    The header records the cache version, the resize parameters and a hash of
+    the source files (name, size and modification time), so a cache built with
+    other settings or from other images is never reused.
+    """
+    magic = b'FDROIMGC'
+    version = 1
+    alignment = 64
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            if f.read(len(self.magic)) != self.magic:
+                raise ValueError('{} is not an image cache'.format(path))
+            header_len = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        self.n_data = self.header['n_data']
+        self.size = tuple(self.header['size'])
+        self._offset = self._data_offset(header_len)
+        self._images = None
+
+    @classmethod
+    def _data_offset(cls, header_len):
+        offset = len(cls.magic) + 8 + header_len
+        return (offset + cls.alignment - 1) // cls.alignment * cls.alignment
+
+    def _open(self):
+        # opened lazily so that each dataloader worker maps the file itself
+        n, (h, w) = self.n_data, self.size
+        self._images = np.memmap(self.path, dtype=np.uint8, mode='c', offset=self._offset, shape=(n, h, w, 3))
+        label_offset = self._offset + n * h * w * 3
+        self._targets = np.memmap(self.path, dtype=np.int64, mode='r', offset=label_offset, shape=(2, n))
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._open()
+        return self._images
+
+    @property
+    def groups(self):
+        if self._images is None:
+            self._open()
+        return self._targets[0]
+
+    @property
+    def labels(self):
+        if self._images is None:
+            self._open()
+        return self._targets[1]
+
+    def __len__(self):
+        return self.n_data
+
+    def __getitem__(self, index):
+        # (3, H, W) uint8 view of the mapped file
+        return torch.from_numpy(self.images[index]).permute(2, 0, 1)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_images'] = None
+        state.pop('_targets', None)
+        return state
+
+    @staticmethod
+    def make_header(image_paths, groups, labels, size):
+        sha = hashlib.sha1()
+        for path in image_paths:
+            stat = os.stat(path)
+            sha.update('{}:{}:{};'.format(os.path.basename(path), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+        sha.update(np.asarray(groups, dtype=np.int64).tobytes())
+        sha.update(np.asarray(labels, dtype=np.int64).tobytes())
+        return {'version': ImageCache.version,
+                'n_data': len(image_paths),
+                'size': list(size),
+                'interpolation': 'bilinear',
+                'mode': 'RGB',
+                'source_hash': sha.hexdigest()}
+
+    @classmethod
+    def build(cls, path, image_paths, groups, labels, size, header=None, n_workers=4):
+        header = cls.make_header(image_paths, groups, labels, size) if header is None else header
+        header_bytes = json.dumps(header).encode('utf-8')
+        offset = cls._data_offset(len(header_bytes))
+        n, (h, w) = len(image_paths), size
+
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(cls.magic)
+            f.write(np.uint64(len(header_bytes)).tobytes())
+            f.write(header_bytes)
+            f.truncate(offset + n * (h * w * 3 + 16))
+
+        images = np.memmap(tmp_path, dtype=np.uint8, mode='r+', offset=offset, shape=(n, h, w, 3))
+        loader = DataLoader(_ResizedImages(image_paths, size), batch_size=64, shuffle=False,
+                            num_workers=n_workers, drop_last=False)
+        for i, (batch, idxs) in enumerate(loader):
+            images[idxs.numpy()] = batch.numpy()
+            if i % 100 == 0:
+                print('[{}/{}] building image cache {}'.format(i * 64, n, path))
+        images.flush()
+        del images
+
+        tail = np.memmap(tmp_path, dtype=np.int64, mode='r+', offset=offset + n * h * w * 3, shape=(2, n))
+        tail[0] = groups
+        tail[1] = labels
+        tail.flush()
+        del tail
+        os.replace(tmp_path, path)
+        return cls(path)
+
+    @classmethod
+    def open_or_build(cls, cache_dir, name, image_paths, groups, labels, size, n_workers=4):
+        header = cls.make_header(image_paths, groups, labels, size)
+        os.makedirs(cache_dir, exist_ok=True)
+        path = os.path.join(cache_dir, '{}_{}x{}_{}.cache'.format(name, size[0], size[1], header['source_hash'][:10]))
+        if os.path.exists(path):
+            cache = cls(path)
+            if cache.header == header:
+                return cache
+            print('stale image cache {}, rebuilding'.format(path))
+        return cls.build(path, image_paths, groups, labels, size, header=header, n_workers=n_workers)
+
+
+class _ResizedImages(Dataset):
+    def __init__(self, image_paths, size):
+        self.image_paths = image_paths
+        self.resize = transforms.Resize(size)
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, index):
+        image = Image.open(self.image_paths[index], mode='r').convert('RGB')
+        return np.array(self.resize(image), dtype=np.uint8), index
@@ -1,8 +1,10 @@
 import os
+import hashlib
 import torch
 import pandas as pd
 import numpy as np
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+from torch.utils.data.dataloader import default_collate
 # from data.confounder_dataset import ConfounderDataset
 from data_handler.dataset_factory import GenericDataset
 from transformers import AutoTokenizer, BertTokenizer
@@ -22,6 +24,7 @@ class JigsawDataset(GenericDataset):
 #         confounder_names,
         batch_size=None,
         method=None,
+        token_cache=False,
         **kwargs
     ):
         
@@ -100,6 +103,12 @@ class JigsawDataset(GenericDataset):
         self.text_array = list(self.text_array[mask])
         self.tokenizer = BertTokenizer.from_pretrained(self.model)
 
+        # with the token cache, samples are unpadded and collate_fn pads each batch to its longest comment
+        self.token_ids, self.lengths = None, None
+        if token_cache:
+            self.token_ids, self.lengths = self._load_token_cache()
+            self.collate_fn = pad_collate
+
         self.n_data, _ = self._data_count(None, self.n_groups, self.n_classes)
 
 #     def __len__(self):
@@ -111,10 +120,47 @@ class JigsawDataset(GenericDataset):
     def get_label_array(self):
         return self.y_array
 
+    def _load_token_cache(self):
+        # one batched pass of the fast tokenizer, stored as memory-mapped int32 arrays
+        sha = hashlib.sha1('{}:{}'.format(self.model, self.max_length).encode('utf-8'))
+        for text in self.text_array:
+            sha.update(text.encode('utf-8'))
+            sha.update(b'\0')
+        cache_dir = os.path.join(self.root, 'cache')
+        prefix = os.path.join(cache_dir, 'jigsaw_{}_{}_{}'.format(self.split, self.max_length, sha.hexdigest()[:10]))
+        ids_path, len_path = prefix + '_ids.npy', prefix + '_lengths.npy'
+
+        if not (os.path.exists(ids_path) and os.path.exists(len_path)):
+            os.makedirs(cache_dir, exist_ok=True)
+            tokenizer = AutoTokenizer.from_pretrained(self.model, use_fast=True)
+            n = len(self.text_array)
+            ids = np.lib.format.open_memmap(ids_path + '.tmp', mode='w+', dtype=np.int32, shape=(n, self.max_length))
+            lengths = np.zeros(n, dtype=np.int32)
+            chunk = 10000
+            for start in range(0, n, chunk):
+                tokens = tokenizer(self.text_array[start:start+chunk], truncation=True, max_length=self.max_length,
+                                   return_attention_mask=False, return_token_type_ids=False)['input_ids']
+                for i, t in enumerate(tokens):
+                    ids[start+i, :len(t)] = t
+                    lengths[start+i] = len(t)
+                print('[{}/{}] tokenizing {} split'.format(min(start+chunk, n), n, self.split))
+            ids.flush()
+            del ids
+            np.save(len_path, lengths)
+            os.replace(ids_path + '.tmp', ids_path)
+
+        return np.load(ids_path, mmap_mode='r'), np.load(len_path)
+
     def __getitem__(self, idx):
         y = self.y_array[idx]
         g = self.g_array[idx]
 
+        if self.token_ids is not None:
+            length = self.lengths[idx]
+            input_ids = torch.from_numpy(self.token_ids[idx, :length].astype(np.int64))
+            x = torch.stack((input_ids, torch.ones_like(input_ids), torch.zeros_like(input_ids)), dim=1)
+            return x, 1, np.float32(g), np.int64(y), idx
+
         text = self.text_array[idx]
         tokens = self.tokenizer(
             text,
@@ -148,3 +194,46 @@ class JigsawDataset(GenericDataset):
                 group_name += f", {attr_name} = {bin_str[attr_idx]}"
         return group_name
 
+
+
+def pad_collate(batch):
+    """Pads the (length, 3) token tensors of a batch to its longest sequence."""
+    xs = [sample[0] for sample in batch]
+    x = torch.zeros(len(xs), max(len(t) for t in xs), 3, dtype=torch.long)
+    for i, t in enumerate(xs):
+        x[i, :len(t)] = t
+    return (x,) + tuple(default_collate([sample[1:] for sample in batch]))
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Shuffles the data, sorts each chunk of `bucket_size` batches by length and
+    shuffles the resulting batches, so that a batch holds comments of similar length.
+    """
+    def __init__(self, lengths, batch_size, bucket_size=50, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.chunk = batch_size * bucket_size
+        self.rng = np.random.RandomState(seed)
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        perm = self.rng.permutation(len(self.lengths))
+        batches = []
+        for start in range(0, len(perm), self.chunk):
+            idxs = perm[start:start+self.chunk]
+            idxs = idxs[np.argsort(self.lengths[idxs], kind='stable')]
+            batches.extend(idxs[i:i+self.batch_size] for i in range(0, len(idxs), self.batch_size))
+        # keep a trailing partial batch last so that drop_last still drops only it
+        full = [b for b in batches if len(b) == self.batch_size]
+        rest = [b for b in batches if len(b) < self.batch_size]
+        order = self.rng.permutation(len(full))
+        return iter(np.concatenate([full[i] for i in order] + rest).tolist())
+
+    def state_dict(self):
+        return {'rng': self.rng.get_state()}
+
+    def load_state_dict(self, state):
+        self.rng.set_state(state['rng'])
@@ -0,0 +1,54 @@
+import math
+import torch
+
+
+class ResidentLoader:
+    """
+    DataLoader replacement for tabular datasets (adult, compas).
+    The whole split is kept as contiguous tensors on the target device and every
+    batch is gathered with a single index_select, so there is no per-sample
+    python or worker overhead. Batches have the same layout and dtypes as the
+    default collate of TabularDataset.__getitem__.
+    """
+    def __init__(self, dataset, batch_size, shuffle=False, sampler=None, drop_last=False, device='cuda'):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.sampler = sampler
+        self.drop_last = drop_last
+        self.device = torch.device(device)
+
+        features = torch.as_tensor(dataset.features)
+        self.inputs = features[:, 2:].float().contiguous().to(self.device)
+        self.groups = features[:, 0].double().to(self.device)
+        self.labels = features[:, 1].long().to(self.device)
+        self.zeros = torch.zeros(batch_size, dtype=torch.long, device=self.device)
+
+    def _num_samples(self):
+        return len(self.sampler) if self.sampler is not None else len(self.dataset)
+
+    def __len__(self):
+        n = self._num_samples()
+        return n // self.batch_size if self.drop_last else math.ceil(n / self.batch_size)
+
+    def _indices(self):
+        if self.sampler is not None:
+            # samplers (WeightedRandomSampler, FairBatch) draw their indices on the host once per epoch
+            return torch.as_tensor(list(iter(self.sampler)), dtype=torch.long).to(self.device)
+        if self.shuffle:
+            return torch.randperm(len(self.dataset), device=self.device)
+        return None
+
+    def __iter__(self):
+        idxs = self._indices()
+        for i in range(len(self)):
+            start = i * self.batch_size
+            if idxs is None:
+                idx = torch.arange(start, min(start + self.batch_size, len(self.dataset)), device=self.device)
+                batch = (self.inputs[start:start+len(idx)], self.zeros[:len(idx)],
+                         self.groups[start:start+len(idx)], self.labels[start:start+len(idx)], idx)
+            else:
+                idx = idxs[start:start+self.batch_size]
+                batch = (self.inputs.index_select(0, idx), self.zeros[:len(idx)],
+                         self.groups.index_select(0, idx), self.labels.index_select(0, idx), idx)
+            yield batch
@@ -50,6 +50,12 @@ class TabularDataset(GenericDataset):
     def get_dim(self):
         return self.dataset.features.shape[-1]
 
+    def get_group_array(self):
+        return self.features[:, 0].astype(np.int64)
+
+    def get_label_array(self):
+        return self.features[:, 1].astype(np.int64)
+
     def __getitem__(self, idx):
         features = self.features[idx]
         group = features[0]
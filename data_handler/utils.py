@@ -26,18 +26,21 @@ def get_mean_std(dataset, skew_ratio=0.8):
 
 def predict_group(model, loader, args):
     
-    model.cuda('cuda:{}'.format(args.device))
+    from utils import get_device
+    from data_handler.dataloader_factory import DataloaderFactory
+    device = get_device(args)
+    model.to(device)
     if args.slversion == 3:
         filename = 'trained_models/group_clf/utkface/scratch/resnet18_seed{}_epochs70_bs128_lr0.001_sv{}_version0.0.pt'
     elif args.slversion == 5:
         filename = 'trained_models/group_clf_pretrain/utkface/scratch/resnet18_seed{}_epochs70_bs128_lr0.001_sv{}_version0.0.pt'
     path =filename.format(str(args.seed), str(args.sv))
-    model.load_state_dict(torch.load(path, map_location=torch.device('cuda:{}'.format(args.device))))
+    model.load_state_dict(torch.load(path, map_location=device))
     
     features = loader.dataset.features
     
-    dataloader = DataLoader(loader.dataset, batch_size=args.batch_size, shuffle=False,
-                        n_workers=args.n_workers, pin_memory=True, drop_last=False)
+    dataloader = DataloaderFactory.get_loader(loader.dataset, batch_size=args.batch_size, shuffle=False,
+                                          num_workers=args.n_workers, pin_memory=True, drop_last=False)
     model.eval()
     with torch.no_grad():
         for i, data in enumerate(dataloader):
@@ -45,10 +48,9 @@ def predict_group(model, loader, args):
             if (groups == -1).sum() == 0:
                 continue
 
-            if args.cuda:
-                inputs = inputs.cuda()
-                groups = groups.cuda()
-                idxs = idxs.cuda()
+            inputs = inputs.to(device)
+            groups = groups.to(device)
+            idxs = idxs.to(device)
             inputs = inputs[groups == -1]
             idxs = idxs[groups==-1] 
 
@@ -65,8 +67,8 @@ def predict_group(model, loader, args):
         def _init_fn(worker_id):
             np.random.seed(int(args.seed))
         sampler = Customsampler(loader.dataset, replacement=False, batch_size=args.batch_size)
-        train_dataloader = DataLoader(loader.dataset, batch_size=args.batch_size, sampler=sampler,
-                                      n_workers=args.n_workers, worker_init_fn=_init_fn, pin_memory=True, drop_last=True)
+        train_dataloader = DataloaderFactory.get_loader(loader.dataset, batch_size=args.batch_size, sampler=sampler,
+                                                        num_workers=args.n_workers, worker_init_fn=_init_fn, pin_memory=True, drop_last=True)
 
     del dataloader
     del model
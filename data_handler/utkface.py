@@ -1,3 +1,4 @@
+import torch
 from collections import defaultdict
 from os.path import join
 from PIL import Image
@@ -37,8 +38,20 @@ class UTKFaceDataset(GenericDataset):
          transforms.ToTensor(),
          transforms.Normalize(mean=mean, std=std)]
     )
+    # the resize is baked into the image cache, the rest runs on the cached uint8 tensors
+    cache_size = {'train': (256, 256), 'test': (224, 224)}
+    cached_train_transform = transforms.Compose(
+        [transforms.RandomCrop(224),
+         transforms.RandomHorizontalFlip(),
+         transforms.ConvertImageDtype(torch.float),
+         transforms.Normalize(mean=mean, std=std)]
+    )
+    cached_test_transform = transforms.Compose(
+        [transforms.ConvertImageDtype(torch.float),
+         transforms.Normalize(mean=mean, std=std)]
+    )
     name = 'utkface'
-    def __init__(self, **kwargs):
+    def __init__(self, img_cache=False, n_workers=4, **kwargs):
         
         transform = self.train_transform if kwargs['split'] == 'train' else self.test_transform
 
@@ -58,14 +71,24 @@ class UTKFaceDataset(GenericDataset):
         self.features = train if self.split == 'train' else test
         
         self.n_data, self.idxs_per_group = self._data_count(self.features, self.n_groups, self.n_classes)
+
+        self.image_cache = None
+        if img_cache:
+            train = self.split == 'train'
+            image_paths = [join(self.root, f[2]) for f in self.features]
+            self.image_cache = self._load_image_cache(image_paths, self.cache_size['train' if train else 'test'], n_workers)
+            self.transform = self.cached_train_transform if train else self.cached_test_transform
         
 #         self.weights = self._make_weights()
                 
     def __getitem__(self, index):
         s, l, img_name = self.features[index]
         
-        image_path = join(self.root, img_name)
-        image = Image.open(image_path, mode='r').convert('RGB')
+        if self.image_cache is not None:
+            image = self.image_cache[index]
+        else:
+            image_path = join(self.root, img_name)
+            image = Image.open(image_path, mode='r').convert('RGB')
 
         if self.transform:
             image = self.transform(image)
@@ -2,6 +2,7 @@ from os.path import join
 from PIL import Image
 
 import random
+import torch
 import numpy as np
 import pandas as pd
 from torchvision import transforms
@@ -32,9 +33,27 @@ class WaterBird(GenericDataset):
         transforms.ToTensor(),
         transforms.Normalize(mean, std)
     ])
+    # the cache stores 256x256 images; RandomResizedCrop then draws its crop from
+    # the resized image rather than from the original resolution
+    cache_size = (256, 256)
+    cached_train_transform = transforms.Compose([
+        transforms.RandomResizedCrop(
+            (224, 224),
+            scale=(0.7, 1.0),
+            ratio=(0.75, 1.3333333333333333),
+            interpolation=2),
+        transforms.RandomHorizontalFlip(),
+        transforms.ConvertImageDtype(torch.float),
+        transforms.Normalize(mean, std)
+    ])
+    cached_test_transform = transforms.Compose([
+        transforms.CenterCrop(224),
+        transforms.ConvertImageDtype(torch.float),
+        transforms.Normalize(mean, std)
+    ])
     name = 'waterbird'
     
-    def __init__(self, **kwargs):
+    def __init__(self, img_cache=False, n_workers=4, **kwargs):
         
         transform = self.train_transform if kwargs['split'] == 'train' else self.test_transform
 
@@ -62,12 +81,27 @@ class WaterBird(GenericDataset):
         self.n_classes = 2
         
         self.n_data, self.idxs_per_group = self._data_count(self.features, self.n_groups, self.n_classes)
+
+        self.image_cache = None
+        if img_cache:
+            image_paths = [join(self.root, filename) for filename in self.filenames]
+            self.image_cache = self._load_image_cache(image_paths, self.cache_size, n_workers)
+            self.transform = self.cached_train_transform if self.split == 'train' else self.cached_test_transform
+
+    def get_group_array(self):
+        return self.g_array
+
+    def get_label_array(self):
+        return self.y_array
         
     def __getitem__(self, index):
         s, l, img_name = self.features[index]
         
-        image_path = join(self.root, img_name)
-        image = Image.open(image_path, mode='r').convert('RGB')
+        if self.image_cache is not None:
+            image = self.image_cache[index]
+        else:
+            image_path = join(self.root, img_name)
+            image = Image.open(image_path, mode='r').convert('RGB')
 
         if self.transform:
             image = self.transform(image)
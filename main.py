@@ -5,23 +5,24 @@ import numpy as np
 import networks
 import data_handler
 import trainer
-from utils import check_log_dir, make_log_name, set_seed
+from trainer.metrics_writer import MetricsWriter
+from utils import check_log_dir, make_log_name, set_seed, get_device, set_num_threads, SyncCounter
 from adamp import AdamP
-from tensorboardX import SummaryWriter
 from sam.sam import SAM
-from arguments import get_args
+from arguments import get_args, get_replica_args
 import time
 import os 
+import contextlib
 from torch.utils.data import DataLoader
-args = get_args()
 
 
-def main():
+def main(args, datasets=None):
 
     torch.backends.cudnn.enabled = True
 
     seed = args.seed
     set_seed(seed)
+    set_num_threads(args)
 
     np.set_printoptions(precision=4)
     torch.set_printoptions(precision=4)
@@ -36,7 +37,7 @@ def main():
     if args.record:
         log_dir = os.path.join(args.log_dir, args.date, dataset, args.method)
         check_log_dir(log_dir)
-        writer = SummaryWriter(log_dir + '/' + log_name)
+        writer = MetricsWriter(log_dir + '/' + log_name, backend=args.record_backend)
 
     print(log_name)    
     ########################## get dataloader ################################
@@ -47,7 +48,8 @@ def main():
                                                         add_attr = args.add_attr,
 #                                                         skew_ratio=args.skew_ratio,
                                                         balSampling=args.balSampling,
-                                                        args=args
+                                                        args=args,
+                                                        datasets=datasets
                                                         )
     n_classes, n_groups, train_loader, test_loader = tmp
     ########################## get model ##################################
@@ -59,20 +61,21 @@ def main():
         args.img_size = 32
 
     model = networks.ModelFactory.get_model(args.model, n_classes, args.img_size,
-                                            pretrained=args.pretrained, n_groups=n_groups)
+                                            pretrained=args.pretrained, n_groups=n_groups,
+                                            replica_seeds=args.replica_seeds if args.replicas > 1 else None)
 
-    model.cuda('cuda:{}'.format(args.device))
+    model.to(get_device(args))
     if args.pretrained:
         if args.modelpath is not None:
-            model.load_state_dict(torch.load(args.modelpath))
+            model.load_state_dict(torch.load(args.modelpath, map_location=get_device(args)))
         elif args.model == 'mlp' and (args.teacher_path is not None and args.teacher_type):
-            model.load_state_dict(torch.load(args.teacher_path))
+            model.load_state_dict(torch.load(args.teacher_path, map_location=get_device(args)))
         
     teacher = None
     if ((args.method == 'mfd' and args.teacher_path is not None) and args.mode != 'eval'):
         teacher = networks.ModelFactory.get_model(args.teacher_type, train_loader.dataset.n_classes, args.img_size)
-        teacher.load_state_dict(torch.load(args.teacher_path, map_location=torch.device('cuda:{}'.format(args.t_device))))
-        teacher.cuda('cuda:{}'.format(args.t_device))
+        teacher.load_state_dict(torch.load(args.teacher_path, map_location=get_device(args, teacher=True)))
+        teacher.to(get_device(args, teacher=True))
 
     print('successfully call the model')
 #     set_seed(seed)
@@ -131,33 +134,50 @@ def main():
     
     if args.mode == 'train':
         start_t = time.time()
-        trainer_.train(train_loader, test_loader, args.epochs, writer=writer)
+        with SyncCounter() if args.count_syncs else contextlib.nullcontext() as sync_counter:
+            trainer_.train(train_loader, test_loader, args.epochs, writer=writer)
+        trainer_.wait_checkpoint()
+        if args.count_syncs:
+            print(sync_counter)
         end_t = time.time()
         train_t = int((end_t - start_t)/60)  # to minutes
         print('Training Time : {} hours {} minutes'.format(int(train_t/60), (train_t % 60)))
-        trainer_.save_model(save_dir, log_name)
     
     else:
         print('Evaluation ----------------')
         model_to_load = args.modelpath
-        trainer_.model.load_state_dict(torch.load(model_to_load))
+        trainer_.model.load_state_dict(torch.load(model_to_load, map_location=get_device(args)))
         print('Trained model loaded successfully')
 
-    if args.evalset == 'all':
-        trainer_.compute_confusion_matix('train', train_loader.dataset.n_classes, train_loader, result_dir, log_name)
-        trainer_.compute_confusion_matix('test', test_loader.dataset.n_classes, test_loader, result_dir, log_name)
-
-    elif args.evalset == 'train':
-        trainer_.compute_confusion_matix('train', train_loader.dataset.n_classes, train_loader, result_dir, log_name)
+    # stacked replicas are saved and evaluated one by one, under the log name of their own configuration
+    if args.replicas > 1:
+        runs = [(trainer_.model.replica(k), make_log_name(replica_args))
+                for k, replica_args in enumerate(get_replica_args(args))]
     else:
-        trainer_.compute_confusion_matix('test', test_loader.dataset.n_classes, test_loader, result_dir, log_name)
+        runs = [(trainer_.model, log_name)]
+    trained_model = trainer_.model
+    for run_model, run_name in runs:
+        trainer_.model = run_model
+        if args.mode == 'train':
+            trainer_.save_model(save_dir, run_name)
+
+        if args.evalset == 'all':
+            trainer_.compute_confusion_matix('train', train_loader.dataset.n_classes, train_loader, result_dir, run_name)
+            trainer_.compute_confusion_matix('test', test_loader.dataset.n_classes, test_loader, result_dir, run_name)
+
+        elif args.evalset == 'train':
+            trainer_.compute_confusion_matix('train', train_loader.dataset.n_classes, train_loader, result_dir, run_name)
+        else:
+            trainer_.compute_confusion_matix('test', test_loader.dataset.n_classes, test_loader, result_dir, run_name)
+    trainer_.model = trained_model
     if writer is not None:
         writer.close()
     print('Done!')
+    return trainer_, test_loader, log_name
 
 
 if __name__ == '__main__':
-    main()
+    main(get_args())
     
     
 
@@ -54,6 +54,64 @@ class MLP(nn.Module):
         self.head = nn.Linear(h_dim, n_classes)
     
 
+class StackedMLP(nn.Module):
+    """K independent MLP replicas whose layers are stacked along a leading dimension.
+
+    One forward pass evaluates every replica on the same batch with a single
+    matmul/bmm per layer and returns (K, batch, n_classes) logits. Since the
+    losses of the replicas are summed, every replica gets its own gradients.
+
+    Replica 0 is drawn from the global rng exactly like a single MLP, so the rng
+    state that the data order is drawn from afterwards is that of a single run;
+    the caller seeds the global rng with seeds[0]. Replica k > 0 is initialized
+    like MLP under torch.manual_seed(seeds[k]), without touching the global rng.
+    """
+    def __init__(self, feature_size, hidden_dim, n_classes=None, n_layer=3, seeds=(0,)):
+        super(StackedMLP, self).__init__()
+        self.mlp_kwargs = dict(feature_size=feature_size, hidden_dim=hidden_dim, n_classes=n_classes, n_layer=n_layer)
+        self.n_replicas = len(seeds)
+
+        replicas = [MLP(**self.mlp_kwargs)]
+        for seed in seeds[1:]:
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(seed)
+                replicas.append(MLP(**self.mlp_kwargs))
+        layers = [[m for m in replica.modules() if isinstance(m, nn.Linear)] for replica in replicas]
+        self.weights = nn.ParameterList([nn.Parameter(torch.stack([l[i].weight.data for l in layers]))
+                                         for i in range(len(layers[0]))])
+        self.biases = nn.ParameterList([nn.Parameter(torch.stack([l[i].bias.data for l in layers]))
+                                        for i in range(len(layers[0]))])
+
+    def forward(self, feature, get_inter=False):
+        feature = torch.flatten(feature, 1)
+        n_layers = len(self.weights)
+
+        # the input is shared, so the first layer of all replicas is one (batch, K * out) matmul
+        w, b = self.weights[0], self.biases[0]
+        h = F.linear(feature, w.flatten(0, 1), b.flatten()).view(len(feature), self.n_replicas, -1).transpose(0, 1)
+        inter = feature.expand(self.n_replicas, -1, -1) if n_layers == 1 else None
+        for i in range(1, n_layers):
+            h = F.relu(h)
+            if i == n_layers - 1:
+                inter = h
+            h = torch.baddbmm(self.biases[i].unsqueeze(1), h, self.weights[i].transpose(1, 2))
+
+        if get_inter:
+            return inter, h
+        else:
+            return h
+
+    def replica(self, k):
+        # replica k as a plain MLP, e.g. to save or evaluate it on its own
+        model = MLP(**self.mlp_kwargs).to(self.weights[0].device)
+        layers = [m for m in model.modules() if isinstance(m, nn.Linear)]
+        with torch.no_grad():
+            for layer, w, b in zip(layers, self.weights, self.biases):
+                layer.weight.copy_(w[k])
+                layer.bias.copy_(b[k])
+        return model
+
+
 class ReverseLayerF(Function):
 
     @staticmethod
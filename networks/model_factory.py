@@ -1,7 +1,7 @@
 import torch.nn as nn
 
 from networks.resnet import resnet10, resnet12,resnet18, resnet34, resnet50, resnet101
-from networks.mlp import MLP
+from networks.mlp import MLP, StackedMLP
 from networks.cifar_net import Net
 
 class ModelFactory():
@@ -9,7 +9,14 @@ class ModelFactory():
         pass
 
     @staticmethod
-    def get_model(target_model, n_classes=2, img_size=224, pretrained=False, n_groups=2):
+    def get_model(target_model, n_classes=2, img_size=224, pretrained=False, n_groups=2, replica_seeds=None):
+
+        if replica_seeds is not None:
+            if target_model not in ['mlp', 'lr']:
+                raise NotImplementedError
+            n_layer = 3 if target_model == 'mlp' else 1
+            return StackedMLP(feature_size=img_size, hidden_dim=64, n_classes=n_classes, n_layer=n_layer,
+                              seeds=replica_seeds)
 
         if target_model == 'mlp': 
             return MLP(feature_size=img_size, hidden_dim=64, n_classes=n_classes)
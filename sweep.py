@@ -0,0 +1,180 @@
+import os
+import csv
+import copy
+import time
+import queue as queue_
+import argparse
+import itertools
+import multiprocessing as mp
+
+import torch
+import data_handler
+from arguments import get_args, get_replica_args
+from utils import make_log_name
+from main import main
+
+# datasets loaded by the parent before the workers are forked; the workers only read them,
+# so the numpy/tensor buffers stay shared copy-on-write instead of being re-parsed per config
+_DATASETS = {}
+
+# the arguments that change what DataloaderFactory.get_datasets builds
+_DATASET_KEYS = ('dataset', 'target', 'add_attr', 'batch_size', 'uc', 'method', 'img_cache', 'token_cache')
+
+
+def get_sweep_args():
+    parser = argparse.ArgumentParser(description='Sweep over main.py configurations', add_help=False)
+    parser.add_argument('--sweep', nargs='+', default=[], metavar='KEY=V1,V2',
+                        help='argument to sweep over (attribute name as in args, e.g. rho=0.1,0.3 seed=0,1,2)')
+    parser.add_argument('--sweep-workers', default=1, type=int, help='the number of configurations run in parallel')
+    parser.add_argument('--sweep-out', default='./results/sweep.csv', help='consolidated result table')
+    sweep_args, rest = parser.parse_known_args()
+    return sweep_args, get_args(rest)
+
+
+def make_configs(args, sweep):
+    grid = []
+    for item in sweep:
+        key, values = item.split('=', 1)
+        key = key.replace('-', '_')
+        if not hasattr(args, key):
+            raise Exception('Unknown sweep argument {}'.format(key))
+        if args.replicas > 1 and key in ['seed', 'rho', 'gamma']:
+            # the per-replica values were already filled in from the defaults by get_args
+            raise Exception('Set --replica-{} instead of sweeping {} with --replicas'.format(key.replace('seed', 'seeds'), key))
+        default = getattr(args, key)
+        cast = type(default) if default is not None and not isinstance(default, bool) else str
+        grid.append([(key, cast(v)) for v in values.split(',')])
+
+    configs = []
+    for overrides in itertools.product(*grid):
+        config = copy.deepcopy(args)
+        for key, value in overrides:
+            setattr(config, key, value)
+        configs.append((config, dict(overrides)))
+    return configs
+
+
+def dataset_key(args):
+    return tuple(getattr(args, key) for key in _DATASET_KEYS)
+
+
+def load_datasets(configs):
+    for args, _ in configs:
+        key = dataset_key(args)
+        if key not in _DATASETS:
+            _DATASETS[key] = data_handler.DataloaderFactory.get_datasets(args.dataset, batch_size=args.batch_size,
+                                                                         seed=args.seed, target_attr=args.target,
+                                                                         add_attr=args.add_attr, args=args)
+
+
+def run_config(i, args, overrides, queue):
+    rows = [dict(overrides)]
+    try:
+        start_t = time.time()
+        trainer_, test_loader, log_name = main(args, datasets=_DATASETS[dataset_key(args)])
+        loss, acc, dcaM, dcaA, _, _ = trainer_.evaluate(trainer_.model, test_loader, trainer_.criterion)
+        minutes = (time.time() - start_t) / 60
+        if args.replicas > 1:
+            # one row per replica of a --replicas run
+            rows = []
+            for k, replica_args in enumerate(get_replica_args(args)):
+                rows.append(dict(overrides, replica=k, seed=replica_args.seed, rho=replica_args.rho,
+                                 gamma=replica_args.gamma, log_name=make_log_name(replica_args),
+                                 test_loss=float(loss[k]), test_acc=float(acc[k]),
+                                 test_dcam=dcaM[k], test_dcaa=dcaA[k], minutes=minutes))
+        else:
+            rows[0].update({'log_name': log_name, 'test_loss': float(loss), 'test_acc': float(acc),
+                            'test_dcam': dcaM, 'test_dcaa': dcaA, 'minutes': minutes})
+    except Exception as e:
+        rows[0]['error'] = repr(e)
+    queue.put((i, rows))
+
+
+def wait_results(queue, running, configs, poll=5):
+    """
+    Waits up to poll seconds for finished configurations and returns their (i, rows).
+
+    A worker that dies without posting its rows (killed for memory, segfault, CUDA abort)
+    gets a failed row instead of hanging the sweep.
+    """
+    try:
+        return [queue.get(timeout=poll)]
+    except queue_.Empty:
+        pass
+    dead = [i for i, process in running.items() if process.exitcode is not None]
+    if not dead:
+        return []
+    # a worker that exited normally has flushed its rows to the queue before exiting
+    results = []
+    while True:
+        try:
+            results.append(queue.get(timeout=1))
+        except queue_.Empty:
+            break
+    posted = set(i for i, _ in results)
+    for i in dead:
+        if i not in posted:
+            results.append((i, [dict(configs[i][1], error='worker exited with code {}'.format(running[i].exitcode))]))
+    return results
+
+
+def sweep():
+    sweep_args, args = get_sweep_args()
+    configs = make_configs(args, sweep_args.sweep)
+    n_workers = max(1, min(sweep_args.sweep_workers, len(configs)))
+    print('# of configurations : {}, # of workers : {}'.format(len(configs), n_workers))
+
+    load_datasets(configs)
+
+    n_gpus = torch.cuda.device_count() if args.cuda else 0
+    if not args.cuda and args.num_threads is None:
+        # split the cores between the workers instead of oversubscribing them
+        n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+    for i, (config, _) in enumerate(configs):
+        if n_gpus > 0:
+            config.device = config.t_device = i % n_gpus
+        elif config.num_threads is None:
+            config.num_threads = n_threads
+
+    # fork shares the loaded datasets; the workers are not daemonic, so they can still start dataloader workers
+    ctx = mp.get_context('fork')
+    queue = ctx.Queue()
+    pending = list(range(len(configs)))
+    running = {}
+    fieldnames = None
+    rows = []
+
+    os.makedirs(os.path.dirname(os.path.abspath(sweep_args.sweep_out)), exist_ok=True)
+    with open(sweep_args.sweep_out, 'w', newline='') as f:
+        while pending or running:
+            while pending and len(running) < n_workers:
+                i = pending.pop(0)
+                config, overrides = configs[i]
+                process = ctx.Process(target=run_config, args=(i, config, overrides, queue))
+                process.start()
+                running[i] = process
+
+            for i, new_rows in wait_results(queue, running, configs):
+                running.pop(i).join()
+                for row in new_rows:
+                    print('[{}/{}] {}'.format(len(configs) - len(pending) - len(running), len(configs), row))
+
+                # the rows of a configuration are written as soon as it finishes
+                rows.extend(new_rows)
+                new_keys = [key for row in new_rows for key in row]
+                if fieldnames is None or not set(new_keys) <= set(fieldnames):
+                    fieldnames = list(dict.fromkeys((fieldnames or []) + new_keys))
+                    f.seek(0)
+                    f.truncate()
+                    writer = csv.DictWriter(f, fieldnames=fieldnames)
+                    writer.writeheader()
+                    writer.writerows(rows)
+                else:
+                    writer.writerows(new_rows)
+                f.flush()
+
+    print('Sweep results saved to {}'.format(sweep_args.sweep_out))
+
+
+if __name__ == '__main__':
+    sweep()
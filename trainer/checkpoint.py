@@ -0,0 +1,87 @@
+import os
+import copy
+import random
+import threading
+import numpy as np
+import torch
+
+
+def get_rng_state(cuda=False):
+    state = {'torch': torch.get_rng_state(),
+             'numpy': np.random.get_state(),
+             'random': random.getstate()}
+    if cuda:
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    # a checkpoint loaded with map_location may carry the rng states on the device
+    torch.set_rng_state(state['torch'].cpu())
+    np.random.set_state(state['numpy'])
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([s.cpu() for s in state['cuda']])
+
+
+def cpu_snapshot(obj, memo=None):
+    """
+    A copy of a checkpoint state with every tensor copied to the host, so that
+    the snapshot handed to CheckpointWriter holds no second copy of the model
+    and optimizer state on the device. Containers and objects holding tensors
+    (e.g. SubgroupLossTracker) are copied shallowly and filled with the copies;
+    anything else is deep-copied. Objects shared within the state stay shared.
+    """
+    memo = {} if memo is None else memo
+    if id(obj) in memo:
+        return memo[id(obj)]
+    if isinstance(obj, torch.Tensor):
+        out = obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        out = copy.copy(obj) # keeps OrderedDict / defaultdict
+        memo[id(obj)] = out
+        for key, value in obj.items():
+            out[key] = cpu_snapshot(value, memo)
+    elif type(obj) in (list, tuple):
+        out = type(obj)(cpu_snapshot(value, memo) for value in obj)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        out = copy.copy(obj)
+        memo[id(obj)] = out
+        out.__dict__.update(cpu_snapshot(out.__dict__, memo))
+    else:
+        out = copy.deepcopy(obj)
+    memo[id(obj)] = out
+    return out
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints from a background thread, so that training goes on while
+    the file is serialized. The state handed to write() must already be a copy.
+    A file is written to <path>.tmp and renamed, so the checkpoint on disk is
+    always complete; at most one write is in flight.
+    """
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def _write(self, path, state):
+        try:
+            tmp_path = path + '.tmp'
+            torch.save(state, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            self.error = e
+
+    def write(self, path, state):
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(path, state))
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
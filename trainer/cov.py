@@ -1,7 +1,7 @@
 from __future__ import print_function
 from collections import defaultdict
 import time
-from utils import get_accuracy
+from utils import get_accuracy, subgroup_mean
 import trainer
 import torch
 import torch.nn as nn
@@ -23,7 +23,10 @@ class Trainer(trainer.GenericTrainer):
         model = self.model
         model.train()
             
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
             self._train_epoch(epoch, train_loader, model, criterion)
             
             eval_start_time = time.time()
@@ -42,11 +45,7 @@ class Trainer(trainer.GenericTrainer):
                    eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
 
             if self.record:
-                _, _, _, _, train_subgroup_acc, train_subgroup_loss=self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                              train=True, 
-                              record=self.record,
-                              writer=writer
-                             )
+                _, _, _, _, train_subgroup_acc, train_subgroup_loss=self.record_train(train_loader, epoch, writer)
                 cov = self.calculate_covariance(self.model, train_loader)
                 n_classes = train_loader.dataset.n_classes
                 covs = {}
@@ -58,6 +57,8 @@ class Trainer(trainer.GenericTrainer):
                 self.scheduler.step(eval_loss)
             else:
                 self.scheduler.step()
+
+            self.save_checkpoint(train_loader, epoch)
         print('Training Finished!')        
 
     def calculate_covariance(self, model, train_loader):
@@ -70,10 +71,9 @@ class Trainer(trainer.GenericTrainer):
         for i, data in enumerate(train_loader):
             inputs, _, groups, targets, idx = data
             labels = targets
-            if self.cuda:
-                inputs = inputs.cuda(device=self.device)
-                labels = labels.cuda(device=self.device)
-                groups = groups.cuda(device=self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
 
             def closure_FPR(inputs, groups, labels, model):
                 groups_onehot = torch.nn.functional.one_hot(groups.long(), num_classes=n_groups)
@@ -108,6 +108,7 @@ class Trainer(trainer.GenericTrainer):
 
     def _train_epoch(self, epoch, train_loader, model, criterion=None):
         model.train()
+        self.start_train_record(train_loader)
         
         n_classes = train_loader.dataset.n_classes
         n_groups = train_loader.dataset.n_groups
@@ -122,32 +123,30 @@ class Trainer(trainer.GenericTrainer):
         
             inputs, _, groups, targets, idx = data
             labels = targets
-            if self.cuda:
-                inputs = inputs.cuda(device=self.device)
-                labels = labels.cuda(device=self.device)
-                groups = groups.cuda(device=self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
                 
             def closure():
-                if self.data == 'jigsaw':
-                    input_ids = inputs[:, :, 0]
-                    input_masks = inputs[:, :, 1]
-                    segment_ids = inputs[:, :, 2]
-                    outputs = model(
-                        input_ids=input_ids,
-                        attention_mask=input_masks,
-                        token_type_ids=segment_ids,
-                        labels=labels,
-                    )[1] 
-                else:
-                    outputs = model(inputs)
+                with self.autocast():
+                    if self.data == 'jigsaw':
+                        input_ids = inputs[:, :, 0]
+                        input_masks = inputs[:, :, 1]
+                        segment_ids = inputs[:, :, 2]
+                        outputs = model(
+                            input_ids=input_ids,
+                            attention_mask=input_masks,
+                            token_type_ids=segment_ids,
+                            labels=labels,
+                        )[1] 
+                    else:
+                        outputs = model(inputs)
+                outputs = outputs.float()
                     
                 if self.balanced:
                     subgroups = groups * n_classes + labels
-                    group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                    group_count = group_map.sum(1)
-                    group_denom = group_count + (group_count==0).float() # avoid nans
                     loss = nn.CrossEntropyLoss(reduction='none')(outputs, labels)
-                    group_loss = (group_map @ loss.view(-1))/group_denom
+                    group_loss = subgroup_mean(loss, subgroups, n_subgroups)
                     loss = torch.mean(group_loss)
                 else:
                     if criterion is not None:
@@ -160,18 +159,20 @@ class Trainer(trainer.GenericTrainer):
                 def closure_FPR(inputs, groups, labels, model):
                     groups_onehot = torch.nn.functional.one_hot(groups.long(), num_classes=n_groups)
                     groups_onehot = groups_onehot.float() # n by g
-                    if self.data == 'jigsaw':
-                        input_ids = inputs[:, :, 0]
-                        input_masks = inputs[:, :, 1]
-                        segment_ids = inputs[:, :, 2]
-                        outputs = model(
-                            input_ids=input_ids,
-                            attention_mask=input_masks,
-                            token_type_ids=segment_ids,
-                            labels=labels,
-                        )[1]
-                    else:
-                        outputs = model(inputs) # n by 2
+                    with self.autocast():
+                        if self.data == 'jigsaw':
+                            input_ids = inputs[:, :, 0]
+                            input_masks = inputs[:, :, 1]
+                            segment_ids = inputs[:, :, 2]
+                            outputs = model(
+                                input_ids=input_ids,
+                                attention_mask=input_masks,
+                                token_type_ids=segment_ids,
+                                labels=labels,
+                            )[1]
+                        else:
+                            outputs = model(inputs) # n by 2
+                    outputs = outputs.float()
 
                     d_theta = torch.diff(outputs, dim=1) # w1Tx - w0Tx + b1-b0  # n by 1
                     d_theta_new = -(labels.view(-1,1)-1)*(2*labels.view(-1,1)-1)*d_theta
@@ -184,18 +185,20 @@ class Trainer(trainer.GenericTrainer):
                 def closure_FNR(inputs, groups, labels, model):
                     groups_onehot = torch.nn.functional.one_hot(groups.long(), num_classes=n_groups)
                     groups_onehot = groups_onehot.float() # n by g
-                    if self.data == 'jigsaw':
-                        input_ids = inputs[:, :, 0]
-                        input_masks = inputs[:, :, 1]
-                        segment_ids = inputs[:, :, 2]
-                        outputs = model(
-                            input_ids=input_ids,
-                            attention_mask=input_masks,
-                            token_type_ids=segment_ids,
-                            labels=labels,
-                        )[1]
-                    else:
-                        outputs = model(inputs) # n by 2
+                    with self.autocast():
+                        if self.data == 'jigsaw':
+                            input_ids = inputs[:, :, 0]
+                            input_masks = inputs[:, :, 1]
+                            segment_ids = inputs[:, :, 2]
+                            outputs = model(
+                                input_ids=input_ids,
+                                attention_mask=input_masks,
+                                token_type_ids=segment_ids,
+                                labels=labels,
+                            )[1]
+                        else:
+                            outputs = model(inputs) # n by 2
+                    outputs = outputs.float()
                     d_theta = torch.diff(outputs, dim=1) # w1Tx - w0Tx + b1-b0  # n by 1
                     d_theta_new = (labels.view(-1,1))*(2*labels.view(-1,1)-1)*d_theta
                     g_theta = torch.minimum(d_theta_new, torch.tensor(0)) # n by 1
@@ -208,18 +211,20 @@ class Trainer(trainer.GenericTrainer):
                 def closure_OMR(inputs, groups, labels, model):
                     groups_onehot = torch.nn.functional.one_hot(groups.long(), num_classes=n_groups)
                     groups_onehot = groups_onehot.float() # n by g
-                    if self.data == 'jigsaw':
-                        input_ids = inputs[:, :, 0]
-                        input_masks = inputs[:, :, 1]
-                        segment_ids = inputs[:, :, 2]
-                        outputs = model(
-                            input_ids=input_ids,
-                            attention_mask=input_masks,
-                            token_type_ids=segment_ids,
-                            labels=labels,
-                        )[1]
-                    else:
-                        outputs = model(inputs) # n by 2
+                    with self.autocast():
+                        if self.data == 'jigsaw':
+                            input_ids = inputs[:, :, 0]
+                            input_masks = inputs[:, :, 1]
+                            segment_ids = inputs[:, :, 2]
+                            outputs = model(
+                                input_ids=input_ids,
+                                attention_mask=input_masks,
+                                token_type_ids=segment_ids,
+                                labels=labels,
+                            )[1]
+                        else:
+                            outputs = model(inputs) # n by 2
+                    outputs = outputs.float()
                     d_theta = torch.diff(outputs, dim=1) # w1Tx - w0Tx + b1-b0  # n by 1
                     d_theta_new = (2*labels.view(-1,1)-1)*d_theta # y*d_theta
                     g_theta = torch.minimum(d_theta_new, torch.tensor(0)) # n by 1
@@ -237,14 +242,12 @@ class Trainer(trainer.GenericTrainer):
             elif self.fairness_criterion == 'ap':
                 loss += self.lamb*closure_OMR(inputs, groups, labels, model)
             
-            loss.backward()
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
                 
-            running_loss += loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += loss.detach()
+            self.track_train(outputs, labels, groups)
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
             
             if i % self.term == self.term-1: # print every self.term mini-batches
                 avg_batch_time = time.time()-batch_start_time
@@ -1,7 +1,7 @@
 from __future__ import print_function
 from collections import defaultdict
 import time
-from utils import get_accuracy
+from utils import get_accuracy, subgroup_mean, subgroup_stats
 import trainer
 import torch
 import torch.nn as nn
@@ -18,7 +18,10 @@ class Trainer(trainer.GenericTrainer):
         model = self.model
         model.train()
             
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
             self._train_epoch(epoch, train_loader, model, criterion)
             
             eval_start_time = time.time()
@@ -37,11 +40,7 @@ class Trainer(trainer.GenericTrainer):
                    eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
 
             if self.record:
-                self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                              train=True, 
-                              record=self.record,
-                              writer=writer
-                             )
+                self.record_train(train_loader, epoch, writer)
                 n_classes = train_loader.dataset.n_classes
                 reg = self._calculate_reg(self.model, train_loader)
                 regs = {}
@@ -53,6 +52,8 @@ class Trainer(trainer.GenericTrainer):
                 self.scheduler.step(eval_loss)
             else:
                 self.scheduler.step()
+
+            self.save_checkpoint(train_loader, epoch)
         print('Training Finished!')        
 
     def _calculate_reg(self, model, train_loader):
@@ -61,28 +62,25 @@ class Trainer(trainer.GenericTrainer):
         n_groups = train_loader.dataset.n_groups
         n_subgroups = n_classes * n_groups
 
-        group_total_denom = torch.zeros((n_groups, n_classes)).cuda()
-        group_total_loss = torch.zeros((n_groups, n_classes)).cuda()
+        group_total_denom = torch.zeros((n_groups, n_classes)).to(self.device)
+        group_total_loss = torch.zeros((n_groups, n_classes)).to(self.device)
         for i, data in enumerate(train_loader):
             # Get the inputs
             inputs, _, groups, targets, idx = data
             labels = targets
-            if self.cuda:
-                inputs = inputs.cuda(device=self.device)
-                labels = labels.cuda(device=self.device)
-                groups = groups.cuda(device=self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
 
             with torch.no_grad():
                 outputs = model(inputs)
                 loss = nn.CrossEntropyLoss(reduction='none')(outputs, labels)
 
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_loss = (group_map @ loss.view(-1))
+                group_count, group_loss, _ = subgroup_stats(loss, subgroups, n_subgroups)
                 group_loss_matrix = group_loss.reshape(n_groups, n_classes)
                 group_total_loss += group_loss_matrix
 
-                group_count = group_map.sum(1)
                 group_denom = group_count + (group_count==0).float() # avoid nans
                 group_denom = group_denom.reshape(n_groups, n_classes)
                 group_total_denom += group_denom
@@ -94,6 +92,7 @@ class Trainer(trainer.GenericTrainer):
 
     def _train_epoch(self, epoch, train_loader, model, criterion=None):
         model.train()
+        self.start_train_record(train_loader)
         
         running_acc = 0.0
         running_loss = 0.0
@@ -109,31 +108,29 @@ class Trainer(trainer.GenericTrainer):
         
             inputs, _, groups, targets, idx = data
             labels = targets
-            if self.cuda:
-                inputs = inputs.cuda(device=self.device)
-                labels = labels.cuda(device=self.device)
-                groups = groups.cuda(device=self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
                 
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                )[1] 
-            else:
-                outputs = model(inputs)
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                    )[1] 
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
 
             if self.balanced:
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_count = group_map.sum(1)
-                group_denom = group_count + (group_count==0).float() # avoid nans
                 loss = nn.CrossEntropyLoss(reduction='none')(outputs, labels)
-                group_loss = (group_map @ loss.view(-1))/group_denom
+                group_loss = subgroup_mean(loss, subgroups, n_subgroups)
                 loss = torch.mean(group_loss)
             else:
                 if criterion is not None:
@@ -150,15 +147,12 @@ class Trainer(trainer.GenericTrainer):
                 
                 loss += self.lamb*closure_DCA(group_loss)
             
-            loss.backward()
-
-            if self.data == 'jigsaw':            
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
                 
-            running_loss += loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += loss.detach()
+            self.track_train(outputs, labels, groups)
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
             
             if i % self.term == self.term-1: # print every self.term mini-batches
                 avg_batch_time = time.time()-batch_start_time
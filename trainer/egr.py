@@ -9,11 +9,15 @@ from torch.optim.lr_scheduler import MultiStepLR, ReduceLROnPlateau, CosineAnnea
 from utils import get_accuracy
 from collections import defaultdict
 import trainer
+from trainer.fairness_stats import confusion_tensor, accuracy, subgroup_accuracy, mean_predictions
+from trainer.ensemble_store import EnsembleStore
 import pickle
-from torch.utils.data import DataLoader
+from data_handler.dataloader_factory import DataloaderFactory
 import copy
 
 class Trainer(trainer.GenericTrainer):
+    checkpoint_attrs = ('theta', 'multiplier', 'multiplier_set', 'model_set', 'best_value', 'weight_update_count')
+
     def __init__(self, args, **kwargs):
         super().__init__(args=args, **kwargs)
         self.eta = args.eta #learning rate for theta
@@ -24,6 +28,7 @@ class Trainer(trainer.GenericTrainer):
         self.constraint_c = args.constraint_c # vector
         self.weight_decay = args.weight_decay #
         self.weight_update_term = 600 #For computation #100 
+        self.ensemble_format = args.egr_ensemble
         
     def train(self, train_loader, test_loader, epochs, dummy_loader=None, writer=None):
         log_set = defaultdict(list)
@@ -52,37 +57,48 @@ class Trainer(trainer.GenericTrainer):
 
         S_Y_set, Y_set, S_set, self.P_S_Y_mat, self.P_Y, self.P_S = self.get_statistics(train_loader.dataset, bs=self.bs, n_workers=self.n_workers)
         
-        if self.cuda:
-            self.theta = self.theta.cuda()
-            self.M_matrix = self.M_matrix.cuda()
-            self.multiplier = self.multiplier.cuda()
-            self.P_S_Y_mat = self.P_S_Y_mat.cuda()
-            self.P_Y = self.P_Y.cuda()
-            self.P_S = self.P_S.cuda()
+        self.theta = self.theta.to(self.device)
+        self.M_matrix = self.M_matrix.to(self.device)
+        self.multiplier = self.multiplier.to(self.device)
+        self.P_S_Y_mat = self.P_S_Y_mat.to(self.device)
+        self.P_Y = self.P_Y.to(self.device)
+        self.P_S = self.P_S.to(self.device)
         
         if self.data != 'jigsaw':
             backup_model = copy.deepcopy(self.model)
+            # the best responses of the iterations, the members of the randomized classifier
+            self.model_set = EnsembleStore(os.path.join(self.save_dir, self.log_name + '_egr_ensemble'),
+                                           backup_model.state_dict(), format=self.ensemble_format)
+            if self.can_resume():
+                # the checkpointed model and optimizer are those created by reset_model
+                self.reset_model(backup_model)
         
         print('eta_learning_rate : ', self.eta)
         n_iters = self.iteration
         print('n_iters : ', n_iters)
         
+        # the positions are (iter_, epoch), the last cost sensitive learning is iteration n_iters
+        self.resume(train_loader)
         for iter_ in range(n_iters):
-            # for numerical stability
-            self.multiplier = self.bound_B * (torch.exp(self.theta-torch.max(self.theta))/(torch.exp(-torch.max(self.theta))+torch.sum(torch.exp(self.theta-torch.max(self.theta))))) 
-            self.multiplier_set.append(self.multiplier)
-            print('self.multiplier', self.multiplier)
+            if not self.finished(iter_, -1):
+                # for numerical stability
+                self.multiplier = self.bound_B * (torch.exp(self.theta-torch.max(self.theta))/(torch.exp(-torch.max(self.theta))+torch.sum(torch.exp(self.theta-torch.max(self.theta))))) 
+                self.multiplier_set.append(self.multiplier)
+                print('self.multiplier', self.multiplier)
             
             start_t = time.time()
             
-            if self.data != 'jigsaw':
+            if self.data != 'jigsaw' and not self.finished(iter_, -1):
                 self.reset_model(backup_model)
             
             if self.data == 'jigsaw':
                 assert n_iters == 1                
-                self.weight_update_count = 0
+                if not self.finished(iter_, -1):
+                    self.weight_update_count = 0
 
             for epoch in range(epochs):
+                if self.finished(iter_, epoch):
+                    continue
                 lb_idx = self._train_epoch(epoch, train_loader, self.model)
                 
                 eval_start_time = time.time()                
@@ -102,25 +118,22 @@ class Trainer(trainer.GenericTrainer):
                        eval_loss, eval_acc, eval_deom, (eval_end_time - eval_start_time)))
 
                 if self.record:
-                    self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                                  train=True, 
-                                  record=self.record,
-                                  writer=writer
-                                 )
+                    self.record_train(train_loader, epoch, writer)
 
                 if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
                     self.scheduler.step(eval_loss)
                 else:
                     self.scheduler.step()
+
+                self.save_checkpoint(train_loader, iter_, epoch)
                     
             end_t = time.time()
             train_t = int((end_t - start_t) / 60)
             print('Training Time : {} hours {} minutes / iter : {}/{}'.format(int(train_t / 60), (train_t % 60),
                                                                               (iter_ + 1), n_iters))
             
-            if self.data != 'jigsaw':
-                model_=copy.deepcopy(self.model)
-                self.model_set.append(model_)
+            if self.data != 'jigsaw' and not self.finished(iter_, epochs):
+                self.model_set.append(self.model.state_dict())
                 
                 # get statistics & calculate violation
                 mu_, acc_ = self.get_mu(train_loader.dataset, bs=self.bs, n_workers=self.n_workers, model=self.model)
@@ -129,13 +142,16 @@ class Trainer(trainer.GenericTrainer):
     
         ##################### last cost sensitive learning  ##############################
         if self.data != 'jigsaw':
-            # Get multiplier_avg
-            multiplier_set_matrix = torch.stack(self.multiplier_set)
-            multiplier_avg = torch.mean(multiplier_set_matrix, dim=0)
-            self.multiplier = multiplier_avg
-            self.reset_model(backup_model)
+            if not self.finished(n_iters, -1):
+                # Get multiplier_avg
+                multiplier_set_matrix = torch.stack(self.multiplier_set)
+                multiplier_avg = torch.mean(multiplier_set_matrix, dim=0)
+                self.multiplier = multiplier_avg
+                self.reset_model(backup_model)
             
             for epoch in range(epochs):
+                if self.finished(n_iters, epoch):
+                    continue
                 lb_idx = self._train_epoch(epoch, train_loader, self.model)
 
                 eval_start_time = time.time()                
@@ -152,28 +168,33 @@ class Trainer(trainer.GenericTrainer):
                 print('[{}/{}] Method: {} '
                       'Test Loss: {:.3f} Test Acc: {:.2f} Test DCAM {:.2f} [{:.2f} s]'.format
                       (epoch + 1, epochs, self.method,
-                       eval_loss, eval_acc, eval_deom, (eval_end_time - eval_start_time)))
+                       eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
 
                 if self.record:
-                    self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                                  train=True, 
-                                  record=self.record,
-                                  writer=writer
-                                 )
+                    self.record_train(train_loader, epoch, writer)
 
                 if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
                     self.scheduler.step(eval_loss)
                 else:
                     self.scheduler.step()
 
+                self.save_checkpoint(train_loader, n_iters, epoch)
+
             end_t = time.time()
             train_t = int((end_t - start_t) / 60)
             print('Training Time : {} hours {} minutes / iter : {}/{}'.format(int(train_t / 60), (train_t % 60),
                                                                               (iter_ + 1), n_iters))
+
+            if len(self.model_set) > 0:
+                ens_acc, ens_dcam, ens_dcaa = self.evaluate_ensemble(test_loader.dataset, bs=self.bs,
+                                                                     n_workers=self.n_workers)
+                print('Method: {} Ensemble of {} iterations: Test Acc: {:.2f} Test DCAM {:.2f} Test DCAA {:.2f}'.format
+                      (self.method, len(self.model_set), ens_acc, ens_dcam, ens_dcaa))
         ##########################################################################################
 
     def _train_epoch(self, epoch, train_loader, model):
         model.train()
+        self.start_train_record(train_loader)
 
         running_loss = 0.0
         running_acc = 0.0
@@ -203,10 +224,9 @@ class Trainer(trainer.GenericTrainer):
             groups = groups.long()
             labels = labels.long()
 
-            if self.cuda:
-                inputs = inputs.cuda()
-                labels = labels.cuda()
-                groups = groups.cuda()
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
             
             if self.fairness_criterion == 'eo' or self.fairness_criterion == 'dca':
                 if not self.balanced:
@@ -230,18 +250,20 @@ class Trainer(trainer.GenericTrainer):
             relabels = (C_0>C_1).long()
             
             def closure():
-                if self.data == 'jigsaw':
-                    input_ids = inputs[:, :, 0]
-                    input_masks = inputs[:, :, 1]
-                    segment_ids = inputs[:, :, 2]
-                    outputs = model(
-                        input_ids=input_ids,
-                        attention_mask=input_masks,
-                        token_type_ids=segment_ids,
-                        labels=labels,
-                    )[1] 
-                else:
-                    outputs = model(inputs)
+                with self.autocast():
+                    if self.data == 'jigsaw':
+                        input_ids = inputs[:, :, 0]
+                        input_masks = inputs[:, :, 1]
+                        segment_ids = inputs[:, :, 2]
+                        outputs = model(
+                            input_ids=input_ids,
+                            attention_mask=input_masks,
+                            token_type_ids=segment_ids,
+                            labels=labels,
+                        )[1] 
+                    else:
+                        outputs = model(inputs)
+                outputs = outputs.float()
                     
                 loss = torch.mean(reweights * nn.CrossEntropyLoss(reduction='none')(outputs, relabels))
                     
@@ -249,10 +271,7 @@ class Trainer(trainer.GenericTrainer):
 
             outputs, loss = closure()
             
-            loss.backward()
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
             
             if self.data == 'jigsaw':
@@ -295,10 +314,11 @@ class Trainer(trainer.GenericTrainer):
 #                         best_model = copy.deepcopy(model)
 
 
-            running_loss += loss.item()
+            self.track_train(outputs, labels, groups)
+            running_loss += loss.detach()
             # binary = True if n_classes == 2 else False
             # running_acc += get_accuracy(outputs, labels, binary=binary)
-            running_acc += get_accuracy(outputs, labels)
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
 
             batch_end_time = time.time()
             avg_batch_time += batch_end_time - batch_start_time
@@ -339,36 +359,26 @@ class Trainer(trainer.GenericTrainer):
         M_matrix = torch.cat((matrix_cat, vector_cat.reshape(-1,1)), dim=1)
         return M_matrix.float()
 
-    def get_mu(self, dataset, bs=128, n_workers=2, model=None):
+    def get_predictions(self, dataset, bs=128, n_workers=2, model=None):
+        # predicted class, label and group of every sample of dataset, in eval mode
         model.eval()
-        
-        if self.fairness_criterion == 'eo' or self.fairness_criterion == 'dca':
-            mu = torch.zeros(self.n_groups * self.n_classes + 1)
-        elif self.fairness_criterion == 'ap':
-            mu = torch.zeros(self.n_groups+ 1)
 
-        dataloader = DataLoader(dataset, batch_size=bs, shuffle=False,
-                                num_workers=n_workers, pin_memory=True, drop_last=False)
+        dataloader = DataloaderFactory.get_loader(dataset, batch_size=bs, shuffle=False,
+                                                  num_workers=n_workers, pin_memory=True, drop_last=False)
 
         Y_pred_set = []
         Y_set = []
         S_set = []
-        S_Y_set = [] # subgroups = groups * n_classes + labels
-        total = 0
         with torch.no_grad():
             for i, data in enumerate(dataloader):
                 inputs, _, sen_attrs, targets, _ = data
                 Y_set.append(targets)
                 S_set.append(sen_attrs)
-                S_Y_set.append(sen_attrs * self.n_classes + targets)
 
-                if self.cuda:
-                    inputs = inputs.cuda()
-                    groups = sen_attrs.cuda()
-                    targets = targets.cuda()
+                inputs = inputs.to(self.device)
+                targets = targets.to(self.device)
 
-
-                if model != None:
+                with self.autocast():
                     if self.data == 'jigsaw':
                         input_ids = inputs[:, :, 0]
                         input_masks = inputs[:, :, 1]
@@ -381,32 +391,36 @@ class Trainer(trainer.GenericTrainer):
                         )[1] 
                     else:
                         outputs = model(inputs)
-                    # Y_pred_set.append(torch.argmax(outputs, dim=1) if n_classes >2 else (torch.sigmoid(outputs) >= 0.5).float())
-                    Y_pred_set.append(torch.argmax(outputs, dim=1))
-                total+= inputs.shape[0]
+                outputs = outputs.float()
+                Y_pred_set.append(torch.argmax(outputs, dim=1))
 
-        Y_set = torch.cat(Y_set).cuda()
-        S_set = torch.cat(S_set)
-        S_Y_set = torch.cat(S_Y_set).cuda()
-        Y_pred_set = torch.cat(Y_pred_set) if len(Y_pred_set) != 0 else torch.zeros(0)
+        model.train()
+        return torch.cat(Y_pred_set), torch.cat(Y_set).to(self.device), torch.cat(S_set).to(self.device)
 
-        acc = torch.sum(Y_pred_set==Y_set)/len(Y_set)
+    def get_mu(self, dataset, bs=128, n_workers=2, model=None):
+        Y_pred_set, Y_set, S_set = self.get_predictions(dataset, bs=bs, n_workers=n_workers, model=model)
 
-        mu[-1] = torch.mean(Y_pred_set.float())
-        if self.fairness_criterion == 'eo' or self.fairness_criterion == 'dca':
-            for i in range(len(mu)-1):
-                index_set = torch.where(S_Y_set==i)[0]
-                mu[i] = torch.mean(Y_pred_set.float()[index_set])
-        elif self.fairness_criterion == 'ap':
-            for i in range(len(mu)-1):
-                index_set = torch.where(S_set==i)[0]
-                mu[i] = torch.mean(Y_pred_set.float()[index_set])
-        if self.cuda:
-            mu = mu.cuda()
-            acc = acc.cuda()
-        
-        model.train()
+        # mu: the mean prediction of every subgroup (eo, dca) or group (ap), then of the whole set
+        confusion = confusion_tensor(Y_pred_set, Y_set, S_set, self.n_groups, self.n_classes)
+        acc = accuracy(confusion)
+        mu = mean_predictions(confusion, by='group' if self.fairness_criterion == 'ap' else 'subgroup')
         return mu.float(), acc.float()
+
+    def evaluate_ensemble(self, dataset, bs=128, n_workers=2):
+        # the randomized classifier predicts with a uniformly drawn member, so its expected confusion
+        # tensor is the mean of those of the members, which are streamed through one model in turn
+        model = copy.deepcopy(self.model)
+        confusion = 0
+        for k in range(len(self.model_set)):
+            self.model_set.load(k, model)
+            Y_pred_set, Y_set, S_set = self.get_predictions(dataset, bs=bs, n_workers=n_workers, model=model)
+            confusion = confusion + confusion_tensor(Y_pred_set, Y_set, S_set, self.n_groups, self.n_classes)
+        confusion = confusion / len(self.model_set)
+
+        acc = accuracy(confusion)
+        group_acc = subgroup_accuracy(confusion)
+        acc_gap = group_acc.max(0)[0] - group_acc.min(0)[0]
+        return acc.item(), acc_gap.max().item(), acc_gap.mean().item()
     
 
     def criterion(self, model, outputs, labels):
@@ -436,36 +450,12 @@ class Trainer(trainer.GenericTrainer):
     
     
     def get_statistics(self, dataset, bs=128, n_workers=2):
-
-        dataloader = DataLoader(dataset, batch_size=bs, shuffle=False,
-                                num_workers=n_workers, pin_memory=True, drop_last=False)
-
-        Y_set = []
-        S_set = []
-        S_Y_set = []
-        total = 0
-        with torch.no_grad():
-            for i, data in enumerate(dataloader):
-                inputs, _, sen_attrs, targets, _ = data
-                Y_set.append(targets)
-                S_set.append(sen_attrs)
-                S_Y_set.append(sen_attrs * self.n_classes + targets)
-
-                if self.cuda:
-                    inputs = inputs.cuda()
-                    groups = sen_attrs.cuda()
-                    targets = targets.cuda()
-                total+= inputs.shape[0]
-
-        Y_set = torch.cat(Y_set).long()
-        S_set = torch.cat(S_set).long()
-        S_Y_set = torch.cat(S_Y_set).long()
-        P_S_Y = torch.zeros(self.n_groups * self.n_classes)
-        for i in range(len(P_S_Y)):
-            index_set = torch.where(S_Y_set==i)[0]
-            P_S_Y[i] = len(index_set) / len(S_Y_set)
+        # labels and groups come from the dataset metadata; no input is loaded
+        Y_set = torch.from_numpy(dataset.get_label_array()).long()
+        S_set = torch.from_numpy(dataset.get_group_array()).long()
+        S_Y_set = S_set * self.n_classes + Y_set
+        P_S_Y = torch.bincount(S_Y_set, minlength=self.n_groups * self.n_classes).float() / len(S_Y_set)
         P_S_Y_mat = P_S_Y.reshape(self.n_groups, self.n_classes)
         P_Y = torch.sum(P_S_Y_mat, dim=0)
         P_S = torch.sum(P_S_Y_mat, dim=1)
         return S_Y_set, Y_set, S_set, P_S_Y_mat, P_Y, P_S
-    
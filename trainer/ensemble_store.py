@@ -0,0 +1,83 @@
+import os
+import numpy as np
+import torch
+
+
+class EnsembleStore:
+    """
+    Members of a model ensemble as the rows of one memory-mapped file, <path>.bin.
+
+    The floating point tensors of a member's state dict are flattened into one row,
+    stored as fp32, fp16, or fp16 differences to a reference state (fp16-delta),
+    which is saved once to <path>.ref.pt. Other tensors (num_batches_tracked) are
+    taken from the reference. Members are read back one at a time into an existing
+    model, so memory does not grow with the number of members.
+    """
+    formats = ('fp32', 'fp16', 'fp16-delta')
+
+    def __init__(self, path, reference, format='fp16-delta'):
+        if format not in self.formats:
+            raise ValueError('Unknown ensemble format {}'.format(format))
+        self.path = path
+        self.format = format
+        self.dtype = np.float32 if format == 'fp32' else np.float16
+        self.names = [name for name, value in reference.items() if value.is_floating_point()]
+        self.shapes = [tuple(reference[name].shape) for name in self.names]
+        self.row_size = sum(int(np.prod(shape)) for shape in self.shapes)
+        self.n_members = 0
+        self._reference = {name: value.detach().to('cpu', copy=True) for name, value in reference.items()}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        torch.save(self._reference, path + '.ref.pt')
+
+    def __len__(self):
+        return self.n_members
+
+    def __getstate__(self):
+        # checkpoints only carry the layout and the number of members
+        state = self.__dict__.copy()
+        state['_reference'] = None
+        return state
+
+    @property
+    def reference(self):
+        if self._reference is None:
+            self._reference = torch.load(self.path + '.ref.pt')
+        return self._reference
+
+    def _flatten(self, state):
+        return torch.cat([state[name].detach().reshape(-1).to('cpu', torch.float32) for name in self.names])
+
+    def append(self, state):
+        row = self._flatten(state)
+        if self.format == 'fp16-delta':
+            row -= self._flatten(self.reference)
+        row = row.numpy().astype(self.dtype)
+        if not np.isfinite(row).all():
+            raise ValueError('A member does not fit in {}, use the fp32 ensemble format'.format(self.format))
+        # written at the slot of the member, so rows beyond a resumed checkpoint are overwritten
+        mode = 'r+b' if os.path.exists(self.path + '.bin') else 'wb'
+        with open(self.path + '.bin', mode) as f:
+            f.seek(self.n_members * row.nbytes)
+            f.write(row.tobytes())
+            f.truncate()
+        self.n_members += 1
+
+    def load(self, k, model):
+        # copies member k into the parameters and buffers of model
+        rows = np.memmap(self.path + '.bin', dtype=self.dtype, mode='r', shape=(self.n_members, self.row_size))
+        row = torch.from_numpy(rows[k].astype(np.float32))
+        del rows
+        state = model.state_dict()
+        offset = 0
+        with torch.no_grad():
+            for name, shape in zip(self.names, self.shapes):
+                size = int(np.prod(shape))
+                value = row[offset:offset + size].view(shape)
+                if self.format == 'fp16-delta':
+                    value = value + self.reference[name].float()
+                state[name].copy_(value)
+                offset += size
+            for name, value in self.reference.items():
+                if not value.is_floating_point():
+                    state[name].copy_(value)
+        return model
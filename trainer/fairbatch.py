@@ -4,30 +4,35 @@ import time
 import os
 import torch
 import torch.nn as nn
-from utils import get_accuracy
+from utils import get_accuracy, subgroup_mean
 from collections import defaultdict
 import torch.optim as optim
 import trainer
 import numpy as np
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
+from data_handler.dataloader_factory import DataloaderFactory
 
 class Trainer(trainer.GenericTrainer):
+    checkpoint_attrs = ('adjust_count',)
+
     def __init__(self, args, **kwargs):
         super().__init__(args=args, **kwargs)
 
     def train(self, train_loader, test_loader, epochs, writer=None):
         
-        dummy_loader = DataLoader(train_loader.dataset, batch_size=self.bs, shuffle=False,
-                                          num_workers=2, 
-                                          pin_memory=True, drop_last=False)
+        dummy_loader = DataloaderFactory.get_loader(train_loader.dataset, batch_size=self.bs, shuffle=False,
+                                                            num_workers=2, 
+                                                            pin_memory=True, drop_last=False)
 
         if self.data == 'jigsaw':
             self.adjust_count = 0
             self.adjust_term = 100
         self.model.train()
         
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
             train_acc, train_loss = self._train_epoch(epoch, train_loader, self.model, dummy_loader)
 
             eval_start_time = time.time()                
@@ -46,17 +51,15 @@ class Trainer(trainer.GenericTrainer):
                    eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
 
             if self.record:
-                self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                              train=True, 
-                              record=self.record,
-                              writer=writer
-                             )
+                self.record_train(train_loader, epoch, writer)
             
             if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
                 self.scheduler.step(eval_loss)
             else:
                 self.scheduler.step()
 
+            self.save_checkpoint(train_loader, epoch)
+
         print('Training Finished!')
 
         return self.model
@@ -64,6 +67,7 @@ class Trainer(trainer.GenericTrainer):
 
     def _train_epoch(self, epoch, train_loader, model, dummy_loader):
         model.train()
+        self.start_train_record(train_loader)
         
         running_acc = 0.0
         running_loss = 0.0
@@ -84,48 +88,46 @@ class Trainer(trainer.GenericTrainer):
             
             # Get the inputs
             inputs, _, groups, labels, _ = data
-            if self.cuda:
-                inputs = inputs.cuda().squeeze()
-                labels = labels.cuda().squeeze()
-                groups = groups.cuda()
+            inputs = inputs.to(self.device).squeeze()
+            labels = labels.to(self.device).squeeze()
+            groups = groups.to(self.device)
 
             # labels = labels.float() if num_classes == 2 else labels.long()
             labels = labels.long()
 
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                    output_hidden_states=True
-                )
-                outputs = outputs[1]
-            else:
-                outputs = model(inputs)
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                        output_hidden_states=True
+                    )
+                    outputs = outputs[1]
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
 
             if self.balanced:
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_count = group_map.sum(1)
-                group_denom = group_count + (group_count==0).float() # avoid nans
                 loss = nn.CrossEntropyLoss(reduction='none')(outputs, labels)
-                group_loss = (group_map @ loss.view(-1))/group_denom
+                group_loss = subgroup_mean(loss, subgroups, n_subgroups)
 #                 weights = self.weight_matrix.flatten().cuda()
                 loss = torch.mean(group_loss)
             else:
                 loss = self.criterion(outputs, labels).mean()
 
-            running_loss += loss.item()
+            running_loss += loss.detach()
             # binary = True if num_classes ==2 else False
-            running_acc += get_accuracy(outputs, labels)
+            self.track_train(outputs, labels, groups)
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
 
             self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            self.backward_step(loss, model)
 
             if i % self.term == self.term-1: # print every self.term mini-batches
                 avg_batch_time = time.time()-batch_start_time
@@ -157,25 +159,26 @@ class Trainer(trainer.GenericTrainer):
         with torch.no_grad():
             for i, data in enumerate(dummy_loader):
                 inputs, _, groups, _labels, tmp = data
-                if self.cuda:
-                    inputs = inputs.cuda()
-                    _labels = _labels.cuda()
-                    groups = groups.cuda()
+                inputs = inputs.to(self.device)
+                _labels = _labels.to(self.device)
+                groups = groups.to(self.device)
                 
-                if self.data == 'jigsaw':
-                    input_ids = inputs[:, :, 0]
-                    input_masks = inputs[:, :, 1]
-                    segment_ids = inputs[:, :, 2]
-                    outputs = model(
-                        input_ids=input_ids,
-                        attention_mask=input_masks,
-                        token_type_ids=segment_ids,
-                        labels=_labels,
-                        output_hidden_states=True
-                    )
-                    outputs = outputs[1]
-                else:
-                    outputs = model(inputs)
+                with self.autocast():
+                    if self.data == 'jigsaw':
+                        input_ids = inputs[:, :, 0]
+                        input_masks = inputs[:, :, 1]
+                        segment_ids = inputs[:, :, 2]
+                        outputs = model(
+                            input_ids=input_ids,
+                            attention_mask=input_masks,
+                            token_type_ids=segment_ids,
+                            labels=_labels,
+                            output_hidden_states=True
+                        )
+                        outputs = outputs[1]
+                    else:
+                        outputs = model(inputs)
+                outputs = outputs.float()
 
                 logits.append(outputs)
                 labels.append(_labels)
@@ -258,7 +261,7 @@ class Trainer(trainer.GenericTrainer):
             yhat_y = {}
             
             ones_array = np.ones(len(sampler.y_data))
-            ones_tensor = torch.FloatTensor(ones_array).cuda()
+            ones_tensor = torch.FloatTensor(ones_array).to(self.device)
             dp_loss = criterion(logits, ones_tensor.long())
             
             for tmp_yz in sampler.yz_tuple:
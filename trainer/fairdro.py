@@ -3,23 +3,25 @@ from collections import defaultdict
 
 import copy
 import time
-from utils import get_accuracy, chi_proj
+from utils import get_accuracy, chi_proj_torch, subgroup_stats
 import trainer
 import torch
 import numpy as np
 
-from torch.utils.data import DataLoader
+from data_handler.dataloader_factory import DataloaderFactory
 
 
 class Trainer(trainer.GenericTrainer):
+    checkpoint_attrs = ('q_dict', 'loss_tracker', 'n_q_update', 'q_update_term')
+
     def __init__(self, args, **kwargs):
         super().__init__(args=args, **kwargs)
         self.train_criterion = torch.nn.CrossEntropyLoss(reduction='none')
-        self.rho = args.rho 
+        self.rho = self.replica_param(args.rho, args.replica_rho) 
         self.optim_q = args.optim_q
 
         # when using gradient ascent for q
-        self.gamma = args.gamma # learning rate of adv_probs
+        self.gamma = self.replica_param(args.gamma, args.replica_gamma, n_dims=2) # learning rate of adv_probs
         self.tol = 1e-4
 
         self.data = args.dataset
@@ -28,6 +30,10 @@ class Trainer(trainer.GenericTrainer):
         self.q_decay = args.q_decay    
 
         self.update_freq = 100 # only for jigsaw
+
+        self.q_loss_estimator = args.q_loss_estimator
+        self.q_loss_decay = args.q_loss_decay
+        self.loss_tracker = None
         
     def train(self, train_loader, test_loader, epochs, criterion=None, writer=None):
         
@@ -38,33 +44,46 @@ class Trainer(trainer.GenericTrainer):
         n_classes = train_loader.dataset.n_classes
         n_groups = train_loader.dataset.n_groups
         
-        self.normal_loader = DataLoader(train_loader.dataset, 
-                                        batch_size=128, 
-                                        shuffle=False, 
-                                        num_workers=2, 
-                                        pin_memory=True, 
-                                        drop_last=False)
+        self.normal_loader = DataloaderFactory.get_loader(train_loader.dataset, 
+                                                          batch_size=128, 
+                                                          shuffle=False, 
+                                                          num_workers=2, 
+                                                          pin_memory=True, 
+                                                          drop_last=False)
         
         self.q_dict = {}
         for l in range(n_classes):
-            self.q_dict[l] = torch.ones(n_groups).cuda(device=self.device) / n_groups
+            self.q_dict[l] = torch.ones(self.replica_shape + (n_groups,)).to(self.device) / n_groups
+
+        if self.q_loss_estimator != 'full':
+            self.loss_tracker = SubgroupLossTracker(len(train_loader.dataset), n_groups, n_classes,
+                                                    mode=self.q_loss_estimator, decay=self.q_loss_decay,
+                                                    replica_shape=self.replica_shape, device=self.device)
         
         if self.data == 'jigsaw':
             self.n_q_update = 0
             self.q_update_term = 0
             self.total_q_update = (epochs * len(train_loader)) / self.update_freq
 
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
             self._train_epoch(epoch, train_loader, model, criterion)            
             if self.data != 'jigsaw' or self.record:
-                _, _, _, _, train_subgroup_acc, train_subgroup_loss = self.evaluate(self.model, 
-                                                                                    self.normal_loader,
-                                                                                    self.train_criterion, 
-                                                                                    epoch,
-                                                                                    train=True,
-                                                                                    record=self.record,
-                                                                                    writer=writer
-                                                                                    )
+                if self.loss_tracker is None:
+                    _, _, _, _, train_subgroup_acc, train_subgroup_loss = self.evaluate(self.model, 
+                                                                                        self.normal_loader,
+                                                                                        self.train_criterion, 
+                                                                                        epoch,
+                                                                                        train=True,
+                                                                                        record=self.record,
+                                                                                        writer=writer
+                                                                                        )
+                else:
+                    train_subgroup_acc, train_subgroup_loss = self.loss_tracker.get()
+                    if self.record:
+                        self._record_estimator_drift(epoch, writer)
                 if self.use_01loss:
                     train_subgroup_loss = 1-train_subgroup_acc
 
@@ -92,10 +111,13 @@ class Trainer(trainer.GenericTrainer):
                                                                              writer=writer
                                                                             )
             eval_end_time = time.time()
-            print('[{}/{}] Method: {} '
-                  'Test Loss: {:.3f} Test Acc: {:.2f} Test DEOM {:.2f} [{:.2f} s]'.format
-                  (epoch + 1, epochs, self.method,
-                   eval_loss, eval_acc, eval_deom, (eval_end_time - eval_start_time)))
+            if self.n_replicas > 1:
+                self.print_replicas(epoch, epochs, eval_loss, eval_acc, eval_deom, eval_deoa, eval_end_time - eval_start_time)
+            else:
+                print('[{}/{}] Method: {} '
+                      'Test Loss: {:.3f} Test Acc: {:.2f} Test DEOM {:.2f} [{:.2f} s]'.format
+                      (epoch + 1, epochs, self.method,
+                       eval_loss, eval_acc, eval_deom, (eval_end_time - eval_start_time)))
             
             if self.record:
                 q_values = {}
@@ -127,9 +149,11 @@ class Trainer(trainer.GenericTrainer):
                     writer.add_scalars('opt_q_values_true', opt_q_values, epoch)
                 
             if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
-                self.scheduler.step(eval_loss)
+                self.scheduler.step(eval_loss.mean()) # stacked replicas share one lr schedule
             else:
                 self.scheduler.step()
+
+            self.save_checkpoint(train_loader, epoch)
                   
         print('Training Finished!')        
 
@@ -145,51 +169,50 @@ class Trainer(trainer.GenericTrainer):
         
         for i, data in enumerate(train_loader):
             # Get the inputs
-            inputs, _, groups, targets, _ = data
+            inputs, _, groups, targets, idx = data
             labels = targets
             
-            if self.cuda:
-                inputs = inputs.cuda(device=self.device)
-                labels = labels.cuda(device=self.device)
-                groups = groups.cuda(device=self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
                 
             subgroups = groups * n_classes + labels
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                )[1] 
-            else:
-                outputs = model(inputs)
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                    )[1] 
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
 
             if criterion is not None:
-                loss = criterion(outputs, labels)
+                loss = self.per_sample_loss(criterion, outputs, labels)
             else:
-                loss = self.train_criterion(outputs, labels)
-
-            # calculate the balSampling losses
-            group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-            group_count = group_map.sum(1)
-            group_denom = group_count + (group_count==0).float() # avoid nans
-            group_loss = (group_map @ loss.view(-1))/group_denom
-            group_loss = group_loss.reshape([n_groups, n_classes])
+                loss = self.per_sample_loss(self.train_criterion, outputs, labels)
+
+            if self.loss_tracker is not None:
+                acc = self.per_sample_acc(outputs, labels)
+                self.loss_tracker.update(idx, subgroups, loss.detach(), acc)
+
+            # calculate the balSampling losses, (n_groups, n_classes) or (K, n_groups, n_classes)
+            group_loss = subgroup_stats(loss, subgroups, n_subgroups)[2].movedim(0, -1)
+            group_loss = group_loss.reshape(self.replica_shape + (n_groups, n_classes))
             robust_loss = 0
             for l in range(n_classes):
-                robust_loss += group_loss[:,l] @ self.q_dict[l]
+                robust_loss += (group_loss[..., l] * self.q_dict[l]).sum()
             robust_loss /= n_classes        
             self.optimizer.zero_grad()
-            robust_loss.backward()                
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(), self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(robust_loss, model, clip=self.data == 'jigsaw')
 
-            running_loss += robust_loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += robust_loss.detach() / self.n_replicas
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
             if i % self.term == self.term-1: # print every self.term mini-batches
                 avg_batch_time = time.time()-batch_start_time
                 print('[{}/{}, {:5d}] Method: {} Train Loss: {:.3f} Train Acc: {:.2f} '
@@ -206,12 +229,15 @@ class Trainer(trainer.GenericTrainer):
                 if self.q_update_term % self.update_freq == 0:
                     print('lets start')
                     start = time.time()
-                    _, _, _, _, train_subgroup_acc, train_subgroup_loss = self.evaluate(self.model, self.normal_loader, self.train_criterion, 
-                                                                       epoch,
-                                                                       train=True,
-                                                                       record=False,
-                                                                       writer=None
-                                                                      )
+                    if self.loss_tracker is None:
+                        _, _, _, _, train_subgroup_acc, train_subgroup_loss = self.evaluate(self.model, self.normal_loader, self.train_criterion, 
+                                                                           epoch,
+                                                                           train=True,
+                                                                           record=False,
+                                                                           writer=None
+                                                                          )
+                    else:
+                        train_subgroup_acc, train_subgroup_loss = self.loss_tracker.get()
                     end = time.time()
 
                     if self.use_01loss:
@@ -236,27 +262,38 @@ class Trainer(trainer.GenericTrainer):
                     self.q_update_term = 0
                 
 
+    def _record_estimator_drift(self, epoch, writer):
+        # exact full pass, only to report how far the incremental estimates are off
+        _, _, _, _, exact_acc, exact_loss = self.evaluate(self.model, 
+                                                          self.normal_loader,
+                                                          self.train_criterion, 
+                                                          epoch,
+                                                          train=True,
+                                                          record=self.record,
+                                                          writer=writer
+                                                          )
+        est_acc, est_loss = self.loss_tracker.get()
+        loss_drift = (est_loss - exact_loss).abs().max().item()
+        acc_drift = (est_acc - exact_acc).abs().max().item()
+        print(f'q loss estimator drift : loss {loss_drift:.4f} acc {acc_drift:.4f}')
+        writer.add_scalars('q_estimator_drift', {'loss': loss_drift, 'acc': acc_drift}, epoch)
+
     def _q_update_ibr(self, q_dict, losses, n_classes, n_groups):
         opt_q = {}
         for l in range(n_classes):
-            label_group_loss = losses[:,l]
+            label_group_loss = losses[..., l]
             opt_q[l] = self._update_mw_margin(label_group_loss)
             print(f'{l} label loss : {label_group_loss}')
             print(f'{l} label q values : {q_dict[l]}')
         return opt_q
     
     def _q_update_pd(self, train_subgroup_loss, n_classes, n_groups):
-        # train_subgroup_loss = torch.flatten(train_subgroup_loss)
-        
-        idxs = np.array([i * n_classes for i in range(n_groups)])  
-            
+        # exponentiated-gradient step on every class (and replica), then one batched projection
+        q = torch.stack([self.q_dict[l] for l in range(n_classes)], dim=-2)
+        q = q * torch.exp(self.gamma * train_subgroup_loss.transpose(-1, -2))
+        q = chi_proj_torch(q, self.rho)
         for l in range(n_classes):
-            label_group_loss = train_subgroup_loss[idxs+l]
-            self.adv_probs_dict[l] *= torch.exp(self.gamma*label_group_loss)
-            self.adv_probs_dict[l] = torch.from_numpy(chi_proj(self.adv_probs_dict[l], self.rho)).cuda(device=self.device).float()
-
-#                self.adv_probs_dict[l] = torch.from_numpy(chi_proj_nonuni(self.adv_probs_dict[l], self.rho, self.group_dist[l])).cuda(device=self.device).float()
-#            self._q_update(train_subgroup_loss, n_classes, n_groups)            
+            self.q_dict[l] = q[..., l, :]
 
     def _q_update_ibr_linear_interpolation(self, q_dict, subgroup_loss, n_classes, n_groups, epoch, epochs):
         if self.q_decay == 'cos': 
@@ -267,10 +304,10 @@ class Trainer(trainer.GenericTrainer):
 
         opt_q = {}
         for l in range(n_classes):
-            label_group_loss = subgroup_loss[:,l]
+            label_group_loss = subgroup_loss[..., l]
             opt_q[l] = self._update_mw_margin(label_group_loss)
             q_dict[l] = q_dict[l] + cur_step_size*(opt_q[l] - q_dict[l])
-            print(f'{l} label loss : {subgroup_loss[:,l]}')
+            print(f'{l} label loss : {subgroup_loss[..., l]}')
             print(f'{l} label q values : {q_dict[l]}')
         return q_dict, opt_q
                  
@@ -334,15 +371,61 @@ class Trainer(trainer.GenericTrainer):
 
         rho = self.rho
         
-        n_groups = len(losses)
-        mean = losses.mean()
-        denom = (losses - mean).norm(2)
-        if denom == 0:
-            q = torch.zeros_like(losses) + 1/n_groups
-        else:
-            q = 1/n_groups + np.sqrt(2 * self.rho / n_groups)* (1/denom) * (losses - mean)
+        # losses is (n_groups,), or (K, n_groups) with a (K, 1) rho for stacked replicas
+        n_groups = losses.shape[-1]
+        mean = losses.mean(-1, keepdim=True)
+        denom = (losses - mean).norm(2, dim=-1, keepdim=True)
+        scale = np.sqrt(2 * rho / n_groups) if self.n_replicas == 1 else torch.sqrt(2 * rho / n_groups)
+        q = torch.where(denom == 0, torch.zeros_like(losses) + 1/n_groups,
+                        1/n_groups + scale * (1/denom) * (losses - mean))
         return q
         
+
+class SubgroupLossTracker:
+    """Per-sample loss/accuracy of the training steps, keyed by dataset index.
+
+    Stands in for a full pass over the train set when updating q: the latest
+    ('running') or exponentially averaged ('ema') loss of every sample seen so
+    far is reduced to (group, class) means on demand.
+    """
+    def __init__(self, n_data, n_groups, n_classes, mode='running', decay=0.9, replica_shape=(), device=None):
+        assert mode in ['running', 'ema']
+        self.n_groups = n_groups
+        self.n_classes = n_classes
+        self.mode = mode
+        self.decay = decay
+        self.replica_shape = replica_shape
+
+        self.loss = torch.zeros((n_data,) + replica_shape, device=device)
+        self.acc = torch.zeros((n_data,) + replica_shape, device=device)
+        self.seen = torch.zeros(n_data, dtype=torch.bool, device=device)
+        self.subgroups = torch.zeros(n_data, dtype=torch.long, device=device)
+
+    def update(self, idx, subgroups, loss, acc):
+        idx = idx.to(self.loss.device)
+        if self.mode == 'ema':
+            seen = self.seen[idx].view((-1,) + (1,) * len(self.replica_shape))
+            loss = torch.where(seen, self.decay * self.loss[idx] + (1 - self.decay) * loss, loss)
+            acc = torch.where(seen, self.decay * self.acc[idx] + (1 - self.decay) * acc, acc)
+        self.loss[idx] = loss.float()
+        self.acc[idx] = acc.float()
+        self.seen[idx] = True
+        self.subgroups[idx] = subgroups.long()
+
+    def get(self):
+        n_subgroups = self.n_groups * self.n_classes
+        seen = self.seen.float().view((-1, 1) + (1,) * len(self.replica_shape))
+        stats = torch.stack([self.loss, self.acc, torch.ones_like(self.loss)], dim=1) * seen
+        _, total, _ = subgroup_stats(stats, self.subgroups, n_subgroups)
+        # a (group, class) cell with no seen sample yet gets 0, as in a full pass
+        count = total[:, 2]
+        denom = count + (count == 0).to(count.dtype) # avoid nans
+        group_loss = (total[:, 0] / denom).movedim(0, -1)
+        group_acc = (total[:, 1] / denom).movedim(0, -1)
+        return (group_acc.reshape(self.replica_shape + (self.n_groups, self.n_classes)),
+                group_loss.reshape(self.replica_shape + (self.n_groups, self.n_classes)))
+
+
 # Deprecated
 
 # def bisection(eta_min, eta_max, f, tol=1e-6, max_iter=1000):
@@ -3,15 +3,17 @@ from collections import defaultdict
 
 import copy
 import time
-from utils import get_accuracy, chi_proj
+from utils import get_accuracy, chi_proj_torch, subgroup_mean
 import trainer
 import torch
 import numpy as np
 
-from torch.utils.data import DataLoader
+from data_handler.dataloader_factory import DataloaderFactory
 
 
 class Trainer(trainer.GenericTrainer):
+    checkpoint_attrs = ('q_dict', 'n_q_update', 'q_update_term')
+
     def __init__(self, args, **kwargs):
         super().__init__(args=args, **kwargs)
         self.train_criterion = torch.nn.CrossEntropyLoss(reduction='none')
@@ -38,21 +40,24 @@ class Trainer(trainer.GenericTrainer):
         n_classes = train_loader.dataset.n_classes
         n_groups = train_loader.dataset.n_groups
         
-        self.normal_loader = DataLoader(train_loader.dataset, 
-                                        batch_size=128, 
-                                        shuffle=False, 
-                                        num_workers=2, 
-                                        pin_memory=True, 
-                                        drop_last=False)
+        self.normal_loader = DataloaderFactory.get_loader(train_loader.dataset, 
+                                                          batch_size=128, 
+                                                          shuffle=False, 
+                                                          num_workers=2, 
+                                                          pin_memory=True, 
+                                                          drop_last=False)
         
-        self.q_dict = torch.ones(n_groups*n_classes).cuda()
+        self.q_dict = torch.ones(n_groups*n_classes).to(self.device)
         
         if self.data == 'jigsaw':
             self.n_q_update = 0
             self.q_update_term = 0
             self.total_q_update = (epochs * len(train_loader)) / self.update_freq
 
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
             self._train_epoch(epoch, train_loader, model, criterion)            
             if self.data != 'jigsaw' or self.record:
                 _, _, _, _, train_subgroup_acc, train_subgroup_loss = self.evaluate(self.model, 
@@ -128,6 +133,8 @@ class Trainer(trainer.GenericTrainer):
                 self.scheduler.step(eval_loss)
             else:
                 self.scheduler.step()
+
+            self.save_checkpoint(train_loader, epoch)
                   
         print('Training Finished!')        
 
@@ -146,24 +153,25 @@ class Trainer(trainer.GenericTrainer):
             inputs, _, groups, targets, _ = data
             labels = targets
             
-            if self.cuda:
-                inputs = inputs.cuda(device=self.device)
-                labels = labels.cuda(device=self.device)
-                groups = groups.cuda(device=self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
                 
             subgroups = groups * n_classes + labels
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                )[1] 
-            else:
-                outputs = model(inputs)
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                    )[1] 
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
 
             if criterion is not None:
                 loss = criterion(outputs, labels)
@@ -171,23 +179,17 @@ class Trainer(trainer.GenericTrainer):
                 loss = self.train_criterion(outputs, labels)
 
             # calculate the balSampling losses
-            group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-            group_count = group_map.sum(1)
-            group_denom = group_count + (group_count==0).float() # avoid nans
-            group_loss = (group_map @ loss.view(-1))/group_denom
+            group_loss = subgroup_mean(loss, subgroups, n_subgroups)
             # group_loss = group_loss.reshape([n_groups, n_classes])
             robust_loss = 0
             # for l in range(n_classes):
             robust_loss += group_loss @ self.q_dict
             robust_loss /= (n_classes*n_groups)        
             self.optimizer.zero_grad()
-            robust_loss.backward()                
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(), self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(robust_loss, model, clip=self.data == 'jigsaw')
 
-            running_loss += robust_loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += robust_loss.detach()
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
             if i % self.term == self.term-1: # print every self.term mini-batches
                 avg_batch_time = time.time()-batch_start_time
                 print('[{}/{}, {:5d}] Method: {} Train Loss: {:.3f} Train Acc: {:.2f} '
@@ -244,17 +246,8 @@ class Trainer(trainer.GenericTrainer):
         return opt_q
     
     def _q_update_pd(self, train_subgroup_loss, n_classes, n_groups):
-        # train_subgroup_loss = torch.flatten(train_subgroup_loss)
-        
-        idxs = np.array([i * n_classes for i in range(n_groups)])  
-            
-        for l in range(n_classes):
-            label_group_loss = train_subgroup_loss[idxs+l]
-            self.adv_probs_dict[l] *= torch.exp(self.gamma*label_group_loss)
-            self.adv_probs_dict[l] = torch.from_numpy(chi_proj(self.adv_probs_dict[l], self.rho)).cuda(device=self.device).float()
-
-#                self.adv_probs_dict[l] = torch.from_numpy(chi_proj_nonuni(self.adv_probs_dict[l], self.rho, self.group_dist[l])).cuda(device=self.device).float()
-#            self._q_update(train_subgroup_loss, n_classes, n_groups)            
+        q = self.q_dict * torch.exp(self.gamma * train_subgroup_loss.flatten())
+        self.q_dict = chi_proj_torch(q, self.rho)
 
     def _q_update_ibr_linear_interpolation(self, q_dict, subgroup_loss, n_classes, n_groups, epoch, epochs):
         if self.q_decay == 'cos': 
@@ -4,7 +4,7 @@ import torch
 import torch.nn.functional as F
 import torch.nn as nn
 import time
-from utils import get_accuracy
+from utils import get_accuracy, subgroup_mean
 import trainer
 from .hsic import RbfHSIC
 
@@ -14,13 +14,20 @@ class Trainer(trainer.GenericTrainer):
         self.lamb = args.lamb
         self.sigma = args.sigma
         self.kernel = args.kernel
+        self.hsic_estimator = args.hsic_estimator
+        self.hsic_features = args.hsic_features
+        self.hsic_block = args.hsic_block
         
     def train(self, train_loader, test_loader, epochs, writer=None):
 
         nlp_flag = True if self.data == 'jigsaw' else False
-        hsic = RbfHSIC(1, 1, nlp_flag=nlp_flag)
+        hsic = RbfHSIC(1, 1, algorithm=self.hsic_estimator, nlp_flag=nlp_flag,
+                       n_features=self.hsic_features, block_size=self.hsic_block, seed=self.seed)
         
+        self.resume(train_loader)
         for epoch in range(self.epochs):
+            if self.finished(epoch):
+                continue
             self._train_epoch(epoch, train_loader, self.model, hsic=hsic)
 
             eval_start_time = time.time()                
@@ -39,21 +46,20 @@ class Trainer(trainer.GenericTrainer):
                    eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
 
             if self.record:
-                self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                              train=True, 
-                              record=self.record,
-                              writer=writer
-                             )
+                self.record_train(train_loader, epoch, writer)
             
             if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
                 self.scheduler.step(eval_loss)
             else:
                 self.scheduler.step()
 
+            self.save_checkpoint(train_loader, epoch)
+
         print('Training Finished!')
 
     def _train_epoch(self, epoch, train_loader, model, hsic=None, criterion=None):
         model.train()
+        self.start_train_record(train_loader)
 
         running_acc = 0.0
         running_loss = 0.0
@@ -67,35 +73,33 @@ class Trainer(trainer.GenericTrainer):
             # Get the inputs
             inputs, _, groups, targets, idx = data
             labels = targets
-            if self.cuda:
-                inputs = inputs.cuda(self.device)
-                labels = labels.cuda(self.device)
-                groups = groups.long().cuda(self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.long().to(self.device)
             
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                    output_hidden_states=True
-                )
-                logits = outputs[1]
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                        output_hidden_states=True
+                    )
+                    logits = outputs[1]
 
-            else:
-                outputs = model(inputs, get_inter=True)
-                logits = outputs[-1]
+                else:
+                    outputs = model(inputs, get_inter=True)
+                    logits = outputs[-1]
+            logits = logits.float()
                     
             if self.balanced:
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_count = group_map.sum(1)
-                group_denom = group_count + (group_count==0).float() # avoid nans
                 loss = nn.CrossEntropyLoss(reduction='none')(logits, labels)
-                group_loss = (group_map @ loss.view(-1))/group_denom
+                group_loss = subgroup_mean(loss, subgroups, n_subgroups)
                 loss = torch.mean(group_loss)
             else:
                 if criterion is not None:
@@ -104,24 +108,21 @@ class Trainer(trainer.GenericTrainer):
                     loss = self.criterion(logits, labels).mean()
                         
             f_s = outputs[-2] if self.data != 'jigsaw' else outputs[2][0][:,0,:]
-            group_onehot = F.one_hot(groups).float()
+            f_s = f_s.float() # the kernel matrices stay in fp32
+            group_onehot = F.one_hot(groups, num_classes=n_groups).float()
             hsic_loss = 0
             for l in range(n_classes):
-                mask = targets == l
-                if mask.sum()==0:
-                    continue
-                hsic_loss += hsic.unbiased_estimator(f_s[mask], group_onehot[mask])
+                # masked instead of indexed, so that there is no host sync; an absent class adds 0
+                hsic_loss += hsic.estimator(f_s, group_onehot, mask=labels == l)
             
             loss = loss + self.lamb * hsic_loss 
             
-            loss.backward()
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
                 
-            running_acc += get_accuracy(logits, labels)
-            running_loss += loss.item()
+            self.track_train(logits, labels, groups)
+            running_acc += get_accuracy(logits, labels, reduction='none').mean()
+            running_loss += loss.detach()
             if i % self.term == self.term - 1:  # print every self.term mini-batches
                 avg_batch_time = time.time() - batch_start_time
                 print('[{}/{}, {:5d}] Method: {} Train Loss: {:.3f} Train Acc: {:.2f} '
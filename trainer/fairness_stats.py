@@ -0,0 +1,67 @@
+import torch
+
+
+def confusion_tensor(preds, labels, groups, n_groups, n_classes):
+    """
+    (n_groups, n_classes, n_classes) counts, [g, y, p] is the number of samples of
+    group g and label y that are predicted as p. One bincount over the whole set;
+    every statistic below is derived from it. Samples with group -1 (no supervision
+    for the sensitive attribute) are not counted.
+    """
+    keep = groups >= 0
+    preds, labels, groups = preds[keep], labels[keep], groups[keep]
+    cells = (groups.long() * n_classes + labels.long()) * n_classes + preds.long()
+    counts = torch.bincount(cells.view(-1), minlength=n_groups * n_classes * n_classes)
+    return counts.view(n_groups, n_classes, n_classes).double()
+
+
+def accuracy(confusion):
+    return confusion.diagonal(dim1=1, dim2=2).sum() / confusion.sum()
+
+
+def subgroup_accuracy(confusion):
+    # (n_groups, n_classes): P(pred = y | g, y)
+    return confusion.diagonal(dim1=1, dim2=2) / confusion.sum(2)
+
+
+# the violations are rates of a group (or subgroup) minus the rate of the whole set;
+# an empty group gives nan
+
+def dp_violations(confusion):
+    # (n_groups, n_classes): P(pred = c | g) - P(pred = c)
+    group_preds = confusion.sum(1)
+    return group_preds / group_preds.sum(1, keepdim=True) - group_preds.sum(0) / confusion.sum()
+
+
+def eo_violations(confusion):
+    # (n_groups, n_classes, n_classes): P(pred = p | g, y) - P(pred = p | y)
+    rates = confusion / confusion.sum(2, keepdim=True)
+    class_rates = confusion.sum(0) / confusion.sum((0, 2)).unsqueeze(1)
+    return rates - class_rates
+
+
+def dca_violations(confusion):
+    # (n_groups, n_classes): P(pred = y | g, y) - P(pred = y | y), the diagonal of eo
+    return eo_violations(confusion).diagonal(dim1=1, dim2=2)
+
+
+def ap_violations(confusion):
+    # (n_groups,): P(pred = y | g) - P(pred = y)
+    correct = confusion.diagonal(dim1=1, dim2=2).sum(1)
+    return correct / confusion.sum((1, 2)) - accuracy(confusion)
+
+
+def mean_predictions(confusion, by='subgroup'):
+    """
+    Mean predicted class of every subgroup (g * n_classes + y) or of every group,
+    followed by that of the whole set; mu of the exponentiated gradient reduction.
+    """
+    n_classes = confusion.shape[-1]
+    classes = torch.arange(n_classes, dtype=confusion.dtype, device=confusion.device)
+    if by == 'subgroup':
+        cells = confusion.reshape(-1, n_classes)
+    else:
+        cells = confusion.sum(1)
+    means = (cells @ classes) / cells.sum(1)
+    total = (confusion.sum((0, 1)) @ classes) / confusion.sum()
+    return torch.cat((means, total.unsqueeze(0)))
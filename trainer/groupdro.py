@@ -2,16 +2,18 @@ from __future__ import print_function
 from collections import defaultdict
 
 import time
-from utils import get_accuracy
+from utils import get_accuracy, subgroup_stats
 import trainer
 import torch
 import numpy as np
 
 
 class Trainer(trainer.GenericTrainer):
+    checkpoint_attrs = ('adv_probs',)
+
     def __init__(self, args, **kwargs):
         super().__init__(args=args, **kwargs)
-        self.gamma = args.gamma # learning rate of adv_probs
+        self.gamma = self.replica_param(args.gamma, args.replica_gamma) # learning rate of adv_probs
         self.train_criterion = torch.nn.CrossEntropyLoss(reduction='none')
 
     def train(self, train_loader, test_loader, epochs, criterion=None, writer=None):
@@ -22,9 +24,12 @@ class Trainer(trainer.GenericTrainer):
         n_classes = train_loader.dataset.n_classes
         n_groups = train_loader.dataset.n_groups
         
-        self.adv_probs = torch.ones(n_groups*n_classes).cuda() / (n_groups*n_classes)
+        self.adv_probs = torch.ones(self.replica_shape + (n_groups*n_classes,)).to(self.device) / (n_groups*n_classes)
         
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
             
             self._train_epoch(epoch, train_loader, model,criterion)
 
@@ -38,27 +43,29 @@ class Trainer(trainer.GenericTrainer):
                                                                              writer=writer
                                                                             )
             eval_end_time = time.time()
-            print('[{}/{}] Method: {} '
-                  'Test Loss: {:.3f} Test Acc: {:.2f} Test DEOM {:.2f} [{:.2f} s]'.format
-                  (epoch + 1, epochs, self.method,
-                   eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
+            if self.n_replicas > 1:
+                self.print_replicas(epoch, epochs, eval_loss, eval_acc, eval_dcam, eval_dcaa, eval_end_time - eval_start_time)
+            else:
+                print('[{}/{}] Method: {} '
+                      'Test Loss: {:.3f} Test Acc: {:.2f} Test DEOM {:.2f} [{:.2f} s]'.format
+                      (epoch + 1, epochs, self.method,
+                       eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
 
             if self.record:
-                self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                              train=True, 
-                              record=self.record,
-                              writer=writer
-                             )
+                self.record_train(train_loader, epoch, writer)
                 
             if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
-                self.scheduler.step(eval_loss)
+                self.scheduler.step(eval_loss.mean()) # stacked replicas share one lr schedule
             else:
                 self.scheduler.step()
+
+            self.save_checkpoint(train_loader, epoch)
                   
         print('Training Finished!')        
 
     def _train_epoch(self, epoch, train_loader, model, criterion=None):
         model.train()
+        self.start_train_record(train_loader)
         
         running_acc = 0.0
         running_loss = 0.0
@@ -73,47 +80,43 @@ class Trainer(trainer.GenericTrainer):
             inputs, _, groups, targets, _ = data
             labels = targets
 
-            if self.cuda:
-                inputs = inputs.cuda(device=self.device)
-                labels = labels.cuda(device=self.device)
-                groups = groups.cuda(device=self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
                 
             subgroups = groups * n_classes + labels
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                )[1] 
-            else:
-                outputs = model(inputs)
-
-            loss = self.train_criterion(outputs, labels)
-
-            # calculate the groupwise losses
-            group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-            group_count = group_map.sum(1)
-            group_denom = group_count + (group_count==0).float() # avoid nans
-            group_loss = (group_map @ loss.view(-1))/group_denom
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                    )[1] 
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
+
+            loss = self.per_sample_loss(self.train_criterion, outputs, labels)
+
+            # calculate the groupwise losses, (n_subgroups,) or (K, n_subgroups)
+            group_loss = subgroup_stats(loss, subgroups, n_subgroups)[2].movedim(0, -1)
 
             # update q
             self.adv_probs = self.adv_probs * torch.exp(self.gamma*group_loss.data)
-            self.adv_probs = self.adv_probs/(self.adv_probs.sum()) # proj
+            self.adv_probs = self.adv_probs/(self.adv_probs.sum(-1, keepdim=True)) # proj
 
-            loss = group_loss @ self.adv_probs
+            loss = (group_loss * self.adv_probs).sum()
                 
-            loss.backward()
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
 
-            running_loss += loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += loss.detach() / self.n_replicas
+            self.track_train(outputs, labels, groups)
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
 
             if i % self.term == self.term-1: # print every self.term mini-batches
                 avg_batch_time = time.time()-batch_start_time
@@ -4,8 +4,10 @@ MIT license
 Python Implementation of the finite sample estimator of Hilbert-Schmidt Independence Criterion (HSIC)
 We provide both biased estimator and unbiased estimators (unbiased estimator is used in the paper)
 """
+import math
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 def to_numpy(x):
@@ -26,18 +28,28 @@ class HSIC(nn.Module):
         Song, Le, et al. "Feature selection via dependence maximization." 2012.
         :math: \frac{1}{m (m - 3)} \bigg[ tr (\tilde K \tilde L) + \frac{1^\top \tilde K 1 1^\top \tilde L 1}{(m-1)(m-2)} - \frac{2}{m-2} 1^\top \tilde K \tilde L 1 \bigg].
         where \tilde K and \tilde L are related to K and L by the diagonal entries of \tilde K_{ij} and \tilde L_{ij} are set to zero.
+    The unbiased estimator can also be computed as
+    (3) 'trace': the same estimate with tr (\tilde K \tilde L) as an elementwise product, O(m^2) instead of O(m^3);
+    (4) 'rff' / 'nystrom': the estimate for the rank-D kernels of D random Fourier features or of
+        D Nystrom landmarks, O(m D^2);
+    (5) 'block': the mean of the estimates on blocks of block_size rows, O(m B). Since the batches
+        are shuffled, averaging the estimates of micro-batches is the same estimator.
     Parameters
     ----------
     sigma_x : float
         the kernel size of the kernel function for X.
     sigma_y : float
         the kernel size of the kernel function for Y.
-    algorithm: str ('unbiased' / 'biased')
+    algorithm: str ('unbiased' / 'biased' / 'trace' / 'rff' / 'nystrom' / 'block')
         the algorithm for the finite sample estimator. 'unbiased' is used for our paper.
     reduction: not used (for compatibility with other losses).
+    n_features: int
+        the number of random Fourier features or Nystrom landmarks of 'rff' / 'nystrom'.
+    block_size: int
+        the block size of 'block'.
     """
     def __init__(self, sigma_x, sigma_y=None, algorithm='unbiased',
-                 reduction=None, nlp_flag=False):
+                 reduction=None, nlp_flag=False, n_features=512, block_size=64, seed=0):
         super(HSIC, self).__init__()
 
         if sigma_y is None:
@@ -46,18 +58,38 @@ class HSIC(nn.Module):
         self.sigma_x = sigma_x
         self.sigma_y = sigma_y
         self.nlp_flag = nlp_flag
+        self.algorithm = algorithm
+        self.n_features = n_features
+        self.block_size = block_size
+        self.seed = seed
 
         if algorithm == 'biased':
             self.estimator = self.biased_estimator
-        elif algorithm == 'unbiased':
+        elif algorithm in ['unbiased', 'trace']:
             self.estimator = self.unbiased_estimator
+        elif algorithm in ['rff', 'nystrom']:
+            self.estimator = self.low_rank_estimator
+        elif algorithm == 'block':
+            self.estimator = self.block_estimator
         else:
             raise ValueError('invalid estimator: {}'.format(algorithm))
 
-    def _kernel_x(self, X):
+    def _kernel_x(self, X, mask=None):
         raise NotImplementedError
 
-    def _kernel_y(self, Y):
+    def _kernel_y(self, Y, mask=None):
+        raise NotImplementedError
+
+    def _features_x(self, X, mask=None):
+        raise NotImplementedError
+
+    def _features_y(self, Y, mask=None):
+        raise NotImplementedError
+
+    def _block_kernel_x(self, X, mask=None):
+        raise NotImplementedError
+
+    def _block_kernel_y(self, Y, mask=None):
         raise NotImplementedError
 
     def biased_estimator(self, input1, input2):
@@ -74,24 +106,93 @@ class HSIC(nn.Module):
 
         return torch.trace(KH @ LH / (N - 1) ** 2)
 
-    def unbiased_estimator(self, input1, input2):
+    def unbiased_estimator(self, input1, input2, mask=None):
         """Unbiased estimator of Hilbert-Schmidt Independence Criterion
         Song, Le, et al. "Feature selection via dependence maximization." 2012.
+        With a boolean mask, this is the estimate on the masked rows only, computed
+        on the whole batch without indexing (0 if the mask is empty).
         """
-        kernel_XX = self._kernel_x(input1)
-        kernel_YY = self._kernel_y(input2)
+        kernel_XX = self._kernel_x(input1, mask)
+        kernel_YY = self._kernel_y(input2, mask)
 
         tK = kernel_XX - torch.diag(kernel_XX)
         tL = kernel_YY - torch.diag(kernel_YY)
-        N = len(input1)
+        if mask is None:
+            N = len(input1)
+        else:
+            w = mask.to(tK.dtype)
+            W = w.unsqueeze(1) * w.unsqueeze(0)
+            tK = tK * W
+            tL = tL * W
+            N = w.sum()
 
+        trace = torch.trace(tK @ tL) if self.algorithm != 'trace' else (tK * tL.t()).sum()
         hsic = (
-            torch.trace(tK @ tL)
+            trace
             + (torch.sum(tK) * torch.sum(tL) / (N - 1) / (N - 2))
             - (2 * torch.sum(tK, 0).dot(torch.sum(tL, 0)) / (N - 2))
         )
 
-        return hsic / (N * (N - 3))
+        if mask is None:
+            return hsic / (N * (N - 3))
+        return hsic / torch.where(N > 0, N * (N - 3), torch.ones_like(N))
+
+    def low_rank_estimator(self, input1, input2, mask=None):
+        """Unbiased estimator for the kernels K = Phi Phi^T and L = Psi Psi^T of the
+        (N, D) feature matrices Phi and Psi; no N x N matrix is formed.
+        """
+        Phi = self._features_x(input1, mask)
+        Psi = self._features_y(input2, mask)
+        if mask is None:
+            N = len(input1)
+        else:
+            w = mask.to(Phi.dtype).unsqueeze(1)
+            Phi = Phi * w
+            Psi = Psi * w
+            N = w.sum()
+
+        # the diagonals of K and L, which \tilde K and \tilde L leave out
+        dK = Phi.pow(2).sum(1)
+        dL = Psi.pow(2).sum(1)
+        sK = Phi.sum(0)
+        sL = Psi.sum(0)
+
+        hsic = (
+            (Phi.t() @ Psi).pow(2).sum() - dK.dot(dL)
+            + ((sK.dot(sK) - dK.sum()) * (sL.dot(sL) - dL.sum()) / (N - 1) / (N - 2))
+            - (2 * (Phi @ sK - dK).dot(Psi @ sL - dL) / (N - 2))
+        )
+
+        if mask is None:
+            return hsic / (N * (N - 3))
+        return hsic / torch.where(N > 0, N * (N - 3), torch.ones_like(N))
+
+    def block_estimator(self, input1, input2, mask=None):
+        """Mean of the unbiased estimates on consecutive blocks of block_size rows
+        (Zhang, Qinyi, et al. "Large-scale kernel methods for independence testing." 2018.)
+        Blocks with fewer than 4 (masked) rows are left out.
+        """
+        # (n_blocks, block_size, block_size), the last block is padded
+        K = self._block_kernel_x(input1, mask)
+        L = self._block_kernel_y(input2, mask)
+        n_blocks, block_size = K.shape[:2]
+
+        w = torch.ones(len(input1), device=K.device) if mask is None else mask.to(K.dtype)
+        w = F.pad(w, (0, n_blocks * block_size - len(w))).view(n_blocks, block_size)
+        W = w.unsqueeze(2) * w.unsqueeze(1)
+        tK = (K - K.diagonal(dim1=1, dim2=2).unsqueeze(1)) * W
+        tL = (L - L.diagonal(dim1=1, dim2=2).unsqueeze(1)) * W
+
+        N = w.sum(1)
+        valid = N > 3
+        N = torch.where(valid, N, torch.full_like(N, 4))
+        hsic = (
+            (tK * tL.transpose(1, 2)).sum((1, 2))
+            + (tK.sum((1, 2)) * tL.sum((1, 2)) / (N - 1) / (N - 2))
+            - (2 * (tK.sum(1) * tL.sum(1)).sum(1) / (N - 2))
+        )
+        hsic = torch.where(valid, hsic / (N * (N - 3)), torch.zeros_like(hsic))
+        return hsic.sum() / valid.sum().clamp(min=1)
 
     def forward(self, input1, input2, **kwargs):
         return self.estimator(input1, input2)
@@ -100,7 +201,7 @@ class HSIC(nn.Module):
 class RbfHSIC(HSIC):
     """Radial Basis Function (RBF) kernel HSIC implementation.
     """
-    def _kernel(self, X, sigma):
+    def _kernel(self, X, sigma, mask=None):
         if not self.nlp_flag:
             X = X.view(len(X), -1)
             Xn = X.norm(2, dim=1, keepdim=True)
@@ -109,7 +210,14 @@ class RbfHSIC(HSIC):
             X_sqnorms = torch.diag(XX)
             X_L2 = -2 * XX + X_sqnorms.unsqueeze(1) + X_sqnorms.unsqueeze(0)
             X_L2 = X_L2.clamp(1e-12)
-            sigma_avg = X_L2.mean().detach()
+            if mask is None:
+                sigma_avg = X_L2.mean().detach()
+            else:
+                # the mean distance between the masked rows; 1 for an empty mask keeps the gradients finite
+                w = mask.to(X_L2.dtype)
+                n_pairs = w.sum() ** 2
+                sigma_avg = (w @ X_L2 @ w / n_pairs.clamp(min=1)).detach()
+                sigma_avg = torch.where(n_pairs > 0, sigma_avg, torch.ones_like(sigma_avg))
 
             gamma = 1/(2*sigma_avg)
     #        gamma = 1 / (2 * sigma ** 2)
@@ -124,11 +232,78 @@ class RbfHSIC(HSIC):
             kernel_XX = torch.matmul(X, X.t()).pow(2)
         return kernel_XX
 
-    def _kernel_x(self, X):
-        return self._kernel(X, self.sigma_x)
+    def _kernel_x(self, X, mask=None):
+        return self._kernel(X, self.sigma_x, mask)
+
+    def _kernel_y(self, Y, mask=None):
+        return self._kernel(Y, self.sigma_y, mask)
+
+    @staticmethod
+    def _unit_rows(X):
+        X = X.view(len(X), -1)
+        return X.div(X.norm(2, dim=1, keepdim=True))
+
+    @staticmethod
+    def _bandwidth(X, mask=None):
+        # mean squared distance between the (masked) unit rows, 2 - 2 |mean row|^2, in O(N)
+        w = torch.ones(len(X), device=X.device) if mask is None else mask.to(X.dtype)
+        n = w.sum()
+        mean = (w @ X) / n.clamp(min=1)
+        sigma_avg = (2 - 2 * mean.pow(2).sum()).clamp(min=1e-12).detach()
+        return torch.where(n > 0, sigma_avg, torch.ones_like(sigma_avg))
+
+    def _cross_kernel(self, A, B, sigma_avg):
+        # kernel between the unit rows of A and B (batched over leading dimensions)
+        AB = A @ B.transpose(-1, -2)
+        if self.nlp_flag:
+            return AB.pow(2)
+        return torch.exp(-(2 - 2 * AB).clamp(1e-12) / (2 * sigma_avg))
+
+    def _features(self, X, mask=None):
+        X = self._unit_rows(X)
+        sigma_avg = self._bandwidth(X, mask)
+        if self.algorithm == 'rff':
+            if self.nlp_flag:
+                raise ValueError('random Fourier features need the rbf kernel, use nystrom')
+            # k(x, y) = exp(-|x - y|^2 / (2 sigma_avg)) has the frequencies N(0, I / sigma_avg)
+            W, b = self._random_features(X.shape[1], X.device)
+            return (2 / self.n_features) ** 0.5 * torch.cos(X @ W / sigma_avg.sqrt() + b)
+
+        # Nystrom: the first rows of the shuffled batch are the landmarks, K_nm K_mm^{-1/2}
+        landmarks = X[:self.n_features].detach()
+        with torch.no_grad():
+            eigvals, eigvecs = torch.linalg.eigh(self._cross_kernel(landmarks, landmarks, sigma_avg))
+            keep = eigvals > 1e-6 * eigvals.max()
+            proj = eigvecs * torch.where(keep, eigvals.clamp(min=1e-12).rsqrt(), torch.zeros_like(eigvals))
+        return self._cross_kernel(X, landmarks, sigma_avg) @ proj
+
+    def _random_features(self, dim, device):
+        # drawn once, each batch rescales them to its bandwidth
+        if getattr(self, 'random_features', None) is None or self.random_features[0].shape[0] != dim:
+            generator = torch.Generator().manual_seed(self.seed)
+            W = torch.randn(dim, self.n_features, generator=generator)
+            b = 2 * math.pi * torch.rand(self.n_features, generator=generator)
+            self.random_features = (W.to(device), b.to(device))
+        return self.random_features
+
+    def _block_kernel(self, X, mask=None):
+        X = self._unit_rows(X)
+        sigma_avg = self._bandwidth(X, mask)
+        n_blocks = math.ceil(len(X) / self.block_size)
+        X = F.pad(X, (0, 0, 0, n_blocks * self.block_size - len(X))).view(n_blocks, self.block_size, -1)
+        return self._cross_kernel(X, X, sigma_avg)
+
+    def _features_x(self, X, mask=None):
+        return self._features(X, mask)
+
+    def _features_y(self, Y, mask=None):
+        return self._features(Y, mask)
+
+    def _block_kernel_x(self, X, mask=None):
+        return self._block_kernel(X, mask)
 
-    def _kernel_y(self, Y):
-        return self._kernel(Y, self.sigma_y)
+    def _block_kernel_y(self, Y, mask=None):
+        return self._block_kernel(Y, mask)
 
 
 class MinusRbfHSIC(RbfHSIC):
@@ -1,12 +1,15 @@
 from __future__ import print_function
 import torch
 import time
-from utils import get_accuracy
+from utils import get_accuracy, subgroup_mean
 import trainer
-from torch.utils.data import DataLoader
+from trainer.fairness_stats import confusion_tensor, accuracy, dp_violations, dca_violations
+from data_handler.dataloader_factory import DataloaderFactory
 
 
 class Trainer(trainer.GenericTrainer):
+    checkpoint_attrs = ('extended_multipliers', 'weight_matrix', 'weight_update_count')
+
     def __init__(self, args, **kwargs):
         super().__init__(args=args, **kwargs)
         self.train_criterion = torch.nn.CrossEntropyLoss(reduction='none')
@@ -26,15 +29,19 @@ class Trainer(trainer.GenericTrainer):
         n_iters = self.iteration
         print('n_iters : ', n_iters)
         violations = 0
+        self.resume(train_loader)
         for iter_ in range(n_iters):
             start_t = time.time()
 
             if self.data == 'jigsaw':
                 assert n_iters == 1
                 self.weight_update_term = 100
-                self.weight_update_count = 0
+                if not self.finished(iter_, -1):
+                    self.weight_update_count = 0
 
             for epoch in range(epochs):
+                if self.finished(iter_, epoch):
+                    continue
                 self._train_epoch(epoch, train_loader, model)
                 
                 eval_start_time = time.time()                
@@ -54,23 +61,21 @@ class Trainer(trainer.GenericTrainer):
                        eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
 
                 if self.record:
-                    self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                                  train=True, 
-                                  record=self.record,
-                                  writer=writer
-                                 )
+                    self.record_train(train_loader, epoch, writer)
 
                 if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
                     self.scheduler.step(eval_loss)
                 else:
                     self.scheduler.step()
+
+                self.save_checkpoint(train_loader, iter_, epoch)
                     
             end_t = time.time()
             train_t = int((end_t - start_t) / 60)
             print('Training Time : {} hours {} minutes / iter : {}/{}'.format(int(train_t / 60), (train_t % 60),
                                                                               (iter_ + 1), n_iters))
             
-            if self.data != 'jigsaw':
+            if self.data != 'jigsaw' and not self.finished(iter_, epochs):
                 # get statistics
                 pred_set, y_set, s_set = self.get_statistics(train_loader.dataset, bs=self.bs,
                                                                      n_workers=self.n_workers, model=model)
@@ -86,6 +91,7 @@ class Trainer(trainer.GenericTrainer):
 
     def _train_epoch(self, epoch, train_loader, model):
         model.train()
+        self.start_train_record(train_loader)
 
         running_acc = 0.0
         running_loss = 0.0
@@ -105,41 +111,36 @@ class Trainer(trainer.GenericTrainer):
 
             weights = self.weight_matrix[groups, labels]
 
-            if self.cuda:
-                inputs = inputs.cuda()
-                labels = labels.cuda()
-                weights = weights.cuda()
-                groups = groups.cuda()
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            weights = weights.to(self.device)
+            groups = groups.to(self.device)
                 
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                )[1] 
-            else:
-                outputs = model(inputs)
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                    )[1] 
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
                 
             if self.balanced:
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_count = group_map.sum(1)
-                group_denom = group_count + (group_count==0).float() # avoid nans
                 loss = self.train_criterion(outputs, labels)
-                group_loss = (group_map @ loss.view(-1))/group_denom
-                weights = self.weight_matrix.flatten().cuda()
+                group_loss = subgroup_mean(loss, subgroups, n_subgroups)
+                weights = self.weight_matrix.flatten().to(self.device)
                 loss = torch.mean(group_loss*weights)
             else:
                 loss = torch.mean(weights * self.train_criterion(outputs, labels))
 
-            loss.backward()
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
             
             if self.data == 'jigsaw':
@@ -157,8 +158,9 @@ class Trainer(trainer.GenericTrainer):
                     self.extended_multipliers -= self.eta * violations 
                     self.weight_matrix = self.get_weight_matrix(self.extended_multipliers) 
 
-            running_loss += loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += loss.detach()
+            self.track_train(outputs, labels, groups)
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
 
             batch_end_time = time.time()
             avg_batch_time += batch_end_time - batch_start_time
@@ -174,28 +176,26 @@ class Trainer(trainer.GenericTrainer):
                 avg_batch_time = 0.0
 
     def get_statistics(self, dataset, bs=128, n_workers=2, model=None):
+        # sen_attrs = -1 means no supervision for sensitive group
+        y_set = torch.from_numpy(dataset.get_label_array())
+        s_set = torch.from_numpy(dataset.get_group_array())
+        if model is None:
+            return torch.zeros(0).long(), y_set.long().to(self.device), s_set.long().to(self.device)
 
-        dataloader = DataLoader(dataset, batch_size=bs, shuffle=False,
-                                num_workers=n_workers, pin_memory=True, drop_last=False)
-
-        if model != None:
-            model.eval()
+        dataloader = DataloaderFactory.get_loader(dataset, batch_size=bs, shuffle=False,
+                                                  num_workers=n_workers, pin_memory=True, drop_last=False)
+        model.eval()
 
         pred_set = []
-        y_set = []
-        s_set = []
         total = 0
         with torch.no_grad():
             for i, data in enumerate(dataloader):
                 inputs, _, sen_attrs, targets, _ = data
-                y_set.append(targets) # sen_attrs = -1 means no supervision for sensitive group
-                s_set.append(sen_attrs)
 
-                if self.cuda:
-                    inputs = inputs.cuda()
-                    targets = targets.cuda()
+                inputs = inputs.to(self.device)
+                targets = targets.to(self.device)
 
-                if model != None:
+                with self.autocast():
                     if self.data == 'jigsaw':
                         input_ids = inputs[:, :, 0]
                         input_masks = inputs[:, :, 1]
@@ -208,40 +208,25 @@ class Trainer(trainer.GenericTrainer):
                         )[1] 
                     else:
                         outputs = model(inputs)
-                    pred_set.append(torch.argmax(outputs, dim=1))
+                outputs = outputs.float()
+                pred_set.append(torch.argmax(outputs, dim=1))
                 total+= inputs.shape[0]
 
-        y_set = torch.cat(y_set)
-        s_set = torch.cat(s_set)
-        pred_set = torch.cat(pred_set) if len(pred_set) != 0 else torch.zeros(0)
-        return pred_set.long(), y_set.long().cuda(), s_set.long().cuda()
+        pred_set = torch.cat(pred_set)
+        return pred_set.long(), y_set.long().to(self.device), s_set.long().to(self.device)
     
-    # Vectorized version for DP & multi-class
+    # DP & multi-class, from the (group, label, prediction) confusion tensor
     def get_error_and_violations_DP(self, y_pred, label, sen_attrs, n_groups, n_classes):
-        acc = torch.mean(y_pred == label)
-        total_num = len(y_pred)
-        violations = torch.zeros((n_groups, n_classes))
-
-        for g in range(n_groups):
-            for c in range(n_classes):
-                pivot = len(torch.where(y_pred==c)[0])/total_num
-                group_idxs=torch.where(sen_attrs == g)[0]
-                group_pred_idxs = torch.where(torch.logical_and(sen_attrs == g, y_pred == c))[0]
-                violations[g, c] = len(group_pred_idxs)/len(group_idxs) - pivot
+        confusion = confusion_tensor(y_pred, label, sen_attrs, n_groups, n_classes)
+        acc = accuracy(confusion).float()
+        violations = dp_violations(confusion).float().cpu()
         return acc, violations
 
-    # Vectorized version for DCA & multi-class
+    # DCA & multi-class, from the (group, label, prediction) confusion tensor
     def get_error_and_violations_DCA(self, y_pred, label, sen_attrs, n_groups, n_classes):
-        acc = torch.mean((y_pred == label).float())
-        violations = torch.zeros((n_groups, n_classes)) 
-        for g in range(n_groups):
-            for c in range(n_classes):
-                class_idxs = torch.where(label==c)[0]
-                pred_class_idxs = torch.where(torch.logical_and(y_pred == c, label == c))[0]
-                pivot = len(pred_class_idxs)/len(class_idxs)
-                group_class_idxs=torch.where(torch.logical_and(sen_attrs == g, label == c))[0]
-                group_pred_class_idxs = torch.where(torch.logical_and(torch.logical_and(sen_attrs == g, y_pred == c), label == c))[0]
-                violations[g, c] = len(group_pred_class_idxs)/len(group_class_idxs) - pivot
+        confusion = confusion_tensor(y_pred, label, sen_attrs, n_groups, n_classes)
+        acc = accuracy(confusion).float()
+        violations = dca_violations(confusion).float().cpu()
         print('violations',violations)
         return acc, violations
     
@@ -0,0 +1,135 @@
+import os
+import csv
+import json
+import queue
+import threading
+import torch
+
+
+class TensorBoardBackend:
+    def __init__(self, path):
+        from tensorboardX import SummaryWriter
+        self.writer = SummaryWriter(path)
+
+    def write(self, tag, values, step):
+        if isinstance(values, dict):
+            self.writer.add_scalars(tag, values, step)
+        else:
+            self.writer.add_scalar(tag, values, step)
+
+    def close(self):
+        self.writer.close()
+
+
+class JsonlBackend:
+    # one line per add_scalar / add_scalars call: {"tag", "step", "value" or "values"}
+    def __init__(self, path):
+        self.f = open(path + '.jsonl', 'a')
+
+    def write(self, tag, values, step):
+        key = 'values' if isinstance(values, dict) else 'value'
+        self.f.write(json.dumps({'tag': tag, 'step': step, key: values}) + '\n')
+
+    def close(self):
+        self.f.close()
+
+
+class CsvBackend:
+    # one row per scalar; the scalars of add_scalars are tagged <main tag>/<key>
+    def __init__(self, path):
+        new = not os.path.exists(path + '.csv')
+        self.f = open(path + '.csv', 'a', newline='')
+        self.writer = csv.writer(self.f)
+        if new:
+            self.writer.writerow(['tag', 'step', 'value'])
+
+    def write(self, tag, values, step):
+        if isinstance(values, dict):
+            self.writer.writerows([('{}/{}'.format(tag, k), step, v) for k, v in values.items()])
+        else:
+            self.writer.writerow((tag, step, values))
+
+    def close(self):
+        self.f.close()
+
+
+backends = {'tensorboard': TensorBoardBackend, 'jsonl': JsonlBackend, 'csv': CsvBackend}
+
+
+class MetricsWriter:
+    """
+    Drop-in for the add_scalar/add_scalars/close part of SummaryWriter.
+    Values may be device tensors: they are only copied on the device when added,
+    and all values of a step are moved to the host with a single transfer once a
+    record of a new step arrives (or on flush/close). The host values are
+    written by a background thread, so a record costs one sync per epoch.
+    """
+    def __init__(self, path, backend='tensorboard'):
+        self.backend = backends[backend](path)
+        self.pending = []
+        self.step = None
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            records = self.queue.get()
+            if records is None:
+                break
+            try:
+                for tag, values, step in records:
+                    self.backend.write(tag, values, step)
+            except Exception as e:
+                self.error = e
+
+    def _add(self, tag, keys, values, step):
+        if self.step is not None and step != self.step:
+            self.flush()
+        self.step = step
+        tensors = [v for v in values if torch.is_tensor(v)]
+        if tensors:
+            # one copy per call, so later in-place updates of the logged tensors do not leak in
+            device = tensors[0].device
+            values = torch.stack([torch.as_tensor(v, device=device).detach().float().reshape(()) for v in values])
+        else:
+            values = [float(v) for v in values]
+        self.pending.append((tag, keys, values, step))
+
+    def add_scalar(self, tag, value, step):
+        self._add(tag, None, [value], step)
+
+    def add_scalars(self, main_tag, values, step):
+        self._add(main_tag, list(values.keys()), list(values.values()), step)
+
+    def flush(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        if not self.pending:
+            return
+        pending, self.pending, self.step = self.pending, [], None
+        # the tensors of all records, grouped by device, come to the host in one transfer per device
+        host = {}
+        for device in {values.device for _, _, values, _ in pending if torch.is_tensor(values)}:
+            tensors = [values for _, _, values, _ in pending if torch.is_tensor(values) and values.device == device]
+            host[device] = iter(torch.cat(tensors).cpu().split([len(t) for t in tensors]))
+        records = []
+        for tag, keys, values, step in pending:
+            if torch.is_tensor(values):
+                values = next(host[values.device]).tolist()
+            if keys is None:
+                records.append((tag, values[0], step))
+            else:
+                records.append((tag, dict(zip(keys, values)), step))
+        self.queue.put(records)
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.backend.close()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
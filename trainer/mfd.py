@@ -5,8 +5,9 @@ import torch.nn.functional as F
 import torch.nn as nn
 import time
 import numpy as np
-from utils import get_accuracy
+from utils import get_accuracy, get_device
 import trainer
+from trainer.teacher_cache import TeacherCache
 
 
 class Trainer(trainer.GenericTrainer):
@@ -14,17 +15,33 @@ class Trainer(trainer.GenericTrainer):
         super().__init__(args=args, **kwargs)
         self.teacher = teacher
         self.lamb = args.lamb
-        self.t_device = args.t_device 
+        self.t_device = get_device(args, teacher=True)
         self.sigma = args.sigma
         self.kernel = args.kernel
+        self.mmd_features = args.mmd_features
+        self.teacher_path = args.teacher_path
+        self.teacher_cache = args.teacher_cache
+        self.teacher_cache_views = args.teacher_cache_views
+        self.feature_cache = None
         
     def train(self, train_loader, test_loader, epochs, writer=None):
         n_classes = train_loader.dataset.n_classes
         n_groups = train_loader.dataset.n_groups
 
         distiller = MMDLoss(w_m=self.lamb, sigma=self.sigma,
-                            n_classes=n_classes, n_groups=n_groups, kernel=self.kernel)
+                            n_classes=n_classes, n_groups=n_groups, kernel=self.kernel,
+                            n_features=self.mmd_features, seed=self.seed)
+        if self.teacher_cache:
+            self.feature_cache = TeacherCache.open_or_build(
+                lambda inputs, labels: self._teacher_features(self.teacher, inputs, labels),
+                self.teacher_path, train_loader.dataset, self.t_device, views=self.teacher_cache_views,
+                seed=self.seed, batch_size=self.bs, n_workers=self.n_workers)
+            # training only reads the cache, so the teacher can leave the gpu
+            self.teacher.cpu()
+        self.resume(train_loader)
         for epoch in range(self.epochs):
+            if self.finished(epoch):
+                continue
             self._train_epoch(epoch, train_loader, self.model, self.teacher, distiller=distiller)
 
             eval_start_time = time.time()                
@@ -43,21 +60,20 @@ class Trainer(trainer.GenericTrainer):
                    eval_loss, eval_acc, eval_deom, (eval_end_time - eval_start_time)))
 
             if self.record:
-                self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                              train=True, 
-                              record=self.record,
-                              writer=writer
-                             )
+                self.record_train(train_loader, epoch, writer)
             
             if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
                 self.scheduler.step(eval_loss)
             else:
                 self.scheduler.step()
 
+            self.save_checkpoint(train_loader, epoch)
+
         print('Training Finished!')
 
     def _train_epoch(self, epoch, train_loader, model, teacher, distiller=None):
         model.train()
+        self.start_train_record(train_loader)
         teacher.eval()
 
         running_acc = 0.0
@@ -67,59 +83,46 @@ class Trainer(trainer.GenericTrainer):
             # Get the inputs
             inputs, _, groups, targets, idx = data
             labels = targets
-            if self.cuda:
-                inputs = inputs.cuda(self.device)
-                labels = labels.cuda(self.device)
-                groups = groups.long().cuda(self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.long().to(self.device)
             
-            t_inputs = inputs.to(self.t_device)
-            
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                    output_hidden_states=True
-                )
-                stu_logits = outputs[1]
-                f_s = outputs[2][0][:,0,:]
-                with torch.no_grad():
-                    t_outputs = model(
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
                         input_ids=input_ids,
                         attention_mask=input_masks,
                         token_type_ids=segment_ids,
                         labels=labels,
                         output_hidden_states=True
                     )
-                    # tea_logits = t_outputs[1]
-                    f_t = t_outputs[2][0][:,0,:]
+                    stu_logits = outputs[1]
+                    f_s = outputs[2][0][:,0,:]
+                else:
+                    outputs = model(inputs, get_inter=True)
+                    stu_logits = outputs[-1]
+                    f_s = outputs[-2]
 
+            if self.feature_cache is not None:
+                f_t = self.feature_cache.lookup(idx, self.device)
             else:
-                outputs = model(inputs, get_inter=True)
-                stu_logits = outputs[-1]
-                f_s = outputs[-2]
-                with torch.no_grad():
-                    t_outputs = teacher(t_inputs, get_inter=True)
-                    # tea_logits = t_outputs[-1]
-                    f_t = t_outputs[-2].detach()
-
+                f_t = self._teacher_features(teacher, inputs.to(self.t_device), labels.to(self.t_device))
+                f_t = f_t.to(self.device)
+            stu_logits, f_s, f_t = stu_logits.float(), f_s.float(), f_t.float()
 
             loss = self.criterion(stu_logits, labels).mean()
             mmd_loss = distiller.forward(f_s, f_t, groups=groups, labels=labels)
             loss = loss + mmd_loss 
             
-            loss.backward()
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
                 
-            running_acc += get_accuracy(stu_logits, labels)
-            running_loss += loss.item()
+            self.track_train(stu_logits, labels, groups)
+            running_acc += get_accuracy(stu_logits, labels, reduction='none').mean()
+            running_loss += loss.detach()
             if i % self.term == self.term - 1:  # print every self.term mini-batches
                 avg_batch_time = time.time() - batch_start_time
                 print('[{}/{}, {:5d}] Method: {} Train Loss: {:.3f} Train Acc: {:.2f} '
@@ -131,15 +134,40 @@ class Trainer(trainer.GenericTrainer):
                 running_acc = 0.0
                 batch_start_time = time.time()
 
+    def _teacher_features(self, teacher, inputs, labels):
+        # the features of the teacher that the student features are matched to
+        with torch.no_grad(), self.autocast():
+            if self.data == 'jigsaw':
+                t_outputs = teacher(
+                    input_ids=inputs[:, :, 0],
+                    attention_mask=inputs[:, :, 1],
+                    token_type_ids=inputs[:, :, 2],
+                    labels=labels,
+                    output_hidden_states=True
+                )
+                return t_outputs[2][0][:,0,:]
+            t_outputs = teacher(inputs, get_inter=True)
+            return t_outputs[-2]
+
             
 class MMDLoss(nn.Module):
-    def __init__(self, w_m, sigma, n_groups, n_classes, kernel):
+    """
+    Sum over (class, group) of the MMD between the teacher features of the class and
+    the student features of the (class, group) subgroup. All subgroups are reduced
+    from whole-batch kernels with one-hot masks. With n_features > 0, the rbf kernel
+    is approximated by that many random Fourier features, which is linear instead
+    of quadratic in the batch size.
+    """
+    def __init__(self, w_m, sigma, n_groups, n_classes, kernel, n_features=0, seed=0):
         super(MMDLoss, self).__init__()
         self.w_m = w_m
         self.sigma = sigma
         self.n_groups = n_groups
         self.n_classes = n_classes
         self.kernel = kernel
+        self.n_features = n_features
+        self.seed = seed
+        self.random_features = None
 
     def forward(self, f_s, f_t, groups, labels):
         if self.kernel == 'poly':
@@ -149,28 +177,62 @@ class MMDLoss(nn.Module):
             student = f_s.view(f_s.shape[0], -1)
             teacher = f_t.view(f_t.shape[0], -1)
 
-        mmd_loss = 0
-        with torch.no_grad():
-            _, sigma_avg = self.pdist(teacher, student, sigma_base=self.sigma, kernel=self.kernel)
+        # (batch, n_classes) and (batch, n_groups * n_classes) masks, the subgroup of (g, c) is g * n_classes + c
+        class_mask = F.one_hot(labels, self.n_classes).to(student.dtype)
+        subgroup_mask = F.one_hot(groups * self.n_classes + labels, self.n_groups * self.n_classes).to(student.dtype)
+        n_t = class_mask.sum(0).repeat(self.n_groups)
+        n_s = subgroup_mask.sum(0)
 
-        for c in range(self.n_classes):
-            if len(teacher[labels==c]) == 0:
-                continue
-            for g in range(self.n_groups):
-                if len(student[(labels==c) * (groups == g)]) == 0:
-                    continue
-                K_TS, _ = self.pdist(teacher[labels == c], student[(labels == c) * (groups == g)],
-                                                sigma_base=self.sigma, sigma_avg=sigma_avg,  kernel=self.kernel)
-                K_SS, _ = self.pdist(student[(labels == c) * (groups == g)], student[(labels == c) * (groups == g)],
-                                        sigma_base=self.sigma, sigma_avg=sigma_avg, kernel=self.kernel)
-
-                K_TT, _ = self.pdist(teacher[labels == c], teacher[labels == c], sigma_base=self.sigma,
-                                        sigma_avg=sigma_avg, kernel=self.kernel)
-
-                mmd_loss += K_TT.mean() + K_SS.mean() - 2 * K_TS.mean()
+        if self.n_features > 0:
+            mmd = self._rff_mmd(student, teacher, class_mask, subgroup_mask, n_t, n_s)
+        else:
+            mmd = self._kernel_mmd(student, teacher, class_mask, subgroup_mask, n_t, n_s)
+
+        # empty subgroups add 0
+        mmd_loss = torch.where(n_s > 0, mmd, torch.zeros_like(mmd)).sum()
         loss = (1/2) * self.w_m * mmd_loss
         return loss
 
+    def _kernel_mmd(self, student, teacher, class_mask, subgroup_mask, n_t, n_s):
+        # one teacher-student block per batch, its mean distance is the rbf bandwidth
+        K_TS, sigma_avg = self.pdist(teacher, student, sigma_base=self.sigma, kernel=self.kernel)
+        K_SS, _ = self.pdist(student, student, sigma_base=self.sigma, sigma_avg=sigma_avg, kernel=self.kernel)
+        with torch.no_grad():
+            K_TT, _ = self.pdist(teacher, teacher, sigma_base=self.sigma, sigma_avg=sigma_avg, kernel=self.kernel)
+            # the teacher term only depends on the class, so it is computed once per class
+            tt = ((K_TT @ class_mask) * class_mask).sum(0) / (class_mask.sum(0) ** 2).clamp(min=1)
+
+        # column g * n_classes + c of the teacher mask selects class c
+        teacher_mask = class_mask.repeat(1, self.n_groups)
+        ss = ((K_SS @ subgroup_mask) * subgroup_mask).sum(0) / (n_s ** 2).clamp(min=1)
+        ts = ((K_TS @ subgroup_mask) * teacher_mask).sum(0) / (n_t * n_s).clamp(min=1)
+        return tt.repeat(self.n_groups) + ss - 2 * ts
+
+    def _rff_mmd(self, student, teacher, class_mask, subgroup_mask, n_t, n_s):
+        with torch.no_grad():
+            # the mean squared teacher-student distance of pdist, in O(batch)
+            sigma_avg = (teacher.pow(2).sum(1).mean() + student.pow(2).sum(1).mean()
+                         - 2 * teacher.mean(0) @ student.mean(0)).clamp(min=1e-12)
+        W, b = self._get_random_features(student.shape[1], student.device)
+        W = W * (self.sigma * sigma_avg).rsqrt()
+        scale = (2 / self.n_features) ** 0.5
+        phi_s = scale * torch.cos(student @ W + b)
+        with torch.no_grad():
+            phi_t = scale * torch.cos(teacher @ W + b)
+            # per-class teacher mean embeddings, shared by the groups of the class
+            mu_t = (class_mask.t() @ phi_t) / class_mask.sum(0).clamp(min=1).unsqueeze(1)
+        mu_s = (subgroup_mask.t() @ phi_s) / n_s.clamp(min=1).unsqueeze(1)
+        return (mu_t.repeat(self.n_groups, 1) - mu_s).pow(2).sum(1)
+
+    def _get_random_features(self, dim, device):
+        # drawn once, the bandwidth of each batch rescales the frequencies
+        if self.random_features is None or self.random_features[0].shape[0] != dim:
+            generator = torch.Generator().manual_seed(self.seed)
+            W = torch.randn(dim, self.n_features, generator=generator)
+            b = 2 * np.pi * torch.rand(self.n_features, generator=generator)
+            self.random_features = (W.to(device), b.to(device))
+        return self.random_features
+
     @staticmethod
     def pdist(e1, e2, eps=1e-12, kernel='rbf', sigma_base=1.0, sigma_avg=None):
         if len(e1) == 0 or len(e2) == 0:
@@ -2,38 +2,34 @@ from __future__ import print_function
 from collections import defaultdict
 
 import time
-from utils import get_accuracy, get_subgroup_accuracy
+from utils import get_accuracy, get_subgroup_accuracy, subgroup_mean, subgroup_stats
 import trainer
 import torch
 import torch.nn as nn
 import numpy as np
-from torch.utils.data import DataLoader
+from data_handler.dataloader_factory import DataloaderFactory
 
 class Trainer(trainer.GenericTrainer):
+    checkpoint_attrs = ('M',)
+
     def __init__(self, args, **kwargs):
         super().__init__(args=args, **kwargs)
         self.epsilon = args.epsilon+1
         self.lamblr = args.lamblr # learning rate of adv_probs
         self.train_criterion = torch.nn.CrossEntropyLoss(reduction='none')
-        self.hinge_loss = torch.nn.MultiMarginLoss()
+        self.hinge_loss = torch.nn.MultiMarginLoss(reduction='none')
         self.fairness_criterion = args.fairness_criterion
         
     def stationary_distribution(self, M):
-#         transition_matrix_transp = transition_matrix.T
-        mat = np.array(M)
-        eigenvals, eigenvects = np.linalg.eig(M)
-        '''
-        Find the indexes of the eigenvalues that are close to one.
-        Use them to select the target eigen vectors. Flatten the result.
-        '''
-        close_to_1_idx = np.isclose(eigenvals,1)
-        target_eigenvect = eigenvects[:,close_to_1_idx]
-        target_eigenvect = target_eigenvect[:,0]
-        # Turn the eigenvector elements into probabilites
-        stationary_distrib = target_eigenvect / sum(target_eigenvect) 
-        stationary_distrib = stationary_distrib.real
-        
-        return torch.tensor(stationary_distrib).cuda()
+        # M is column stochastic with positive entries, so its stationary distribution p is the
+        # unique solution of (M - I) p = 0 with sum(p) = 1; one row of the singular system is
+        # replaced by the normalization and the system is solved on the device
+        n = M.shape[0]
+        A = M.double() - torch.eye(n, dtype=torch.float64, device=M.device)
+        A[0] = 1
+        b = torch.zeros(n, dtype=torch.float64, device=M.device)
+        b[0] = 1
+        return torch.linalg.solve(A, b).to(M.dtype)
     
     # def eo_constraints(self, outputs, labels, groups):
     #     tnr_group0_mask = ((1-labels) * (1-groups)) == 1
@@ -59,33 +55,22 @@ class Trainer(trainer.GenericTrainer):
     #     return (g0,g1,g2,g3)
     
     def dca_constraints(self, outputs, labels, groups, n_classes, n_groups):
-        constraints = []
-        for l in range(n_classes):
-            loss_list = []
-            flipped_loss_list = []
-            label_mask = (labels == l).float()
-            for g in range(n_groups):
-                mask = (label_mask * (groups == g).float()).bool()
-                if mask.sum() == 0:
-                    loss_list.append(None)
-                    flipped_loss_list.append(None)
-                else:
-                    loss_list.append(self.hinge_loss(outputs[mask], labels[mask]))
-                    flipped_loss_list.append(self.hinge_loss(-1 * outputs[mask], labels[mask]))
-
-            for g in range(n_groups-1):
-                loss_a = loss_list[g]
-                loss_b = loss_list[g+1]
-                flipped_loss_a = flipped_loss_list[g]
-                flipped_loss_b = flipped_loss_list[g+1]
+        # hinge losses of outputs and -outputs in one call, reduced to (n_groups, n_classes, 2)
+        # subgroup means with one scatter; a constraint is 0 if one of its two subgroups is not
+        # in the batch, which needs no host sync
+        n_subgroups = n_classes * n_groups
+        subgroups = groups * n_classes + labels
+        hinge = self.hinge_loss(torch.cat((outputs, -outputs)), labels.repeat(2)).view(2, -1).t()
+        count, _, losses = subgroup_stats(hinge, subgroups, n_subgroups)
+        count = count.view(n_groups, n_classes)
+        losses, flipped_losses = losses.view(n_groups, n_classes, 2).unbind(-1)
 
-                if loss_a == None or loss_b == None:
-                    constraints.extend([0,0])
-                else:
-                    constraints.append(loss_a + flipped_loss_b - self.epsilon)
-                    constraints.append(flipped_loss_a + loss_b - self.epsilon)
-            
-        return constraints
+        # constraints of the adjacent groups (g, g+1) of every class, ordered by class, then group
+        present = (count[:-1] > 0) & (count[1:] > 0)
+        constraints = torch.stack((losses[:-1] + flipped_losses[1:] - self.epsilon,
+                                   flipped_losses[:-1] + losses[1:] - self.epsilon), dim=-1)
+        constraints = torch.where(present.unsqueeze(-1), constraints, 0.)
+        return constraints.transpose(0, 1).flatten()
     
     # def ap_constraints(self, outputs, labels, groups, n_classes, n_groups):
     #     constraints = []
@@ -109,19 +94,14 @@ class Trainer(trainer.GenericTrainer):
     #     return constraints    
     
     def update_M_dca(self, station_dist, train_subgroup_acc, n_classes, n_groups):
-        constraints = []
-        for l in range(n_classes):
-            loss_list = []
-            for g in range(n_groups-1):
-                loss_a = 1-train_subgroup_acc[g,l]
-                loss_b = 1-train_subgroup_acc[g+1,l]
-                constraints.append(loss_a - loss_b - self.epsilon)
-                constraints.append(-loss_a + loss_b - self.epsilon)
-        constraints.insert(0,0)
+        # (n_groups-1, n_classes) differences of adjacent groups, ordered like dca_constraints:
+        # for each class and pair of groups, (a - b - eps, b - a - eps), after a 0 for the erm loss
+        loss = 1 - train_subgroup_acc
+        diff = (loss[:-1] - loss[1:]).t()
+        constraints = torch.stack((diff, -diff), dim=-1).flatten() - self.epsilon
+        constraints = torch.cat((constraints.new_zeros(1), constraints))
         
-        grad = torch.tensor(constraints).unsqueeze(1)
-        tmp = grad @ station_dist.cpu().unsqueeze(0)
-        grad = torch.exp(self.lamblr * tmp)
+        grad = torch.exp(self.lamblr * torch.outer(constraints, station_dist))
         self.M = self.M * grad
         self.M = self.M / self.M.sum(0)
 
@@ -145,25 +125,28 @@ class Trainer(trainer.GenericTrainer):
         model = self.model
         model.train()
         
-        self.normal_loader = DataLoader(train_loader.dataset, 
-                                        batch_size=128, 
-                                        shuffle=False, 
-                                        num_workers=2, 
-                                        pin_memory=True, 
-                                        drop_last=False)
+        self.normal_loader = DataloaderFactory.get_loader(train_loader.dataset, 
+                                                          batch_size=128, 
+                                                          shuffle=False, 
+                                                          num_workers=2, 
+                                                          pin_memory=True, 
+                                                          drop_last=False)
         
         n_classes = train_loader.dataset.n_classes
         n_groups = train_loader.dataset.n_groups
         
-        self.adv_probs = torch.ones(n_groups*n_classes).cuda() / n_groups*n_classes
+        self.adv_probs = torch.ones(n_groups*n_classes).to(self.device) / n_groups*n_classes
         if self.fairness_criterion == 'dca':
             n_constraints = n_classes * (n_groups-1) *2 + 1 # +1 for erm loss
         elif self.fairness_criterion == 'ap':
             n_constraints = (n_groups-1) * 2 + 1
-        self.M = torch.ones((n_constraints,n_constraints))/n_constraints
+        self.M = torch.ones((n_constraints,n_constraints), device=self.device)/n_constraints
         self.n_constraints = n_constraints
         
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
 
             self._train_epoch(epoch, train_loader, model, criterion)
             _, _, _, _, train_subgroup_acc, train_subgroup_loss = self.evaluate(self.model, self.normal_loader, self.train_criterion, 
@@ -189,21 +172,20 @@ class Trainer(trainer.GenericTrainer):
                    eval_loss, eval_acc, eval_deom, (eval_end_time - eval_start_time)))
 
             if self.record:
-                self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                              train=True, 
-                              record=self.record,
-                              writer=writer
-                             )
+                self.record_train(train_loader, epoch, writer)
                 
             if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
                 self.scheduler.step(eval_loss)
             else:
                 self.scheduler.step()
+
+            self.save_checkpoint(train_loader, epoch)
                   
         print('Training Finished!')        
 
     def _train_epoch(self, epoch, train_loader, model, criterion=None):
         model.train()
+        self.start_train_record(train_loader)
         
         running_acc = 0.0
         running_loss = 0.0
@@ -220,42 +202,37 @@ class Trainer(trainer.GenericTrainer):
             inputs, _, groups, targets, _ = data
             labels = targets
 
-            if self.cuda:
-                inputs = inputs.cuda(device=self.device)
-                labels = labels.cuda(device=self.device)
-                groups = groups.cuda(device=self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
                 
             subgroups = groups * n_classes + labels
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                )[1] 
-            else:
-                outputs = model(inputs)
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                    )[1] 
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
 
             if self.fairness_criterion == 'dca':
                 constraints_loss = self.dca_constraints(outputs, labels, groups, n_classes, n_groups)
             elif self.fairness_criterion == 'ap':
                 constraints_loss = self.ap_constraints(outputs, labels, groups, n_classes, n_groups)
             
-            tmp = 0
-            for i in range(self.n_constraints-1):
-                tmp += constraints_loss[i] * station_dist[i+1]
-            constraints_loss = tmp
+            constraints_loss = constraints_loss @ station_dist[1:]
             
             if self.balanced:
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_count = group_map.sum(1)
-                group_denom = group_count + (group_count==0).float() # avoid nans
                 loss = nn.CrossEntropyLoss(reduction='none')(outputs, labels)
-                group_loss = (group_map @ loss.view(-1))/group_denom
+                group_loss = subgroup_mean(loss, subgroups, n_subgroups)
                 loss = torch.mean(group_loss)
             else:
                 if criterion is not None:
@@ -265,18 +242,16 @@ class Trainer(trainer.GenericTrainer):
             
             loss = station_dist[0]*loss + constraints_loss 
             
-            loss.backward()
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
             train_subgroup_acc, train_group_acc = get_subgroup_accuracy(outputs, labels, groups, n_classes, n_groups)
             if self.fairness_criterion == 'dca':
                 self.update_M_dca(station_dist, train_subgroup_acc, n_classes, n_groups)
             elif self.fairness_criterion == 'ap':
                 self.update_M_ap(station_dist, train_group_acc, n_classes, n_groups)                
-            running_loss += loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += loss.detach()
+            self.track_train(outputs, labels, groups)
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
 
             if i % self.term == self.term-1: # print every self.term mini-batches
                 avg_batch_time = time.time()-batch_start_time
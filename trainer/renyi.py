@@ -3,12 +3,14 @@ import os
 import torch
 import torch.nn as nn
 import time
-from utils import get_accuracy
+from utils import get_accuracy, subgroup_mean
 import trainer
-from torch.utils.data import DataLoader
+from data_handler.dataloader_factory import DataloaderFactory
 
 
 class Trainer(trainer.GenericTrainer):
+    checkpoint_attrs = ('weights',)
+
     def __init__(self, args, **kwargs):
         super().__init__(args=args, **kwargs)
         
@@ -26,7 +28,10 @@ class Trainer(trainer.GenericTrainer):
         if self.fairness_criterion == 'dp':
             self.weights = torch.zeros((1, self.n_classes))
         
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
             self._train_epoch(epoch, train_loader, model, criterion)
             
             eval_start_time = time.time()
@@ -48,10 +53,9 @@ class Trainer(trainer.GenericTrainer):
                 outputs, groups, labels = [], [], []
                 for i, data in enumerate(test_loader):
                     inputs, _, group, target, idx = data
-                    if self.cuda:
-                        inputs = inputs.cuda(device=self.device)
-                        label = target.cuda(device=self.device)
-                        group = group.cuda(device=self.device)
+                    inputs = inputs.to(self.device)
+                    label = target.to(self.device)
+                    group = group.to(self.device)
                     output = self.model(inputs)
                     outputs.append(output)
                     groups.append(group)
@@ -68,6 +72,8 @@ class Trainer(trainer.GenericTrainer):
                 self.scheduler.step(eval_loss)
             else:
                 self.scheduler.step()
+
+            self.save_checkpoint(train_loader, epoch)
         print('Training Finished!')        
 
     def calculate_correlation(self, outputs, groups, labels, weights):
@@ -135,33 +141,31 @@ class Trainer(trainer.GenericTrainer):
             labels = targets.long()
             weights = self.weights
             
-            if self.cuda:
-                inputs = inputs.cuda(device=self.device)
-                labels = labels.cuda(device=self.device)
-                groups = groups.cuda(device=self.device)
-                weights = weights.cuda(device=self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
+            weights = weights.to(self.device)
                 
                 
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                )[1] 
-            else:
-                outputs = model(inputs)
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                    )[1] 
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
 
             if self.balanced:
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_count = group_map.sum(1)
-                group_denom = group_count + (group_count==0).float() # avoid nans
                 loss = nn.CrossEntropyLoss(reduction='none')(outputs, labels)
-                group_loss = (group_map @ loss.view(-1))/group_denom
+                group_loss = subgroup_mean(loss, subgroups, n_subgroups)
                 loss = torch.mean(group_loss)
             else:
                 if criterion is not None:
@@ -171,14 +175,11 @@ class Trainer(trainer.GenericTrainer):
             
             loss += self.lamb * self.calculate_correlation(outputs, groups, labels, weights)
             
-            loss.backward()
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
                 
-            running_loss += loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += loss.detach()
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
             
             if i % self.term == self.term-1: # print every self.term mini-batches
                 avg_batch_time = time.time()-batch_start_time
@@ -196,8 +197,8 @@ class Trainer(trainer.GenericTrainer):
     def update_weights(self, dataset, bs, n_workers, model, weights):  
         model.eval()
         
-        dataloader = DataLoader(dataset, batch_size=bs, shuffle=False,
-                                num_workers=n_workers, pin_memory=True, drop_last=False)
+        dataloader = DataloaderFactory.get_loader(dataset, batch_size=bs, shuffle=False,
+                                                  num_workers=n_workers, pin_memory=True, drop_last=False)
         
         
         Y_prob_set = []
@@ -210,29 +211,30 @@ class Trainer(trainer.GenericTrainer):
                 Y_set.append(targets) # sen_attrs = -1 means no supervision for sensitive group
                 S_set.append(sen_attrs)
 
-                if self.cuda:
-                    inputs = inputs.cuda()
-                    groups = sen_attrs.cuda()
-                    targets = targets.cuda()
+                inputs = inputs.to(self.device)
+                groups = sen_attrs.to(self.device)
+                targets = targets.to(self.device)
                 if model != None:
-                    if self.data == 'jigsaw':
-                        input_ids = inputs[:, :, 0]
-                        input_masks = inputs[:, :, 1]
-                        segment_ids = inputs[:, :, 2]
-                        outputs = model(
-                            input_ids=input_ids,
-                            attention_mask=input_masks,
-                            token_type_ids=segment_ids,
-                            labels=targets,
-                        )[1] 
-                    else:
-                        outputs = model(inputs)
+                    with self.autocast():
+                        if self.data == 'jigsaw':
+                            input_ids = inputs[:, :, 0]
+                            input_masks = inputs[:, :, 1]
+                            segment_ids = inputs[:, :, 2]
+                            outputs = model(
+                                input_ids=input_ids,
+                                attention_mask=input_masks,
+                                token_type_ids=segment_ids,
+                                labels=targets,
+                            )[1] 
+                        else:
+                            outputs = model(inputs)
+                    outputs = outputs.float()
                     output_probs = torch.nn.Softmax(dim=None)(outputs) # n by c
                     Y_prob_set.append(output_probs)
                 total+= inputs.shape[0]
 
-        Y_set = torch.cat(Y_set).long().cuda()
-        S_set = torch.cat(S_set).long().cuda()
+        Y_set = torch.cat(Y_set).long().to(self.device)
+        S_set = torch.cat(S_set).long().to(self.device)
         Y_prob_set = torch.cat(Y_prob_set) if len(Y_prob_set) != 0 else torch.zeros(0)
         
         
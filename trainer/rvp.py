@@ -3,7 +3,7 @@ from collections import defaultdict
 
 import copy
 import time
-from utils import get_accuracy
+from utils import get_accuracy, subgroup_mean
 import trainer
 import torch
 import numpy as np
@@ -24,7 +24,10 @@ class Trainer(trainer.GenericTrainer):
         model = self.model
         model.train()
 
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
             self._train_epoch(epoch, train_loader, model, criterion)            
             eval_start_time = time.time()
             eval_loss, eval_acc, eval_deom, eval_deoa, _, _  = self.evaluate(self.model, 
@@ -45,6 +48,8 @@ class Trainer(trainer.GenericTrainer):
                 self.scheduler.step(eval_loss)
             else:
                 self.scheduler.step()
+
+            self.save_checkpoint(train_loader, epoch)
                   
         print('Training Finished!')        
 
@@ -58,7 +63,7 @@ class Trainer(trainer.GenericTrainer):
         n_groups = train_loader.dataset.n_groups
         n_subgroups = n_classes * n_groups
         
-        total_loss = torch.zeros(n_subgroups).cuda(device=self.device)
+        total_loss = torch.zeros(n_subgroups).to(self.device)
         
         idxs = np.array([i * n_classes for i in range(n_groups)])            
         for i, data in enumerate(train_loader):
@@ -70,24 +75,25 @@ class Trainer(trainer.GenericTrainer):
 #                 groups_prob = groups
 #                 groups = torch.distributions.categorical.Categorical(groups_prob).sample()
             
-            if self.cuda:
-                inputs = inputs.cuda(device=self.device)
-                labels = labels.cuda(device=self.device)
-                groups = groups.cuda(device=self.device)
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
                 
             subgroups = groups * n_classes + labels
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                )[1] 
-            else:
-                outputs = model(inputs)
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                    )[1] 
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
 
             if criterion is not None:
                 loss = criterion(outputs, labels)
@@ -95,10 +101,7 @@ class Trainer(trainer.GenericTrainer):
                 loss = self.train_criterion(outputs, labels)
 
             # calculate the balSampling losses
-            group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-            group_count = group_map.sum(1)
-            group_denom = group_count + (group_count==0).float() # avoid nans
-            group_loss = (group_map @ loss.view(-1))/group_denom
+            group_loss = subgroup_mean(loss, subgroups, n_subgroups)
             avg_group_loss = group_loss.sum() / n_subgroups
             
             var_loss = 0
@@ -111,13 +114,10 @@ class Trainer(trainer.GenericTrainer):
             total_loss = avg_group_loss + var_loss
             
             self.optimizer.zero_grad()
-            total_loss.backward()                
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(total_loss, model, clip=self.data == 'jigsaw')
                 
-            running_loss += total_loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += total_loss.detach()
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
             if i % self.term == self.term-1: # print every self.term mini-batches
                 avg_batch_time = time.time()-batch_start_time
                 print('[{}/{}, {:5d}] Method: {} Train Loss: {:.3f} Train Acc: {:.2f} '
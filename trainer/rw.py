@@ -5,7 +5,7 @@ import torch
 import torch.nn as nn
 import time
 import torch.optim as optim
-from utils import get_accuracy
+from utils import get_accuracy, subgroup_mean
 from collections import defaultdict
 import trainer
 import pickle
@@ -31,7 +31,10 @@ class Trainer(trainer.GenericTrainer):
         start_t = time.time()
         weight_matrix = self.get_reweight_matrix(y_set, s_set, n_groups, n_classes)  
 
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
             self._train_epoch(epoch, train_loader, model, weight_matrix)
 
             eval_start_time = time.time()                
@@ -51,24 +54,22 @@ class Trainer(trainer.GenericTrainer):
                    eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
 
             if self.record:
-                self.evaluate(self.model, train_loader, 
-                              self.criterion, epoch, 
-                              train=True, 
-                              record=self.record,
-                              writer=writer
-                             )
+                self.record_train(train_loader, epoch, writer)
 
             if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
                 self.scheduler.step(eval_loss)
             else:
                 self.scheduler.step()
 
+            self.save_checkpoint(train_loader, epoch)
+
         end_t = time.time()
         train_t = int((end_t - start_t) / 60)
         print('Training Time : {} hours {} minutes '.format(int(train_t / 60), (train_t % 60)))
                                                                           
     def _train_epoch(self, epoch, train_loader, model, weight_matrix, criterion=None):
         model.train()
+        self.start_train_record(train_loader)
 
         running_acc = 0.0
         running_loss = 0.0
@@ -88,32 +89,30 @@ class Trainer(trainer.GenericTrainer):
 
             weights = weight_matrix[groups, labels]
             
-            if self.cuda:
-                inputs = inputs.cuda()
-                labels = labels.cuda()
-                weights = weights.cuda()
-                groups = groups.cuda()
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            weights = weights.to(self.device)
+            groups = groups.to(self.device)
                 
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                )[1] 
-            else:
-                outputs = model(inputs)
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                    )[1] 
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
                 
             if self.balanced:
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_count = group_map.sum(1)
-                group_denom = group_count + (group_count==0).float() # avoid nans
                 loss = self.train_criterion(outputs, labels)
-                group_loss = (group_map @ loss.view(-1))/group_denom
+                group_loss = subgroup_mean(loss, subgroups, n_subgroups)
                 loss = torch.mean(group_loss)
             else:
                 if criterion is not None:
@@ -121,14 +120,12 @@ class Trainer(trainer.GenericTrainer):
                 else:
                     loss = self.criterion(outputs, labels).mean()
 
-            loss.backward()
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
             
-            running_loss += loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += loss.detach()
+            self.track_train(outputs, labels, groups)
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
 
             batch_end_time = time.time()
             avg_batch_time += batch_end_time - batch_start_time
@@ -144,24 +141,10 @@ class Trainer(trainer.GenericTrainer):
                 avg_batch_time = 0.0
 
     def get_statistics(self, dataset, bs=128, n_workers=2, model=None):
-
-        dataloader = DataLoader(dataset, batch_size=bs, shuffle=False,
-                                num_workers=n_workers, pin_memory=True, drop_last=False)
-
-        if model != None:
-            model.eval()
-
-        y_set = []
-        s_set = []
-        with torch.no_grad():
-            for i, data in enumerate(dataloader):
-                _, _, sen_attrs, targets, _ = data
-                y_set.append(targets) 
-                s_set.append(sen_attrs)
-
-        y_set = torch.cat(y_set)
-        s_set = torch.cat(s_set)
-        return y_set.long().cuda(), s_set.long().cuda()
+        # labels and groups come from the dataset metadata; no input is loaded
+        y_set = torch.from_numpy(dataset.get_label_array())
+        s_set = torch.from_numpy(dataset.get_group_array())
+        return y_set.long().to(self.device), s_set.long().to(self.device)
 
     # update weight
     def get_reweight_matrix(self, label, sen_attrs, n_groups, n_classes):  
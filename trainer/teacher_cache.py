@@ -0,0 +1,116 @@
+import os
+import copy
+import hashlib
+import numpy as np
+import torch
+from torchvision import transforms
+from torch.utils.data import DataLoader
+
+
+class TeacherCache:
+    """
+    Features of a frozen teacher for every sample of the train set, computed once
+    and memory-mapped from <dataset root>/cache as (N, D) or, with K augmented
+    views, (N, K, D) float32. Rows are looked up by the index each dataset returns.
+
+    views=0 stores the non-augmented view of each sample. views=K>0 stores K
+    views drawn with the train augmentation and fixed seeds; each lookup picks one
+    of them at random per sample. The file name holds a hash of the teacher
+    weights, the samples and the views, so a stale cache is never reused.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.features = torch.from_numpy(np.load(path, mmap_mode='c'))
+        self.views = self.features.shape[1] if self.features.dim() == 3 else 0
+
+    def __len__(self):
+        return len(self.features)
+
+    def lookup(self, idx, device):
+        # waterbird returns (index, file name) pairs
+        if isinstance(idx, (list, tuple)):
+            idx = idx[0]
+        if idx.device != self.features.device:
+            # the loader keeps its data on the device (--resident), so the features go there once as well
+            self.features = self.features.to(idx.device)
+        if self.views > 0:
+            view = torch.randint(self.views, idx.shape, device=idx.device)
+            f_t = self.features[idx, view]
+        else:
+            f_t = self.features[idx]
+        return f_t.to(device, non_blocking=True)
+
+    @staticmethod
+    def make_key(teacher_path, dataset, views, seed):
+        sha = hashlib.sha1()
+        with open(teacher_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                sha.update(chunk)
+        sha.update('{}:{}:{}:{}:{}'.format(dataset.root, dataset.split, len(dataset), views, seed).encode('utf-8'))
+        sha.update(np.asarray(dataset.get_group_array(), dtype=np.int64).tobytes())
+        sha.update(np.asarray(dataset.get_label_array(), dtype=np.int64).tobytes())
+        return sha.hexdigest()
+
+    @classmethod
+    def open_or_build(cls, forward, teacher_path, dataset, device, views=0, seed=0, batch_size=256, n_workers=4):
+        """
+        forward(inputs, labels) -> (batch, ...) teacher features, run under no_grad.
+        """
+        key = cls.make_key(teacher_path, dataset, views, seed)
+        cache_dir = os.path.join(dataset.root, 'cache')
+        path = os.path.join(cache_dir, 'teacher_{}_{}_{}.npy'.format(dataset.split, views, key[:10]))
+        if not os.path.exists(path):
+            os.makedirs(cache_dir, exist_ok=True)
+            cls.build(path, forward, dataset, device, views, seed, batch_size, n_workers)
+        return cls(path)
+
+    @classmethod
+    def build(cls, path, forward, dataset, device, views=0, seed=0, batch_size=256, n_workers=4):
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        n = len(dataset)
+        features = None
+        for view in range(max(views, 1)):
+            # each view is drawn from its own seed, in the main process or in the loader workers,
+            # without touching the RNG state of training
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(seed * max(views, 1) + view)
+                loader = DataLoader(_view_dataset(dataset, augment=views > 0), batch_size=batch_size, shuffle=False,
+                                    num_workers=n_workers, drop_last=False, collate_fn=dataset.collate_fn)
+                for i, (inputs, _, _, labels, idx) in enumerate(loader):
+                    if isinstance(idx, (list, tuple)):
+                        idx = idx[0]
+                    with torch.no_grad():
+                        f_t = forward(inputs.to(device), labels.to(device))
+                    f_t = f_t.float().reshape(len(f_t), -1).cpu().numpy()
+                    if features is None:
+                        shape = (n, views, f_t.shape[1]) if views > 0 else (n, f_t.shape[1])
+                        features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=shape)
+                    if views > 0:
+                        features[idx.numpy(), view] = f_t
+                    else:
+                        features[idx.numpy()] = f_t
+                    if i % 100 == 0:
+                        print('[{}/{}] caching teacher features, view {}/{}'.format(i * batch_size, n, view + 1,
+                                                                                   max(views, 1)))
+        features.flush()
+        del features
+        os.replace(tmp_path, path)
+
+
+def _view_dataset(dataset, augment):
+    # a shallow copy of the train set with the transform of the cached view
+    train_transform = getattr(dataset, 'train_transform', None)
+    if train_transform is None:
+        # no augmentation (adult, compas, jigsaw)
+        return dataset
+    cached = getattr(dataset, 'image_cache', None) is not None
+    view = copy.copy(dataset)
+    if augment:
+        view.transform = dataset.cached_train_transform if cached else train_transform
+    elif cached and isinstance(dataset.cache_size, dict):
+        # the train images are cached at the train size, the test view resizes them to the test size
+        view.transform = transforms.Compose([transforms.Resize(dataset.cache_size['test'], antialias=True),
+                                             dataset.cached_test_transform])
+    else:
+        view.transform = dataset.cached_test_transform if cached else dataset.test_transform
+    return view
@@ -3,8 +3,8 @@ import numpy as np
 import os
 import torch.nn as nn
 from torch.optim.lr_scheduler import ReduceLROnPlateau, MultiStepLR, CosineAnnealingLR
-from sklearn.metrics import confusion_matrix
-from utils import make_log_name
+from utils import make_log_name, subgroup_stats, get_device
+from trainer.checkpoint import CheckpointWriter, cpu_snapshot, get_rng_state, set_rng_state
 
 
 class TrainerFactory:
@@ -52,12 +52,15 @@ class GenericTrainer:
     '''
     Base class for trainer; to implement a new training routine, inherit from this. 
     '''
+    # method-specific attributes that change during training and go into checkpoints
+    checkpoint_attrs = ()
+
     def __init__(self, model, args, optimizer, scheduler=None):
         self.model = model
         self.optimizer = optimizer
         
         self.cuda = args.cuda
-        self.device = args.device        
+        self.device = get_device(args)
         self.term = args.term
         self.seed = args.seed
         self.get_inter = args.get_inter
@@ -66,6 +69,9 @@ class GenericTrainer:
         self.method = args.method
         self.model_name =args.model
         self.record = args.record
+        # collect the train-set record from the training steps instead of an extra pass (see record_train)
+        self.fused_record = args.record and args.fused_record
+        self.train_stats = None
 
         self.criterion=torch.nn.CrossEntropyLoss(reduction='none')
         self.fairness_criterion = args.fairness_criterion
@@ -79,6 +85,19 @@ class GenericTrainer:
         self.lr = args.lr
         self.max_grad_norm = args.max_grad_norm
 
+        # mixed precision: only the forward passes run under autocast, losses are computed in fp32
+        self.amp_dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(args.amp)
+        self.amp_device = self.device.type
+        self.scaler = torch.amp.GradScaler(self.amp_device, enabled=args.amp == 'fp16' and self.cuda)
+        self.channels_last = args.channels_last
+        if self.channels_last and self.model is not None:
+            self.model = self.model.to(memory_format=torch.channels_last)
+
+        # K stacked mlp replicas (networks.mlp.StackedMLP) give (K, batch, n_classes) outputs;
+        # per-replica tensors carry replica_shape as their leading dimensions
+        self.n_replicas = args.replicas
+        self.replica_shape = () if self.n_replicas == 1 else (self.n_replicas,)
+
         # for redefining data handler        
         self.data = args.dataset
         self.bs = args.batch_size
@@ -89,6 +108,14 @@ class GenericTrainer:
         self.log_dir = os.path.join(args.log_dir, args.date, args.dataset, args.method)
         self.save_dir = os.path.join(args.save_dir, args.date, args.dataset, args.method)
 
+        # checkpoints of the state after every ckpt_freq-th epoch, written in the background
+        self.ckpt_freq = args.ckpt_freq
+        self.ckpt_path = os.path.join(self.save_dir, self.log_name + '_ckpt.pt')
+        self.ckpt_writer = CheckpointWriter()
+        self.resume_requested = args.resume
+        self.resume_position = None
+        self.n_finished_epochs = 0
+
         if scheduler is None:
             if self.optim_type == 'Adam' and self.optimizer is not None:
                 self.scheduler = ReduceLROnPlateau(self.optimizer)
@@ -104,6 +131,96 @@ class GenericTrainer:
             self.scheduler = scheduler
             
 
+    def autocast(self):
+        return torch.autocast(self.amp_device, dtype=self.amp_dtype, enabled=self.amp_dtype is not None)
+
+    def backward_step(self, loss, model, clip=False, optimizer=None):
+        # backward and optimizer step through the grad scaler, which is a pass-through unless fp16 is used
+        optimizer = self.optimizer if optimizer is None else optimizer
+        self.scaler.scale(loss).backward()
+        if clip:
+            self.scaler.unscale_(optimizer)
+            torch.nn.utils.clip_grad_norm_(model.parameters(), self.max_grad_norm)
+        self.scaler.step(optimizer)
+        self.scaler.update()
+
+    def replica_param(self, value, values, n_dims=1):
+        # a hyperparameter as a float, or as a (K, 1, ...) tensor with one value per replica
+        # that broadcasts against per-replica tensors with n_dims trailing dimensions
+        if self.n_replicas == 1:
+            return value
+        return torch.tensor(values, device=self.device).view((self.n_replicas,) + (1,) * n_dims)
+
+    def per_sample_loss(self, criterion, outputs, labels):
+        # (batch,) losses, or (batch, K) for the (K, batch, n_classes) outputs of stacked replicas
+        if self.n_replicas == 1:
+            return criterion(outputs, labels)
+        return criterion(outputs.flatten(0, 1), labels.repeat(self.n_replicas)).view(self.n_replicas, -1).t()
+
+    def per_sample_acc(self, outputs, labels):
+        acc = (torch.argmax(outputs, -1) == labels).float()
+        return acc if self.n_replicas == 1 else acc.t()
+
+    def print_replicas(self, epoch, epochs, loss, acc, dcaM, dcaA, eval_time):
+        print('[{}/{}] Method: {} [{:.2f} s]'.format(epoch + 1, epochs, self.method, eval_time))
+        for k in range(self.n_replicas):
+            print('    replica {:2d} Test Loss: {:.3f} Test Acc: {:.2f} Test DCAM {:.2f} Test DCAA {:.2f}'.format
+                  (k, loss[k], acc[k], dcaM[k], dcaA[k]))
+
+    def can_resume(self):
+        return self.resume_requested and os.path.exists(self.ckpt_path)
+
+    def finished(self, *position):
+        # whether the epoch (or step) at position, e.g. (iter_, epoch), is already covered by the resumed checkpoint
+        return self.resume_position is not None and position <= self.resume_position
+
+    def checkpoint_state(self, train_loader, position):
+        state = {'position': position,
+                 'n_finished_epochs': self.n_finished_epochs,
+                 'model': self.model.state_dict(),
+                 'optimizer': self.optimizer.state_dict(),
+                 'scheduler': self.scheduler.state_dict() if self.scheduler is not None else None,
+                 'scaler': self.scaler.state_dict(),
+                 'rng': get_rng_state(self.cuda),
+                 'trainer': {name: getattr(self, name) for name in self.checkpoint_attrs if hasattr(self, name)}}
+        sampler = getattr(train_loader, 'sampler', None)
+        if hasattr(sampler, 'state_dict'):
+            state['sampler'] = sampler.state_dict()
+        return state
+
+    def save_checkpoint(self, train_loader, *position):
+        # called at the end of every epoch; position orders the epochs of nested loops, e.g. (iter_, epoch)
+        self.n_finished_epochs += 1
+        if self.ckpt_freq <= 0 or self.n_finished_epochs % self.ckpt_freq != 0:
+            return
+        # the copy is taken here, on the host, the serialization happens in the writer thread
+        self.ckpt_writer.write(self.ckpt_path, cpu_snapshot(self.checkpoint_state(train_loader, position)))
+
+    def resume(self, train_loader):
+        # call at the start of train(), after the method-specific state has been initialized
+        if not self.can_resume():
+            if self.resume_requested:
+                print('No checkpoint at {}, training from scratch'.format(self.ckpt_path))
+            return
+        # tensors saved from another device (or on a gpu, resumed with --cpu) go to this run's device
+        state = torch.load(self.ckpt_path, map_location=self.device, weights_only=False)
+        self.model.load_state_dict(state['model'])
+        self.optimizer.load_state_dict(state['optimizer'])
+        if state['scheduler'] is not None:
+            self.scheduler.load_state_dict(state['scheduler'])
+        self.scaler.load_state_dict(state['scaler'])
+        for name, value in state['trainer'].items():
+            setattr(self, name, value)
+        if 'sampler' in state:
+            train_loader.sampler.load_state_dict(state['sampler'])
+        set_rng_state(state['rng'])
+        self.n_finished_epochs = state['n_finished_epochs']
+        self.resume_position = tuple(state['position'])
+        print('Resumed from {} after epoch {}'.format(self.ckpt_path, self.resume_position))
+
+    def wait_checkpoint(self):
+        self.ckpt_writer.wait()
+
     def evaluate(self, model, loader, criterion, epoch=0, device=None, train=False, record=False, writer=None):
         if record:
             assert writer is not None
@@ -117,9 +234,9 @@ class GenericTrainer:
         n_subgroups = n_groups * n_classes        
         device = self.device if device is None else device
 
-        group_count = torch.zeros(n_subgroups).cuda(device=device)
-        group_loss = torch.zeros(n_subgroups).cuda(device=device)        
-        group_acc = torch.zeros(n_subgroups).cuda(device=device) 
+        group_count = torch.zeros(n_subgroups).to(device)
+        group_loss = torch.zeros((n_subgroups,) + self.replica_shape).to(device)        
+        group_acc = torch.zeros((n_subgroups,) + self.replica_shape).to(device) 
         
         with torch.no_grad():
             for j, eval_data in enumerate(loader):
@@ -129,47 +246,40 @@ class GenericTrainer:
                 inputs, _, groups, classes, _ = eval_data
                 labels = classes 
             
-                if self.cuda:
-                    inputs = inputs.cuda(device)
-                    labels = labels.cuda(device)
-                    groups = groups.cuda(device)
+                inputs = inputs.to(device)
+                labels = labels.to(device)
+                groups = groups.to(device)
                     
-                if self.data == 'jigsaw':
-                    input_ids = inputs[:, :, 0]
-                    input_masks = inputs[:, :, 1]
-                    segment_ids = inputs[:, :, 2]
-                    outputs = model(
-                        input_ids=input_ids,
-                        attention_mask=input_masks,
-                        token_type_ids=segment_ids,
-                        labels=labels,
-                    )[1] 
-                else:
-                    outputs = model(inputs)
-
-                loss = criterion(outputs, labels)
-                preds = torch.argmax(outputs, 1)
-                acc = (preds == labels).float().squeeze()
+                with self.autocast():
+                    if self.data == 'jigsaw':
+                        input_ids = inputs[:, :, 0]
+                        input_masks = inputs[:, :, 1]
+                        segment_ids = inputs[:, :, 2]
+                        outputs = model(
+                            input_ids=input_ids,
+                            attention_mask=input_masks,
+                            token_type_ids=segment_ids,
+                            labels=labels,
+                        )[1] 
+                    else:
+                        outputs = model(inputs)
+                outputs = outputs.float()
+
+                loss = self.per_sample_loss(criterion, outputs, labels)
+                acc = self.per_sample_acc(outputs, labels)
                 
                 # calculate the losses for each group
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_count += group_map.sum(1)
+                shape = (-1,) + self.replica_shape
+                count, loss_sum, _ = subgroup_stats(loss.reshape(shape), subgroups, n_subgroups)
+                _, acc_sum, _ = subgroup_stats(acc.reshape(shape), subgroups, n_subgroups)
+                group_count += count
 
-                group_loss += (group_map @ loss.view(-1))
-                group_acc += group_map @ acc
+                group_loss += loss_sum
+                group_acc += acc_sum
 
-            loss = group_loss.sum() / group_count.sum() 
-            acc = group_acc.sum() / group_count.sum() 
-
-            group_loss /= group_count
-            group_acc /= group_count
-
-            group_loss = group_loss.reshape((n_groups, n_classes))            
-            group_acc = group_acc.reshape((n_groups, n_classes))
-            balSampling_acc_gap = torch.max(group_acc, dim=0)[0] - torch.min(group_acc, dim=0)[0]
-            dcaA = torch.mean(balSampling_acc_gap).item()
-            dcaM = torch.max(balSampling_acc_gap).item()
+            loss, acc, dcaM, dcaA, group_acc, group_loss = self.summarize_subgroups(group_count, group_loss, group_acc,
+                                                                                    n_groups, n_classes)
 
         if record:
             self.write_record(writer, epoch, loss, acc, dcaM, dcaA, group_loss, group_acc, train)
@@ -177,6 +287,61 @@ class GenericTrainer:
         model.train()
         return loss, acc, dcaM, dcaA, group_acc, group_loss
     
+    def summarize_subgroups(self, group_count, group_loss, group_acc, n_groups, n_classes):
+        # overall and per-subgroup loss/acc and the dca from per-subgroup counts and sums
+        loss = group_loss.sum(0) / group_count.sum() 
+        acc = group_acc.sum(0) / group_count.sum() 
+
+        group_count = group_count.view((-1,) + (1,) * len(self.replica_shape))
+        group_loss = group_loss / group_count
+        group_acc = group_acc / group_count
+
+        # (n_groups, n_classes), or (K, n_groups, n_classes) for stacked replicas
+        group_loss = group_loss.movedim(0, -1).reshape(self.replica_shape + (n_groups, n_classes))            
+        group_acc = group_acc.movedim(0, -1).reshape(self.replica_shape + (n_groups, n_classes))
+        balSampling_acc_gap = torch.max(group_acc, dim=-2)[0] - torch.min(group_acc, dim=-2)[0]
+        dcaA = torch.mean(balSampling_acc_gap, dim=-1).tolist()
+        dcaM = torch.max(balSampling_acc_gap, dim=-1)[0].tolist()
+        return loss, acc, dcaM, dcaA, group_acc, group_loss
+
+    def start_train_record(self, loader):
+        # call at the start of _train_epoch; with --fused-record the steps then add their outputs with track_train
+        if not self.fused_record:
+            return
+        n_groups, n_classes = loader.dataset.n_groups, loader.dataset.n_classes
+        shape = (n_groups * n_classes,)
+        self.train_stats = {'n_groups': n_groups, 'n_classes': n_classes,
+                            'count': torch.zeros(shape, device=self.device),
+                            'loss': torch.zeros(shape + self.replica_shape, device=self.device),
+                            'acc': torch.zeros(shape + self.replica_shape, device=self.device)}
+
+    def track_train(self, outputs, labels, groups):
+        # adds the logits of a training step to the train-set record of the epoch, without a host sync
+        if self.train_stats is None:
+            return
+        stats = self.train_stats
+        with torch.no_grad():
+            outputs = outputs.detach().float()
+            loss = self.per_sample_loss(self.criterion, outputs, labels)
+            acc = self.per_sample_acc(outputs, labels)
+            subgroups = groups.long() * stats['n_classes'] + labels
+            n_subgroups = len(stats['count'])
+            count, loss_sum, _ = subgroup_stats(loss, subgroups, n_subgroups)
+            stats['count'] += count
+            stats['loss'] += loss_sum
+            stats['acc'] += subgroup_stats(acc, subgroups, n_subgroups)[1]
+
+    def record_train(self, train_loader, epoch, writer):
+        # the train-set record of an epoch: with --fused-record it comes from the training steps of the epoch,
+        # i.e. from the weights as they were during the epoch, otherwise from a separate pass over the train set
+        if self.train_stats is None:
+            return self.evaluate(self.model, train_loader, self.criterion, epoch, train=True, record=True, writer=writer)
+        stats, self.train_stats = self.train_stats, None
+        loss, acc, dcaM, dcaA, group_acc, group_loss = self.summarize_subgroups(stats['count'], stats['loss'], stats['acc'],
+                                                                                stats['n_groups'], stats['n_classes'])
+        self.write_record(writer, epoch, loss, acc, dcaM, dcaA, group_loss, group_acc, train=True)
+        return loss, acc, dcaM, dcaA, group_acc, group_loss
+
     def write_record(self, writer, epoch, loss, acc, dcaM, dcaA, group_loss, group_acc, train=False):
         flag = 'train' if train else 'test'
         
@@ -208,65 +373,80 @@ class GenericTrainer:
     def compute_confusion_matix(self, dataset='test', n_classes=2,
                                 dataloader=None, log_dir="", log_name=""):
         from scipy.io import savemat
-        from collections import defaultdict
         self.model.eval()
-        confu_mat = defaultdict(lambda: np.zeros((n_classes, n_classes)))
-        print('# of {} data : {}'.format(dataset, len(dataloader.dataset)))
-
-        predict_mat = {}
-        output_set = torch.tensor([])
-        group_set = torch.tensor([], dtype=torch.long)
-        target_set = torch.tensor([], dtype=torch.long)
-        intermediate_feature_set = torch.tensor([])
+        n_groups = dataloader.dataset.n_groups
+        n_data = len(dataloader.dataset)
+        print('# of {} data : {}'.format(dataset, n_data))
+
+        # preallocated buffers filled in place; the penultimate features are streamed to a memory-mapped .npy
+        output_set = torch.zeros((n_data, n_classes), device=self.device)
+        group_set = torch.zeros(n_data, dtype=torch.long, device=self.device)
+        target_set = torch.zeros(n_data, dtype=torch.long, device=self.device)
+        confu_count = torch.zeros(n_groups * n_classes * n_classes, dtype=torch.long, device=self.device)
+        feature_path = os.path.join(log_dir, log_name + '_{}_inter.npy'.format(dataset))
+        intermediate_feature_set = None
+        n = 0
         
         with torch.no_grad():
             for i, data in enumerate(dataloader):
                 # Get the inputs
                 inputs, _, groups, targets, _ = data
                 labels = targets
-                groups = groups.long()
-
-                if self.cuda:
-                    inputs = inputs.cuda(self.device)
-                    labels = labels.cuda(self.device)
-
-                # forward                    
-                if self.data == 'jigsaw':
-                    input_ids = inputs[:, :, 0]
-                    input_masks = inputs[:, :, 1]
-                    segment_ids = inputs[:, :, 2]
-                    outputs = self.model(
-                        input_ids=input_ids,
-                        attention_mask=input_masks,
-                        token_type_ids=segment_ids,
-                        labels=labels,
-                    )[1] 
-                else:
-                    outputs = self.model(inputs)
+
+                inputs = inputs.to(self.device)
+                labels = labels.to(self.device)
+                groups = groups.to(self.device).long()
+
+                # forward, with the penultimate features from the same call
+                with self.autocast():
+                    if self.data == 'jigsaw':
+                        input_ids = inputs[:, :, 0]
+                        input_masks = inputs[:, :, 1]
+                        segment_ids = inputs[:, :, 2]
+                        outputs = self.model(
+                            input_ids=input_ids,
+                            attention_mask=input_masks,
+                            token_type_ids=segment_ids,
+                            labels=labels,
+                        )[1] 
+                    elif self.get_inter:
+                        results = self.model(inputs, get_inter=True)
+                        intermediate_feature, outputs = results[-2], results[-1]
+                    else:
+                        outputs = self.model(inputs)
+                outputs = outputs.float()
                     
-                if self.get_inter:
-                    intermediate_feature = self.model.forward(inputs, get_inter=True)[-2]
+                bs = len(labels)
+                if self.get_inter and self.data != 'jigsaw':
+                    if intermediate_feature_set is None:
+                        intermediate_feature_set = np.lib.format.open_memmap(
+                            feature_path, mode='w+', dtype=np.float32, shape=(n_data,) + tuple(intermediate_feature.shape[1:]))
+                    intermediate_feature_set[n:n+bs] = intermediate_feature.float().cpu().numpy()
+
+                group_set[n:n+bs] = groups
+                target_set[n:n+bs] = labels
+                output_set[n:n+bs] = outputs
+
+                # per-group confusion matrices (rows: labels, columns: predictions) with one bincount
+                pred = torch.argmax(outputs, 1)
+                confu_count += torch.bincount((groups * n_classes + labels) * n_classes + pred,
+                                              minlength=n_groups * n_classes * n_classes)
+                n += bs
 
-                group_set = torch.cat((group_set, groups))
-                target_set = torch.cat((target_set, targets))
-                output_set = torch.cat((output_set, outputs.cpu()))
-                if self.get_inter:
-                    intermediate_feature_set = torch.cat((intermediate_feature_set, intermediate_feature.cpu()))
+        confu_count = confu_count.view(n_groups, n_classes, n_classes).cpu().numpy().astype(np.float64)
+        confu_mat = {str(g): confu_count[g] for g in range(n_groups) if confu_count[g].sum() > 0}
 
-                pred = torch.argmax(outputs, 1)
-                group_element = list(torch.unique(groups).numpy())
-                for i in group_element:
-                    mask = groups == i
-                    if len(labels[mask]) != 0:
-                        confu_mat[str(i)] += confusion_matrix(
-                            labels[mask].cpu().numpy(), pred[mask].cpu().numpy(),
-                            labels=[i for i in range(n_classes)])
-
-        predict_mat['group_set'] = group_set.numpy()
-        predict_mat['target_set'] = target_set.numpy()
-        predict_mat['output_set'] = output_set.numpy()
-        if self.get_inter:
-            predict_mat['intermediate_feature_set'] = intermediate_feature_set.numpy()
+        predict_mat = {}
+        predict_mat['group_set'] = group_set[:n].cpu().numpy()
+        predict_mat['target_set'] = target_set[:n].cpu().numpy()
+        predict_mat['output_set'] = output_set[:n].cpu().numpy()
+        if intermediate_feature_set is not None:
+            intermediate_feature_set.flush()
+            del intermediate_feature_set
+            if n < n_data: # e.g. drop_last
+                np.save(feature_path + '.tmp.npy', np.load(feature_path, mmap_mode='r')[:n])
+                os.replace(feature_path + '.tmp.npy', feature_path)
+            print('intermediate features saved to {}'.format(feature_path))
             
         savepath = os.path.join(log_dir, log_name + '_{}_confu'.format(dataset))
         print('savepath', savepath)
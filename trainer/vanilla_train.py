@@ -2,7 +2,7 @@ from __future__ import print_function
 from collections import defaultdict
 
 import time
-from utils import get_accuracy, cal_dca
+from utils import get_accuracy, cal_dca, subgroup_stats
 import trainer
 import torch
 import torch.nn as nn
@@ -16,7 +16,10 @@ class Trainer(trainer.GenericTrainer):
         model = self.model
         model.train()
 
+        self.resume(train_loader)
         for epoch in range(epochs):
+            if self.finished(epoch):
+                continue
             self._train_epoch(epoch, train_loader, model, criterion)
             
             eval_start_time = time.time()
@@ -29,27 +32,29 @@ class Trainer(trainer.GenericTrainer):
                                                                              writer=writer
                                                                             )
             eval_end_time = time.time()
-            print('[{}/{}] Method: {} '
-                  'Test Loss: {:.3f} Test Acc: {:.2f} Test DCAM {:.2f} [{:.2f} s]'.format
-                  (epoch + 1, epochs, self.method,
-                   eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
+            if self.n_replicas > 1:
+                self.print_replicas(epoch, epochs, eval_loss, eval_acc, eval_dcam, eval_dcaa, eval_end_time - eval_start_time)
+            else:
+                print('[{}/{}] Method: {} '
+                      'Test Loss: {:.3f} Test Acc: {:.2f} Test DCAM {:.2f} [{:.2f} s]'.format
+                      (epoch + 1, epochs, self.method,
+                       eval_loss, eval_acc, eval_dcam, (eval_end_time - eval_start_time)))
             
             if self.record:
-                self.evaluate(self.model, train_loader, self.criterion, epoch, 
-                              train=True, 
-                              record=self.record,
-                              writer=writer
-                             )
+                self.record_train(train_loader, epoch, writer)
                 cal_dca(train_loader,  self.model, writer, epoch)
                              
             if self.scheduler != None and 'Reduce' in type(self.scheduler).__name__:
-                self.scheduler.step(eval_loss)
+                self.scheduler.step(eval_loss.mean()) # stacked replicas share one lr schedule
             else:
                 self.scheduler.step()
+
+            self.save_checkpoint(train_loader, epoch)
         print('Training Finished!')        
 
     def _train_epoch(self, epoch, train_loader, model, criterion=None):
         model.train()
+        self.start_train_record(train_loader)
         
         running_acc = 0.0
         running_loss = 0.0
@@ -64,46 +69,43 @@ class Trainer(trainer.GenericTrainer):
             inputs, _, groups, targets, idx = data
             labels = targets
 
-            if self.cuda:
-                inputs = inputs.cuda()
-                labels = labels.cuda()
-                groups = groups.cuda()
+            inputs = inputs.to(self.device)
+            labels = labels.to(self.device)
+            groups = groups.to(self.device)
                 
-            if self.data == 'jigsaw':
-                input_ids = inputs[:, :, 0]
-                input_masks = inputs[:, :, 1]
-                segment_ids = inputs[:, :, 2]
-                outputs = model(
-                    input_ids=input_ids,
-                    attention_mask=input_masks,
-                    token_type_ids=segment_ids,
-                    labels=labels,
-                )[1] 
-            else:
-                outputs = model(inputs)
+            with self.autocast():
+                if self.data == 'jigsaw':
+                    input_ids = inputs[:, :, 0]
+                    input_masks = inputs[:, :, 1]
+                    segment_ids = inputs[:, :, 2]
+                    outputs = model(
+                        input_ids=input_ids,
+                        attention_mask=input_masks,
+                        token_type_ids=segment_ids,
+                        labels=labels,
+                    )[1] 
+                else:
+                    outputs = model(inputs)
+            outputs = outputs.float()
 
+            # the losses of stacked replicas are summed, so each replica gets its own gradients
             if self.balanced:
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_count = group_map.sum(1)
-                group_denom = group_count + (group_count==0).float() # avoid nans
-                loss = nn.CrossEntropyLoss(reduction='none')(outputs, labels)
-                group_loss = (group_map @ loss.view(-1))/group_denom
-                loss = torch.mean(group_loss)
+                loss = self.per_sample_loss(nn.CrossEntropyLoss(reduction='none'), outputs, labels)
+                group_loss = subgroup_stats(loss, subgroups, n_subgroups)[2]
+                loss = torch.mean(group_loss, 0).sum()
             else:
                 if criterion is not None:
-                    loss = criterion(outputs, labels).mean()
+                    loss = self.per_sample_loss(criterion, outputs, labels).mean(0).sum()
                 else:
-                    loss = self.criterion(outputs, labels).mean()
+                    loss = self.per_sample_loss(self.criterion, outputs, labels).mean(0).sum()
         
-            loss.backward()
-            if self.data == 'jigsaw':
-                torch.nn.utils.clip_grad_norm_(model.parameters(),self.max_grad_norm)
-            self.optimizer.step()
+            self.backward_step(loss, model, clip=self.data == 'jigsaw')
             self.optimizer.zero_grad()
 
-            running_loss += loss.item()
-            running_acc += get_accuracy(outputs, labels)
+            running_loss += loss.detach() / self.n_replicas
+            self.track_train(outputs, labels, groups)
+            running_acc += get_accuracy(outputs, labels, reduction='none').mean()
             
             if i % self.term == self.term-1: # print every self.term mini-batches
                 avg_batch_time = time.time()-batch_start_time
@@ -3,15 +3,18 @@ import numpy as np
 import random
 import os
 import torch.nn.functional as F
-import cvxpy as cvx
 import time 
+import threading
+import sys
 import torch.nn as nn
 import torch
-from torch.utils.data import DataLoader
+from data_handler.dataloader_factory import DataloaderFactory
 
 from copy import deepcopy
 
 def chi_proj(pre_q, rho):
+    # reference solver; use chi_proj_torch in training loops
+    import cvxpy as cvx
     #start = time.time()
     g = pre_q.shape[0]
     q = cvx.Variable(g)
@@ -33,6 +36,73 @@ def chi_proj(pre_q, rho):
     return q.value
 
 
+def _lambertw_exp(log_x, w=None, n_iter=6):
+    # principal branch of W(exp(log_x)), Newton on w + log(w) = log_x.
+    # softplus(log_x) = log(1 + x) upper-bounds W(x), so the first step lands
+    # left of the root and the iterates then increase monotonically to it.
+    w0 = F.softplus(log_x)
+    w = w0 if w is None else torch.minimum(w, w0)
+    for _ in range(n_iter):
+        w = w / (1 + w) * (1 + log_x - torch.log(w))
+    return w
+
+
+def chi_proj_torch(pre_q, rho, tol=1e-8, max_iter=100):
+    """Solver-free counterpart of chi_proj, batched over the last dimension.
+
+    Solves min_q KL(q || pre_q) s.t. q in the simplex and
+    ||q - 1/g||^2 <= 2 * rho / g for every row of pre_q at once; rho may be a
+    tensor that broadcasts against the rows.
+    The KKT conditions give q = W(xi * pre_q) / sum(W(xi * pre_q)) for a
+    scalar xi > 0 per row (W is the Lambert W function), so only a 1-d root
+    search over log(xi) is needed; it is done with a bracketed Newton method.
+    """
+    v = pre_q.double().clamp(min=1e-300)
+    g = v.shape[-1]
+    u = 1. / g
+    rho = torch.as_tensor(rho, dtype=v.dtype, device=v.device) # a float, or one value per row
+    radius = 2 * rho / g
+
+    p = v / v.sum(-1, keepdim=True)
+    inside = ((p - u) ** 2).sum(-1) <= radius
+    # a ball of radius 0 only holds the uniform vector
+    uniform = (radius <= 0).expand_as(inside)
+
+    # bracket for s = log(xi): the ball constraint is violated at lo and
+    # satisfied at hi, where every W(xi * v_i) >= z_min
+    log_v = v.log()
+    log_v_max = log_v.max(-1)[0]
+    log_v_min = log_v.min(-1)[0]
+    z_min = (log_v_max - log_v_min) / torch.sqrt(2 * torch.where(rho > 0, rho, torch.ones_like(rho))) + 1
+    hi = z_min + z_min.log() - log_v_min
+    lo = np.log(1e-12) - log_v_max
+
+    s = hi.clone()
+    q = p
+    for _ in range(max_iter):
+        z = _lambertw_exp(log_v + s.unsqueeze(-1))
+        t = z.sum(-1, keepdim=True)
+        q = z / t
+        f = ((q - u) ** 2).sum(-1) - radius
+        dz = z / (1 + z)
+        dq = (dz - q * dz.sum(-1, keepdim=True)) / t
+        df = 2 * ((q - u) * dq).sum(-1)
+
+        # f is decreasing in s
+        lo = torch.where(f > 0, s, lo)
+        hi = torch.where(f > 0, hi, s)
+        done = inside | uniform | (f.abs() <= tol * radius) | (hi - lo <= 1e-12)
+        if done.all():
+            break
+        s_newton = s - f / df
+        in_bracket = (s_newton > lo) & (s_newton < hi)
+        s = torch.where(in_bracket, s_newton, (lo + hi) / 2)
+
+    q = torch.where(inside.unsqueeze(-1), p, q)
+    q = torch.where(uniform.unsqueeze(-1), torch.full_like(q, u), q)
+    return q.to(pre_q.dtype)
+
+
 # def chi_proj_nonuni(pre_q, rho, group_dist):
 #     #start = time.time()
 #     g = pre_q.shape[0]
@@ -73,6 +143,21 @@ def set_seed(seed):
     torch.backends.cudnn.deterministic = True
 
 
+def get_device(args, teacher=False):
+    # every model, tensor and loader follows this device; --cpu (or no visible gpu) runs on cpu
+    if not args.cuda:
+        return torch.device('cpu')
+    return torch.device('cuda', args.t_device if teacher else args.device)
+
+
+def set_num_threads(args):
+    # intra-op threads (one op split across cores) and inter-op threads (independent ops run concurrently)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if args.num_interop_threads is not None:
+        torch.set_num_interop_threads(args.num_interop_threads)
+
+
 def get_accuracy(outputs, labels, binary=False, reduction='mean'):
     #if multi-label classification
     if len(labels.size())>1:
@@ -85,7 +170,7 @@ def get_accuracy(outputs, labels, binary=False, reduction='mean'):
     if binary:
         predictions = (torch.sigmoid(outputs) >= 0.5).float()
     else:
-        predictions = torch.argmax(outputs, 1)
+        predictions = torch.argmax(outputs, -1)
         
     c = (predictions == labels).float().squeeze()
     if reduction == 'none':
@@ -94,19 +179,80 @@ def get_accuracy(outputs, labels, binary=False, reduction='mean'):
         accuracy = torch.mean(c)
         return accuracy.item()
 
+def subgroup_stats(values, subgroups, n_subgroups):
+    """Per-subgroup count, sum and mean of values in O(batch) with index_add.
+
+    values is reduced along its first dimension; subgroups holds the subgroup
+    id (group * n_classes + label) of every row. Empty subgroups get a mean of 0.
+    """
+    subgroups = subgroups.long().view(-1)
+    count = torch.bincount(subgroups, minlength=n_subgroups).to(values.dtype)
+    total = values.new_zeros((n_subgroups,) + values.shape[1:]).index_add(0, subgroups, values)
+    denom = count + (count == 0).to(values.dtype) # avoid nans
+    mean = total / denom.view((-1,) + (1,) * (values.dim() - 1))
+    return count, total, mean
+
+
+class SyncCounter:
+    """Counts the reads of tensor values by the host (item, tolist, numpy, cpu and
+    bool/int/float conversions) and the optimizer steps while active.
+
+    On a gpu every such read waits for the device, so reads per step measure how
+    often a training loop stalls the device. Only the calling thread is counted,
+    and not the reads of the optimizers and data loaders, which only touch their
+    own bookkeeping tensors on the host.
+    """
+    methods = ['item', 'tolist', 'numpy', 'cpu', '__bool__', '__int__', '__float__']
+    ignored = (os.path.dirname(torch.optim.__file__), os.path.dirname(torch.utils.data.__file__))
+
+    def __init__(self):
+        self.n_syncs = 0
+        self.n_steps = 0
+
+    def _wrap(self, method):
+        thread = threading.get_ident()
+        def wrapper(tensor, *args, **kwargs):
+            if threading.get_ident() == thread and not sys._getframe(1).f_code.co_filename.startswith(self.ignored):
+                self.n_syncs += 1
+            return method(tensor, *args, **kwargs)
+        return wrapper
+
+    def __enter__(self):
+        # global optimizer hooks need torch >= 2.0, which only --count-syncs requires
+        from torch.optim.optimizer import register_optimizer_step_post_hook
+        self.originals = {name: getattr(torch.Tensor, name) for name in self.methods}
+        for name, method in self.originals.items():
+            setattr(torch.Tensor, name, self._wrap(method))
+        def count_step(optimizer, args, kwargs):
+            self.n_steps += 1
+        self.hook = register_optimizer_step_post_hook(count_step)
+        return self
+
+    def __exit__(self, *exc):
+        for name, method in self.originals.items():
+            setattr(torch.Tensor, name, method)
+        self.hook.remove()
+
+    def __str__(self):
+        return 'host syncs : {} in {} steps ({:.2f} per step)'.format(
+            self.n_syncs, self.n_steps, self.n_syncs / max(self.n_steps, 1))
+
+
+def subgroup_mean(values, subgroups, n_subgroups):
+    return subgroup_stats(values.view(-1), subgroups, n_subgroups)[2]
+
+
 def get_subgroup_accuracy(outputs, labels, groups, n_classes, n_groups, reduction='mean'):
     n_subgroups = n_classes*n_groups
     with torch.no_grad():
         subgroups = groups * n_classes + labels
-        group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-        group_count = group_map.sum(1)
-        group_denom = group_count + (group_count==0).float() # avoid nans
-        group_denom = group_denom.reshape((n_groups, n_classes))
-       
         predictions = torch.argmax(outputs, 1)
         c = (predictions==labels).float()
 
-        num_correct = (group_map @ c).reshape((n_groups, n_classes))
+        group_count, num_correct, _ = subgroup_stats(c, subgroups, n_subgroups)
+        group_denom = group_count + (group_count==0).float() # avoid nans
+        group_denom = group_denom.reshape((n_groups, n_classes))
+        num_correct = num_correct.reshape((n_groups, n_classes))
         subgroup_acc = num_correct/group_denom
         group_acc = num_correct.sum(1) / group_denom.sum(1) 
         
@@ -177,6 +323,9 @@ def make_log_name(args):
     if args.balanced:
         log_name += '_balanced'
 
+    if args.replicas > 1:
+        log_name += f'_replicas{args.replicas}'
+
     return log_name
 
 
@@ -184,22 +333,23 @@ def cal_dca(loader, model, writer, epoch):
     bs_list = [128, 256, 512,1024]
     acc_gap_dict = {}
     loss_gap_dict = {}
+    device = next(model.parameters()).device
     for bs in bs_list:
-        loader = DataLoader(loader.dataset, 
-                            batch_size=bs, 
-                            shuffle=False, 
-                            num_workers=1, 
-                            pin_memory=True, 
-                            drop_last=True)
+        loader = DataloaderFactory.get_loader(loader.dataset, 
+                                              batch_size=bs, 
+                                              shuffle=False, 
+                                              num_workers=1, 
+                                              pin_memory=device.type == 'cuda', 
+                                              drop_last=True)
         model.train()
 
         n_groups = loader.dataset.n_groups
         n_classes = loader.dataset.n_classes
         n_subgroups = n_groups * n_classes        
         
-        group_count_total = torch.zeros(n_subgroups).cuda()
-        group_loss_total = torch.zeros(n_subgroups).cuda()        
-        group_acc_total = torch.zeros(n_subgroups).cuda()        
+        group_count_total = torch.zeros(n_subgroups, device=device)
+        group_loss_total = torch.zeros(n_subgroups, device=device)
+        group_acc_total = torch.zeros(n_subgroups, device=device)
 
         group_loss_list = []
         group_acc_list = []
@@ -208,23 +358,18 @@ def cal_dca(loader, model, writer, epoch):
                 # Get the inputs
                 inputs, _, groups, targets, idx = data
                 labels = targets
-                inputs = inputs.cuda()
-                labels = labels.cuda()
-                groups = groups.cuda()
+                inputs = inputs.to(device)
+                labels = labels.to(device)
+                groups = groups.to(device)
                     
                 outputs = model(inputs)
                 preds = torch.argmax(outputs, 1)
                 acc = (preds == labels).float().squeeze()
 
                 subgroups = groups * n_classes + labels
-                group_map = (subgroups == torch.arange(n_subgroups).unsqueeze(1).long().cuda()).float()
-                group_count = group_map.sum(1)
-                group_denom = group_count + (group_count==0).float() # avoid nans
                 loss = nn.CrossEntropyLoss(reduction='none')(outputs, labels)
-                unnormalized_group_loss = (group_map @ loss.view(-1))
-                unnormalized_group_acc = (group_map @ acc)
-                group_loss = unnormalized_group_loss / group_denom
-                group_acc = unnormalized_group_acc / group_denom
+                group_count, unnormalized_group_loss, group_loss = subgroup_stats(loss, subgroups, n_subgroups)
+                _, unnormalized_group_acc, group_acc = subgroup_stats(acc, subgroups, n_subgroups)
                 loss = torch.mean(group_loss)
 
                 group_count_total += group_count